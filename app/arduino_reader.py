@@ -1,118 +1,385 @@
 # arduino_reader.py
 
+import heapq
 import os
 import threading
 import time
-import requests
 from datetime import datetime, timedelta
-from sqlalchemy import text
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from sqlalchemy import DateTime, Integer, bindparam, text
 from app.database import SessionLocal
-from app.devices.models import DeviceIot
+from app.leader_election import LeaderElector
+from app.command_bus import command_bus
+from app.transition_journal import transition_journal
+from app.device_twin import device_twin
+from app.scheduler_metrics import SchedulerMetrics, TickRecord, render_prometheus
 
-PORT          = os.getenv("PORT", "8003")
-SERVO_CMD_URL = f"http://localhost:{PORT}/devices/devices/servo-command"
 VALVE_TYPE_ID = 2
 
+# Sin deadlines ni avisos, el scheduler igual revisa cada SCHEDULER_MAX_IDLE segundos
+# (cubre cambios hechos fuera de la API). 0 = sólo deadlines y avisos.
+SCHEDULER_MAX_IDLE    = float(os.getenv("SCHEDULER_MAX_IDLE", "600"))
+SCHEDULER_RETRY_DELAY = 5.0   # s antes de reintentar si la revisión falla
+SCHEDULER_CHANNEL     = "valve_scheduler"   # canal NOTIFY para despertar al líder desde otro worker
+SCHEDULER_SLOW_TICK   = float(os.getenv("SCHEDULER_SLOW_TICK", "1.0"))  # s de tick o atraso que se reportan
 
-def device_status_scheduler() -> None:
-    print("[scheduler] hilo iniciado")
-    while True:
+# Reparto de dispositivos en shards (device_iot_id % SCHEDULER_SHARDS), cada uno con su
+# propio lease. Cada worker toma a lo sumo ceil(shards / SCHEDULER_WORKERS) shards.
+SCHEDULER_SHARDS  = max(1, int(os.getenv("SCHEDULER_SHARDS", "1")))
+SCHEDULER_WORKERS = max(1, int(os.getenv("SCHEDULER_WORKERS", "1")))
+
+
+# Estado objetivo de cada dispositivo con request aprobado y de cada válvula sin ninguno.
+# Una sola sentencia: calcula el objetivo, actualiza sólo lo que cambia y devuelve esos
+# dispositivos. request_id (último request aprobado) distingue el cierre por expiración
+# (se envía close al ESP32) del paso a No Operativo por no tener solicitudes.
+# El filtro del shard va dentro de latest: cada shard agrupa sólo los requests aprobados
+# de sus dispositivos (recorriendo ix_request_status_device_id) en vez de toda la tabla.
+# El estado anterior sólo sale en PostgreSQL: SQLite no deja leer las tablas del FROM
+# en RETURNING y en ese caso la transición queda con from_status NULL.
+_RECONCILE_SQL = """
+    WITH latest AS (
+        SELECT r.device_iot_id, r.open_date, r.close_date
+          FROM request r
+          JOIN (
+              SELECT MAX(id) max_id
+                FROM request
+               WHERE status = 17
+                 AND device_iot_id % :shards = :shard
+               GROUP BY device_iot_id
+          ) x ON r.id = x.max_id
+    ),
+    target AS (
+        SELECT d.id AS device_id, d.status AS old_status,
+               CASE
+                   WHEN l.device_iot_id IS NULL THEN 12                       -- sin solicitudes
+                   WHEN l.open_date > :now THEN                               -- solicitud futura
+                       CASE WHEN d.status IN (21, 22) THEN d.status ELSE 20 END
+                   WHEN :now BETWEEN l.open_date AND l.close_date THEN        -- apertura vigente
+                       CASE WHEN d.status = 20 THEN 22 ELSE d.status END
+                   WHEN l.close_date < :now THEN 12                           -- cierre expirado
+                   ELSE d.status
+               END AS new_status
+          FROM device_iot d
+          LEFT JOIN latest l ON l.device_iot_id = d.id
+         WHERE (l.device_iot_id IS NOT NULL OR d.devices_id = :valve_type_id)
+           AND d.id % :shards = :shard
+    )
+    UPDATE device_iot
+       SET status = target.new_status
+      FROM target
+     WHERE device_iot.id = target.device_id
+       AND target.new_status IS NOT NULL
+       AND COALESCE(device_iot.status, -1) <> target.new_status
+    RETURNING device_iot.id, device_iot.status, device_iot.lot_id, {old_status} AS old_status,
+              (SELECT MAX(q.id) FROM request q
+                WHERE q.device_iot_id = device_iot.id AND q.status = 17) AS request_id
+"""
+# :now con el mismo formato que las columnas (SQLite compara fechas como texto)
+RECONCILE_SQL = text(_RECONCILE_SQL.format(old_status="target.old_status")).bindparams(bindparam("now", type_=DateTime))
+RECONCILE_SQL_NO_FROM_RETURNING = text(_RECONCILE_SQL.format(old_status="NULL")).bindparams(bindparam("now", type_=DateTime))
+
+
+def command_for(status: int, has_request: bool) -> Optional[str]:
+    """Comando que se envía a la válvula al pasar a `status` (None si ninguno)."""
+    if status == 22:
+        return "open"
+    if status == 12 and has_request:
+        return "close"
+    return None
+
+
+def reconcile_device_statuses(db, now: datetime, shard: int = 0, shards: int = 1) -> List[Tuple[int, int, bool]]:
+    """
+    Lleva el estado de cada válvula del shard al que corresponde según su último request aprobado.
+    Devuelve (device_iot_id, nuevo estado, tiene request aprobado) de los que cambiaron.
+    Los comandos a las válvulas salen por el bus al confirmar la transacción de `db`.
+    """
+    sql = RECONCILE_SQL if db.get_bind().dialect.name == "postgresql" else RECONCILE_SQL_NO_FROM_RETURNING
+    seen = device_twin.seq
+    changed = db.execute(
+        sql, {"now": now, "valve_type_id": VALVE_TYPE_ID, "shard": shard, "shards": shards}
+    ).fetchall()
+    for dev_id, status, lot_id, old_status, request_id in changed:
+        has_request = request_id is not None
+        if status == 12 and has_request:
+            print(f"[scheduler] {dev_id} expiró close_date → 12 (No Operativo)")
+        elif status == 12:
+            print(f"[scheduler] {dev_id} → 12 (No Operativo, sin solicitudes)")
+        elif status == 22:
+            print(f"[scheduler] {dev_id} apertura vigente → 22 (Abierta)")
+        elif status == 20:
+            print(f"[scheduler] {dev_id} próxima apertura → 20 (En espera)")
+        action = command_for(status, has_request)
+        if action:
+            command_bus.publish_after_commit(db, dev_id, action, source="scheduler")
+        transition_journal.record_after_commit(
+            db, dev_id, lot_id, old_status, status, "scheduler", request_id=request_id, ts=now
+        )
+        device_twin.stage(db, dev_id, {"status": status}, seen)
+    return [(dev_id, status, request_id is not None) for dev_id, status, _, _, request_id in changed]
+
+
+class DeadlineScheduler:
+    """
+    Scheduler de válvulas guiado por deadlines: mantiene un min-heap con los próximos
+    open_date/close_date de los requests aprobados y duerme hasta el más cercano.
+    approve_request, update_request y reject_request lo despiertan con wake().
+    Cada despertar ejecuta reconcile_device_statuses y recarga el heap.
+    Sólo revisa el worker que tiene el liderazgo del shard; los demás esperan a ser elegidos.
+    clock permite conducirlo con un reloj virtual (benchmarks/simulate_scheduler.py).
+    """
+
+    def __init__(
+        self,
+        leader: LeaderElector,
+        shard: int = 0,
+        shards: int = 1,
+        max_idle: float = SCHEDULER_MAX_IDLE,
+        clock: Callable[[], datetime] = datetime.now
+    ):
+        self.leader = leader
+        self.clock = clock
+        self.shard = shard
+        self.shards = shards
+        self.max_idle = max_idle
+        self._heap: List[Tuple[datetime, int]] = []   # (deadline, device_iot_id)
+        self._cond = threading.Condition()
+        self._woken = False
+        self._last_tick = 0.0
+        self._thread = None
+        self.metrics = SchedulerMetrics(shard)
+
+    def owns(self, device_id: Optional[int]) -> bool:
+        return device_id is None or device_id % self.shards == self.shard
+
+    def wake(self) -> None:
+        """Avisar que cambiaron los requests: revisar y recalcular deadlines ya."""
+        with self._cond:
+            self._woken = True
+            self._cond.notify()
+
+    def _load_deadlines(self, db, now: datetime) -> List[Tuple[datetime, int]]:
+        """Próximos open_date/close_date del último request aprobado de cada dispositivo."""
+        rows = db.execute(text("""
+            SELECT r.device_iot_id, r.open_date, r.close_date
+              FROM request r
+              JOIN (
+                  SELECT MAX(id) max_id
+                    FROM request
+                   WHERE status = 17
+                     AND device_iot_id % :shards = :shard
+                   GROUP BY device_iot_id
+              ) x ON r.id = x.max_id
+             WHERE (r.open_date > :now OR r.close_date >= :now)
+        """).bindparams(bindparam("now", type_=DateTime)).columns(device_iot_id=Integer, open_date=DateTime, close_date=DateTime),
+            {"now": now, "shard": self.shard, "shards": self.shards}).fetchall()
+        deadlines = []
+        for dev_id, open_date, close_date in rows:
+            if open_date and open_date > now:
+                deadlines.append((open_date, dev_id))
+            if close_date and close_date >= now:
+                # El cierre se detecta con close_date < now: despertar justo después
+                deadlines.append((close_date + timedelta(milliseconds=1), dev_id))
+        heapq.heapify(deadlines)
+        return deadlines
+
+    def _pop_due(self, now: datetime) -> List[datetime]:
+        """Saca del heap los deadlines ya vencidos (para medir su atraso)."""
+        due = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, dev_id = heapq.heappop(self._heap)
+                if dev_id:   # 0 = reintento tras un error, no es un deadline de solicitud
+                    due.append(deadline)
+        return due
+
+    def tick(self, reason: str = "manual") -> List[Tuple[int, int, bool]]:
+        """Una revisión: reconcilia los estados del shard y recarga el heap. Devuelve los cambios."""
+        changed: List[Tuple[int, int, bool]] = []
+        now = self.clock()
+        record = TickRecord(now, reason)
+        due = self._pop_due(now)
+        lags: List[float] = []
+        started = time.perf_counter()
         db = SessionLocal()
         try:
-            now = datetime.now()
-
-            # 1) CIERRE EXPIRADO → cerrar + status 12 (No Operativo)
-            rows = db.execute(text("""
-                SELECT r.device_iot_id, r.close_date
-                  FROM request r
-                  JOIN (
-                      SELECT MAX(id) max_id
-                        FROM request
-                       WHERE status = 17
-                       GROUP BY device_iot_id
-                  ) x ON r.id = x.max_id
-                 WHERE r.close_date < :now
-            """), {"now": now}).fetchall()
-
-            for dev_id, cdate in rows:
-                dev = db.query(DeviceIot).get(dev_id)
-                if not dev:
-                    continue
-                if dev.status != 12:
-                    # Cambiamos directamente a No Operativo
-                    dev.status = 12
-                    print(f"[scheduler] {dev.id} expiró close_date {cdate} → 12 (No Operativo)")
-                    try:
-                        requests.post(SERVO_CMD_URL, json={"action": "close"}, timeout=2)
-                        print(f"[scheduler] POST close al ESP32 para dev {dev.id}")
-                    except requests.RequestException as e:
-                        print("[scheduler] POST close error:", e)
-
-            # 2) APERTURA VIGENTE → solo desde 20 a 22 (abierta)
-            rows = db.execute(text("""
-                SELECT r.device_iot_id, r.open_date
-                  FROM request r
-                  JOIN (
-                      SELECT MAX(id) max_id
-                        FROM request
-                       WHERE status = 17
-                       GROUP BY device_iot_id
-                  ) x ON r.id = x.max_id
-                 WHERE :now BETWEEN r.open_date AND r.close_date
-            """), {"now": now}).fetchall()
-
-            for dev_id, odate in rows:
-                dev = db.query(DeviceIot).get(dev_id)
-                if dev and dev.status == 20:
-                    dev.status = 22
-                    print(f"[scheduler] {dev.id} apertura {odate} → 22 (Abierta)")
-                    try:
-                        requests.post(SERVO_CMD_URL, json={"action": "open"}, timeout=2)
-                        print(f"[scheduler] POST open al ESP32 para dev {dev.id}")
-                    except requests.RequestException as e:
-                        print("[scheduler] POST open error:", e)
-
-            # 3) SOLICITUD FUTURA → status 20 (En espera)
-            rows = db.execute(text("""
-                SELECT r.device_iot_id, r.open_date
-                  FROM request r
-                  JOIN (
-                      SELECT MAX(id) max_id
-                        FROM request
-                       WHERE status = 17
-                       GROUP BY device_iot_id
-                  ) x ON r.id = x.max_id
-                 WHERE r.open_date > :now
-            """), {"now": now}).fetchall()
-
-            for dev_id, next_open in rows:
-                dev = db.query(DeviceIot).get(dev_id)
-                if dev and dev.status not in (21, 22):
-                    dev.status = 20
-                    print(f"[scheduler] {dev.id} próxima apertura {next_open} → 20 (En espera)")
-
-            # 4) SIN NINGUNA SOLICITUD → status 12 (No Operativo)
-            for dev in db.query(DeviceIot).filter(DeviceIot.devices_id == VALVE_TYPE_ID):
-                # si no hay ninguna solicitud aprobada
-                any_req = db.execute(text("""
-                    SELECT 1 FROM request
-                     WHERE device_iot_id = :dev_id
-                       AND status = 17
-                   LIMIT 1
-                """), {"dev_id": dev.id}).first()
-                if not any_req and dev.status != 12:
-                    dev.status = 12
-                    print(f"[scheduler] {dev.id} → 12 (No Operativo, sin solicitudes)")
-
+            changed = reconcile_device_statuses(db, now, self.shard, self.shards)
+            t_reconcile = time.perf_counter()
             db.commit()
-
+            t_commit = time.perf_counter()
+            applied = self.clock()
+            lags = [(applied - deadline).total_seconds() for deadline in due]
+            deadlines = self._load_deadlines(db, now)
+            record.phases = {
+                "reconcile": t_reconcile - started,
+                "commit": t_commit - t_reconcile,
+                "deadlines": time.perf_counter() - t_commit
+            }
+            record.rows = {"reconcile": len(changed), "deadlines": len(deadlines)}
         except Exception as e:
             db.rollback()
-            print("[scheduler] Error:", e)
+            record.error = str(e)
+            print(f"[scheduler] Error (shard {self.shard}):", e)
+            with self._cond:
+                deadlines = list(self._heap)
+            heapq.heappush(deadlines, (self.clock() + timedelta(seconds=SCHEDULER_RETRY_DELAY), 0))
         finally:
             db.close()
+        with self._cond:
+            self._heap = deadlines
+            self._last_tick = time.monotonic()
+
+        record.duration = time.perf_counter() - started
+        for _, status, has_request in changed:
+            record.transitions[status] = record.transitions.get(status, 0) + 1
+            action = command_for(status, has_request)
+            if action:
+                record.commands[action] = record.commands.get(action, 0) + 1
+        record.due = len(due)
+        record.max_lag = max(lags) if lags else None
+        self.metrics.record(record, lags)
+        if record.duration > SCHEDULER_SLOW_TICK or (record.max_lag or 0) > SCHEDULER_SLOW_TICK:
+            print(f"[scheduler] tick lento (shard {self.shard}): {record.to_dict()}")
+        return changed
+
+    def next_deadline(self) -> Optional[datetime]:
+        with self._cond:
+            return self._heap[0][0] if self._heap else None
+
+    def _wait(self) -> str:
+        """Duerme hasta el próximo deadline, un aviso o el tiempo máximo sin revisar."""
+        with self._cond:
+            while True:
+                if self._woken:
+                    self._woken = False
+                    return "wake"
+                if not self.leader.is_leader:
+                    self._cond.wait()
+                    continue
+                timeout: Optional[float] = None
+                if self.max_idle > 0:
+                    timeout = self.max_idle - (time.monotonic() - self._last_tick)
+                    if timeout <= 0:
+                        return "idle"
+                if self._heap:
+                    due = (self._heap[0][0] - self.clock()).total_seconds()
+                    if due <= 0:
+                        return "deadline"
+                    timeout = due if timeout is None else min(timeout, due)
+                self._cond.wait(timeout)
+
+    def run(self) -> None:
+        print(f"[scheduler] hilo iniciado (shard {self.shard}/{self.shards})")
+        reason = "start"
+        while True:
+            if self.leader.is_leader:
+                self.tick(reason)
+            reason = self._wait()
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+
+    def stats(self, recent: int = 10) -> Dict[str, Any]:
+        next_deadline = self.next_deadline()
+        with self._cond:
+            pending = len(self._heap)
+        return {
+            "shard": self.shard,
+            "shards": self.shards,
+            "leader": self.leader.stats(),
+            "pending_deadlines": pending,
+            "next_deadline": next_deadline.isoformat() if next_deadline else None,
+            "max_idle_seconds": self.max_idle,
+            "metrics": self.metrics.snapshot(recent)
+        }
+
+
+def _shard_capacity() -> bool:
+    """¿Este worker puede tomar otro shard sin pasarse de su parte?"""
+    owned = sum(1 for sched in scheduler_shards if sched.leader.is_leader)
+    return owned < -(-SCHEDULER_SHARDS // SCHEDULER_WORKERS)
+
+
+def _build_shard(shard: int) -> DeadlineScheduler:
+    name = "valve_scheduler" if SCHEDULER_SHARDS == 1 else f"valve_scheduler:{shard}"
+    leader = LeaderElector(name, channels=[SCHEDULER_CHANNEL], can_acquire=_shard_capacity)
+    sched = DeadlineScheduler(leader, shard, SCHEDULER_SHARDS)
+    # Al ganar o perder el liderazgo, el hilo del scheduler reevalúa su rol de inmediato
+    leader.on_elected(sched.wake)
+    leader.on_demoted(sched.wake)
+    # payload: device_iot_id afectado ("" = todos); sólo despierta el shard que lo contiene
+    leader.on_notify(SCHEDULER_CHANNEL, lambda payload: sched.wake() if sched.owns(int(payload) if payload else None) else None)
+    return sched
+
+
+scheduler_shards: List[DeadlineScheduler] = []
+scheduler_shards.extend(_build_shard(shard) for shard in range(SCHEDULER_SHARDS))
+valve_scheduler = scheduler_shards[0]
+
+
+def wake_scheduler(device_id: Optional[int] = None) -> None:
+    """Despierta al scheduler líder del shard del dispositivo, esté en este worker o en otro."""
+    targets = [sched for sched in scheduler_shards if sched.owns(device_id)]
+    if all(sched.leader.is_leader or not sched.leader.is_postgres for sched in targets):
+        for sched in targets:
+            sched.wake()
+        return
+    try:
+        valve_scheduler.leader.notify(SCHEDULER_CHANNEL, "" if device_id is None else str(device_id))
+    except Exception as e:
+        print("[scheduler] No se pudo avisar al líder:", e)
+
+
+def scheduler_status(recent: int = 10) -> Dict[str, Any]:
+    """Estado y métricas de los shards de este worker."""
+    return {
+        "pid": os.getpid(),
+        "shards": SCHEDULER_SHARDS,
+        "workers": SCHEDULER_WORKERS,
+        "owned_shards": [sched.shard for sched in scheduler_shards if sched.leader.is_leader],
+        "commands": command_bus.stats(),
+        "schedulers": [sched.stats(recent) for sched in scheduler_shards]
+    }
+
+
+def scheduler_metrics_text() -> str:
+    """Métricas de los shards de este worker en formato Prometheus."""
+    entries = []
+    for sched in scheduler_shards:
+        with sched._cond:
+            pending = len(sched._heap)
+        next_deadline = sched.next_deadline()
+        gauges = {"is_leader": int(sched.leader.is_leader), "pending_deadlines": pending}
+        if next_deadline is not None:
+            gauges["next_deadline_seconds"] = round((next_deadline - sched.clock()).total_seconds(), 3)
+        entries.append((sched.metrics, gauges))
+    return render_prometheus(entries)
+
+
+def device_status_scheduler() -> None:
+    valve_scheduler.run()
 
-        time.sleep(5)
 
 def start_background_jobs() -> None:
-    threading.Thread(target=device_status_scheduler, daemon=True).start()
+    for sched in scheduler_shards:
+        sched.leader.start()
+        sched.start()
+
+
+def stop_background_jobs() -> None:
+    for sched in scheduler_shards:
+        sched.leader.stop()
+
+
+if __name__ == "__main__":
+    # Proceso dedicado al scheduler: varios en paralelo se reparten los shards
+    start_background_jobs()
+    transition_journal.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        stop_background_jobs()
+        transition_journal.stop()
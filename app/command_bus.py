@@ -0,0 +1,124 @@
+import os
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Deque, Dict, List, Optional
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# =======================================================
+# Bus interno de comandos hacia los dispositivos
+# =======================================================
+#
+# El scheduler, open_valve/close_valve y la detección de fugas publican aquí en lugar
+# de hacer un POST HTTP a su propio endpoint. Los comandos publicados dentro de una
+# transacción se despachan sólo después del commit (y se descartan si hay rollback).
+# El despacho es concurrente entre dispositivos y en orden para cada dispositivo.
+# Las colas que recoge cada ESP32 se suscriben en app.servo_queue.
+# Cada comando lleva un command_id; un reenvío (reintento, reencolado) conserva el suyo.
+
+COMMAND_BUS_WORKERS = int(os.getenv("COMMAND_BUS_WORKERS", "8"))
+
+_PENDING_KEY = "pending_device_commands"
+
+
+class DeviceCommand:
+    __slots__ = ("command_id", "device_id", "action", "source", "created_at", "reissued")
+
+    def __init__(self, device_id: Optional[int], action: str, source: str, command_id: Optional[str] = None):
+        self.command_id = command_id or uuid.uuid4().hex
+        self.device_id = device_id
+        self.action = action
+        self.source = source
+        self.created_at = datetime.now()
+        self.reissued = command_id is not None
+
+    def __repr__(self) -> str:
+        return f"DeviceCommand({self.device_id}, {self.action!r}, {self.source!r}, {self.command_id})"
+
+
+class CommandBus:
+    def __init__(self, workers: int = COMMAND_BUS_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="command-bus")
+        self._handlers: List[Callable[[DeviceCommand], None]] = []
+        self._lanes: Dict[Any, Deque[DeviceCommand]] = {}   # device_id → comandos en espera
+        self._lock = threading.Lock()
+        self.published = 0
+        self.dispatched = 0
+        self.failed = 0
+        self.discarded = 0
+
+    def subscribe(self, handler: Callable[[DeviceCommand], None]) -> None:
+        self._handlers.append(handler)
+
+    def publish(
+        self, device_id: Optional[int], action: str, source: str, command_id: Optional[str] = None
+    ) -> DeviceCommand:
+        """Despachar ya, fuera de cualquier transacción. command_id reenvía un comando ya emitido."""
+        command = DeviceCommand(device_id, action, source, command_id)
+        self.published += 1
+        self._enqueue(command)
+        return command
+
+    def publish_after_commit(self, db: Session, device_id: Optional[int], action: str, source: str) -> DeviceCommand:
+        """Despachar cuando la transacción de `db` confirme; se descarta si hace rollback."""
+        command = DeviceCommand(device_id, action, source)
+        self.published += 1
+        db.connection()  # asegura una transacción abierta para que commit/rollback la cierren
+        db.info.setdefault(_PENDING_KEY, []).append(command)
+        return command
+
+    def _enqueue(self, command: DeviceCommand) -> None:
+        with self._lock:
+            lane = self._lanes.get(command.device_id)
+            if lane is not None:
+                lane.append(command)   # ya hay un despacho en curso para este dispositivo
+                return
+            self._lanes[command.device_id] = deque([command])
+        self._executor.submit(self._drain, command.device_id)
+
+    def _drain(self, device_id: Optional[int]) -> None:
+        """Despacha en orden los comandos de un dispositivo hasta vaciar su cola."""
+        while True:
+            with self._lock:
+                lane = self._lanes[device_id]
+                if not lane:
+                    del self._lanes[device_id]
+                    return
+                command = lane.popleft()
+            for handler in self._handlers:
+                try:
+                    handler(command)
+                    self.dispatched += 1
+                except Exception as e:
+                    self.failed += 1
+                    print(f"[comandos] Error despachando {command}:", e)
+
+    def _after_commit(self, session: Session) -> None:
+        for command in session.info.pop(_PENDING_KEY, ()):
+            self._enqueue(command)
+
+    def _after_rollback(self, session: Session, previous_transaction=None) -> None:
+        self.discarded += len(session.info.pop(_PENDING_KEY, ()))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            queued = sum(len(lane) for lane in self._lanes.values())
+            busy = len(self._lanes)
+        return {
+            "handlers": len(self._handlers),
+            "published": self.published,
+            "dispatched": self.dispatched,
+            "failed": self.failed,
+            "discarded": self.discarded,
+            "devices_in_flight": busy,
+            "queued": queued
+        }
+
+
+command_bus = CommandBus()
+
+event.listen(Session, "after_commit", command_bus._after_commit)
+event.listen(Session, "after_soft_rollback", command_bus._after_rollback)
@@ -0,0 +1,132 @@
+import asyncio
+import os
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+from app.database import engine
+from app.leader_election import LEADER_KEEPALIVE
+
+# =======================================================
+# Conexión LISTEN por worker integrada en el event loop
+# =======================================================
+#
+# Cada worker abre una conexión de PostgreSQL fuera del pool, hace LISTEN del canal y
+# registra su descriptor con loop.add_reader: los NOTIFY se leen en el event loop, sin
+# un hilo ni consultas periódicas. Si la conexión se corta se reintenta cada
+# COMMAND_LISTEN_RETRY segundos; al reconectar se llama on_reconnect, porque los
+# avisos enviados mientras no se escuchaba se perdieron.
+# Sin PostgreSQL no hace nada (un solo proceso, los avisos locales alcanzan).
+
+COMMAND_LISTEN_RETRY = float(os.getenv("COMMAND_LISTEN_RETRY", "5"))   # s
+
+
+class NotifyListener:
+    def __init__(
+        self,
+        channel: str,
+        on_payload: Callable[[str], None],
+        on_reconnect: Optional[Callable[[], None]] = None,
+        retry: float = COMMAND_LISTEN_RETRY
+    ):
+        self.channel = channel
+        self.on_payload = on_payload
+        self.on_reconnect = on_reconnect
+        self.retry = retry
+        self._conn = None
+        self._lost: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.connects = 0
+        self.received = 0
+        self.errors = 0
+        self.listening_since: Optional[datetime] = None
+
+    @property
+    def is_postgres(self) -> bool:
+        return engine.dialect.name == "postgresql"
+
+    @property
+    def listening(self) -> bool:
+        return self.listening_since is not None
+
+    def _connect(self):
+        pooled = engine.raw_connection()
+        pooled.detach()  # fuera del pool: la conexión vive mientras se escucha
+        conn = pooled.driver_connection
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("SET application_name = %s", (f"disriego-listen-{self.channel}",))
+            cur.execute("SET tcp_keepalives_idle = %s", (LEADER_KEEPALIVE,))
+            cur.execute("SET tcp_keepalives_interval = %s", (max(1, LEADER_KEEPALIVE // 2),))
+            cur.execute("SET tcp_keepalives_count = 2")
+            cur.execute(f'LISTEN "{self.channel}"')
+        return conn
+
+    def _on_readable(self) -> None:
+        """Callback del event loop: hay datos en la conexión."""
+        try:
+            self._conn.poll()
+            while self._conn.notifies:
+                note = self._conn.notifies.pop(0)
+                self.received += 1
+                self.on_payload(note.payload)
+        except Exception as e:
+            self.errors += 1
+            print(f"[listen] {self.channel}: conexión perdida:", e)
+            self._lost.set()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        first = True
+        while True:
+            try:
+                self._conn = await loop.run_in_executor(None, self._connect)
+            except Exception as e:
+                self.errors += 1
+                print(f"[listen] {self.channel}: no se pudo conectar:", e)
+                await asyncio.sleep(self.retry)
+                continue
+            self.connects += 1
+            self.listening_since = datetime.now()
+            self._lost = asyncio.Event()
+            loop.add_reader(self._conn.fileno(), self._on_readable)
+            if not first and self.on_reconnect is not None:
+                self.on_reconnect()
+            first = False
+            try:
+                await self._lost.wait()
+            finally:
+                loop.remove_reader(self._conn.fileno())
+                self._close()
+                self.listening_since = None
+            await asyncio.sleep(self.retry)
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    async def start(self) -> None:
+        """Debe llamarse desde el event loop del worker (evento startup)."""
+        if not self.is_postgres or self._task is not None:
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        print(f"[listen] {self.channel}: escuchando (pid {os.getpid()})")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "channel": self.channel,
+            "enabled": self.is_postgres,
+            "listening": self.listening,
+            "listening_since": self.listening_since.isoformat() if self.listening_since else None,
+            "connects": self.connects,
+            "received": self.received,
+            "errors": self.errors
+        }
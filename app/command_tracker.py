@@ -0,0 +1,407 @@
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from sqlalchemy import Boolean, DateTime, Integer, bindparam, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+from app.database import engine
+from app.command_bus import DeviceCommand
+from app.device_twin import device_twin
+from app.devices.models import DeviceCommandLog
+from app.scheduler_metrics import Histogram
+
+# =======================================================
+# Seguimiento de comandos: entrega, confirmación y reintentos
+# =======================================================
+#
+# Cada comando queda en device_command_log con su command_id desde que se encola.
+# Al entregarlo (GET, long-poll, SSE o WebSocket) se anota la entrega; el dispositivo
+# lo confirma con POST /devices/devices/servo-command/{command_id}/ack.
+#
+# Sólo se reintenta lo que el dispositivo dijo que iba a confirmar (acks=true al
+# pedirlo): el firmware antiguo no confirma y sus comandos quedan como entregados.
+# Si la confirmación no llega, el mismo comando se vuelve a encolar tras
+# COMMAND_ACK_TIMEOUT · 2^(entregas-1) segundos (tope COMMAND_RETRY_MAX_DELAY); tras
+# COMMAND_MAX_ATTEMPTS entregas sin respuesta queda "unacked" (válvula que no responde).
+# Una copia reencolada de un comando que entre tanto se confirmó se descarta al sacarla.
+# Un reintento nunca pasa por encima de un comando más nuevo del mismo dispositivo: si
+# existe uno, el viejo queda "superseded" en vez de reencolarse, y una copia ya
+# reencolada se descarta al sacarla (el "open" sin confirmar no reabre la válvula que
+# un "close" posterior cerró).
+#
+# Latencias emisión → entrega, entrega → confirmación y emisión → confirmación en
+# histogramas globales, por dispositivo y por lote. Son del worker que atendió la
+# entrega o la confirmación (los datos salen de la fila, así que cualquier worker
+# puede medir cualquier comando); se suman entre workers como los de Prometheus.
+
+COMMAND_ACK_TIMEOUT     = float(os.getenv("COMMAND_ACK_TIMEOUT", "10"))        # s hasta el primer reintento
+COMMAND_RETRY_MAX_DELAY = float(os.getenv("COMMAND_RETRY_MAX_DELAY", "300"))   # s, tope del backoff
+COMMAND_MAX_ATTEMPTS    = int(os.getenv("COMMAND_MAX_ATTEMPTS", "5"))          # entregas sin confirmar
+COMMAND_RETRY_INTERVAL  = float(os.getenv("COMMAND_RETRY_INTERVAL", "2"))      # s entre barridos
+COMMAND_SLOW_SECONDS    = float(os.getenv("COMMAND_SLOW_SECONDS", "30"))       # p95 de confirmación "lenta"
+COMMAND_RETRY_BATCH     = 500
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)   # s
+STAGES = ("delivery", "ack", "total")   # emisión→entrega, entrega→confirmación, emisión→confirmación
+
+STATUS_QUEUED     = "queued"
+STATUS_DELIVERED  = "delivered"
+STATUS_ACKED      = "acked"
+STATUS_FAILED     = "failed"       # el dispositivo confirmó con error
+STATUS_UNACKED    = "unacked"      # se agotaron los reintentos
+STATUS_SUPERSEDED = "superseded"   # hay un comando más nuevo para el dispositivo
+
+TABLE = DeviceCommandLog.__tablename__
+
+# Hay un comando emitido después para el mismo dispositivo
+_NEWER = f"""EXISTS (
+    SELECT 1 FROM {TABLE} AS newer
+     WHERE newer.device_iot_id = {TABLE}.device_iot_id AND newer.issued_at > {TABLE}.issued_at
+)"""
+
+_REQUEUED_SQL = text(f"""
+    UPDATE {TABLE} SET status = '{STATUS_QUEUED}', next_retry_at = NULL
+     WHERE id = :id AND acked_at IS NULL AND status <> '{STATUS_SUPERSEDED}'
+""")
+
+_DELIVERED_SQL = text(f"""
+    UPDATE {TABLE}
+       SET attempts = attempts + 1,
+           delivered_at = COALESCE(delivered_at, :now),
+           last_delivered_at = :now,
+           status = '{STATUS_DELIVERED}',
+           expects_ack = :expects_ack,
+           next_retry_at = NULL
+     WHERE id = :id AND acked_at IS NULL AND status <> '{STATUS_SUPERSEDED}'
+       AND (attempts = 0 OR NOT {_NEWER})
+    RETURNING device_iot_id, lot_id, attempts, issued_at
+""").bindparams(bindparam("now", type_=DateTime), bindparam("expects_ack", type_=Boolean)).columns(
+    device_iot_id=Integer, lot_id=Integer, attempts=Integer, issued_at=DateTime)
+
+_NEXT_RETRY_SQL = text(f"UPDATE {TABLE} SET next_retry_at = :at WHERE id = :id").bindparams(
+    bindparam("at", type_=DateTime))
+
+_EXISTS_SQL = text(f"SELECT 1 FROM {TABLE} WHERE id = :id")
+
+_SUPERSEDE_SQL = text(f"""
+    UPDATE {TABLE} SET status = '{STATUS_SUPERSEDED}', next_retry_at = NULL
+     WHERE id IN :ids AND acked_at IS NULL AND {_NEWER}
+""").bindparams(bindparam("ids", expanding=True))
+
+_ACK_SQL = text(f"""
+    UPDATE {TABLE}
+       SET acked_at = :now, status = :status, detail = :detail, next_retry_at = NULL
+     WHERE id = :id AND acked_at IS NULL
+""").bindparams(bindparam("now", type_=DateTime))
+
+_DUE_SQL = """
+    SELECT id, device_iot_id, lot_id, action, attempts
+      FROM {table}
+     WHERE status = '{status}' AND next_retry_at <= :now
+     ORDER BY next_retry_at
+     LIMIT :limit
+     {lock}
+"""
+DUE_SQL = text(_DUE_SQL.format(table=TABLE, status=STATUS_DELIVERED, lock="FOR UPDATE SKIP LOCKED")).bindparams(
+    bindparam("now", type_=DateTime))
+DUE_SQL_NO_LOCK = text(_DUE_SQL.format(table=TABLE, status=STATUS_DELIVERED, lock="")).bindparams(
+    bindparam("now", type_=DateTime))
+
+_STILL_DUE_SQL = text(f"SELECT id FROM {TABLE} WHERE id IN :ids AND status = '{STATUS_DELIVERED}'").bindparams(
+    bindparam("ids", expanding=True))
+
+_SET_STATUS_SQL = text(f"UPDATE {TABLE} SET status = :status, next_retry_at = NULL WHERE id IN :ids").bindparams(
+    bindparam("ids", expanding=True))
+
+_UNACKED_SQL = text(f"""
+    SELECT device_iot_id, MAX(lot_id) AS lot_id, COUNT(*) AS commands, MAX(issued_at) AS last_issued_at
+      FROM {TABLE}
+     WHERE status = '{STATUS_UNACKED}' AND issued_at >= :since
+     GROUP BY device_iot_id
+     ORDER BY COUNT(*) DESC
+""").bindparams(bindparam("since", type_=DateTime)).columns(
+    device_iot_id=Integer, lot_id=Integer, commands=Integer, last_issued_at=DateTime)
+
+
+class CommandTracker:
+    def __init__(
+        self,
+        ack_timeout: float = COMMAND_ACK_TIMEOUT,
+        max_delay: float = COMMAND_RETRY_MAX_DELAY,
+        max_attempts: int = COMMAND_MAX_ATTEMPTS,
+        retry_interval: float = COMMAND_RETRY_INTERVAL
+    ):
+        self.ack_timeout = ack_timeout
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.retry_interval = retry_interval
+        self._histograms: Dict[Tuple[str, int], Dict[str, Histogram]] = {}
+        self._lock = threading.Lock()
+        self._retry: Optional[Callable[[], int]] = None
+        self._stop = threading.Event()
+        self._thread = None
+        self.issued = 0
+        self.delivered = 0
+        self.redelivered = 0
+        self.acked = 0
+        self.failed = 0
+        self.duplicate_acks = 0
+        self.skipped = 0
+        self.retried = 0
+        self.unacked = 0
+        self.superseded = 0
+        self.errors = 0
+
+    def backoff(self, attempts: int) -> float:
+        """Segundos de espera de la confirmación tras la entrega número `attempts`."""
+        return min(self.max_delay, self.ack_timeout * 2 ** max(0, attempts - 1))
+
+    # ── Emisión y entrega (dentro de la transacción de la cola) ──
+    def record(self, conn: Connection, command: DeviceCommand, device_id: int) -> None:
+        """Anota un comando encolado: nuevo, o reenviado con su mismo command_id."""
+        if command.reissued:
+            conn.execute(_REQUEUED_SQL, {"id": command.command_id})
+            return
+        state = device_twin.peek(device_id)
+        conn.execute(DeviceCommandLog.__table__.insert(), {
+            "id": command.command_id, "device_iot_id": device_id,
+            "lot_id": state.lot_id if state is not None else None,
+            "action": command.action, "source": command.source, "status": STATUS_QUEUED,
+            "attempts": 0, "expects_ack": False, "issued_at": command.created_at
+        })
+        self.issued += 1
+
+    def mark_delivered(self, conn: Connection, command_id: Optional[str], expects_ack: bool, now: datetime) -> bool:
+        """
+        Anota la entrega de un comando recién sacado de la cola. Devuelve False si no hay
+        que entregarlo: ya estaba confirmado o es la copia de un reintento con un comando
+        más nuevo para el mismo dispositivo.
+        """
+        if command_id is None:
+            return True   # encolado antes del seguimiento
+        row = conn.execute(_DELIVERED_SQL, {"id": command_id, "now": now, "expects_ack": expects_ack}).first()
+        if row is None:
+            if conn.execute(_EXISTS_SQL, {"id": command_id}).first() is None:
+                return True
+            self.superseded += conn.execute(_SUPERSEDE_SQL, {"ids": [command_id]}).rowcount
+            self.skipped += 1
+            return False
+        if expects_ack:
+            conn.execute(_NEXT_RETRY_SQL, {"id": command_id, "at": now + timedelta(seconds=self.backoff(row.attempts))})
+        self.delivered += 1
+        if row.attempts == 1:
+            self._observe(row.device_iot_id, row.lot_id, "delivery", (now - row.issued_at).total_seconds())
+        else:
+            self.redelivered += 1
+        return True
+
+    # ── Confirmación del dispositivo ────────────────────────
+    def ack(
+        self, db: Session, command_id: str, device_id: Optional[int], ok: bool, detail: Optional[str]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Confirma un comando. None si no existe; ValueError si es de otro dispositivo.
+        Una confirmación repetida no cambia nada y vuelve con duplicate=True.
+        """
+        entry = db.get(DeviceCommandLog, command_id)
+        if entry is None:
+            return None
+        if device_id is not None and entry.device_iot_id != device_id:
+            raise ValueError(f"El comando {command_id} no es del dispositivo {device_id}")
+        if entry.acked_at is not None:
+            self.duplicate_acks += 1
+            return {**self.to_dict(entry), "duplicate": True}
+        now = datetime.now()
+        status = STATUS_ACKED if ok else STATUS_FAILED
+        if db.execute(_ACK_SQL, {"id": command_id, "now": now, "status": status,
+                                 "detail": (detail or None) and detail[:200]}).rowcount == 0:
+            db.rollback()   # otra confirmación ganó la carrera
+            self.duplicate_acks += 1
+            db.refresh(entry)
+            return {**self.to_dict(entry), "duplicate": True}
+        db.commit()
+        db.refresh(entry)
+        if ok:
+            self.acked += 1
+        else:
+            self.failed += 1
+        if entry.last_delivered_at is not None:
+            self._observe(entry.device_iot_id, entry.lot_id, "ack", (now - entry.last_delivered_at).total_seconds())
+        self._observe(entry.device_iot_id, entry.lot_id, "total", (now - entry.issued_at).total_seconds())
+        return {**self.to_dict(entry), "duplicate": False}
+
+    def get(self, db: Session, command_id: str) -> Optional[Dict[str, Any]]:
+        entry = db.get(DeviceCommandLog, command_id)
+        return self.to_dict(entry) if entry is not None else None
+
+    @staticmethod
+    def to_dict(entry: DeviceCommandLog) -> Dict[str, Any]:
+        def iso(value: Optional[datetime]) -> Optional[str]:
+            return value.isoformat() if value is not None else None
+        return {
+            "command_id": entry.id,
+            "device_id": entry.device_iot_id,
+            "lot_id": entry.lot_id,
+            "action": entry.action,
+            "source": entry.source,
+            "status": entry.status,
+            "attempts": entry.attempts,
+            "expects_ack": entry.expects_ack,
+            "issued_at": iso(entry.issued_at),
+            "delivered_at": iso(entry.delivered_at),
+            "last_delivered_at": iso(entry.last_delivered_at),
+            "acked_at": iso(entry.acked_at),
+            "next_retry_at": iso(entry.next_retry_at),
+            "detail": entry.detail
+        }
+
+    # ── Reintentos ──────────────────────────────────────────
+    def due_retries(self, conn: Connection, now: datetime) -> List[Any]:
+        """
+        Comandos entregados cuya confirmación venció. Los que tienen un comando más nuevo
+        del mismo dispositivo pasan a superseded y los que agotaron las entregas a unacked;
+        el resto pasa a queued y se devuelve para volver a encolarlo en `conn`.
+        """
+        sql = DUE_SQL if conn.dialect.name == "postgresql" else DUE_SQL_NO_LOCK
+        rows = conn.execute(sql, {"now": now, "limit": COMMAND_RETRY_BATCH}).all()
+        if not rows:
+            return []
+        superseded = conn.execute(_SUPERSEDE_SQL, {"ids": [r.id for r in rows]}).rowcount
+        if superseded:
+            self.superseded += superseded
+            live = {r.id for r in conn.execute(_STILL_DUE_SQL, {"ids": [r.id for r in rows]})}
+            rows = [r for r in rows if r.id in live]
+        exhausted = [r for r in rows if r.attempts >= self.max_attempts]
+        retry = [r for r in rows if r.attempts < self.max_attempts]
+        if exhausted:
+            conn.execute(_SET_STATUS_SQL, {"status": STATUS_UNACKED, "ids": [r.id for r in exhausted]})
+            self.unacked += len(exhausted)
+            for r in exhausted:
+                print(f"[comandos] Device {r.device_iot_id}: '{r.action}' sin confirmar tras {r.attempts} entregas ({r.id})")
+        if retry:
+            conn.execute(_SET_STATUS_SQL, {"status": STATUS_QUEUED, "ids": [r.id for r in retry]})
+            self.retried += len(retry)
+        return retry
+
+    def on_retry(self, sweep: Callable[[], int]) -> None:
+        """Registra quién vuelve a encolar los comandos vencidos (app.servo_queue)."""
+        self._retry = sweep
+
+    def _sweep_once(self) -> None:
+        try:
+            self._retry()
+        except Exception as e:
+            self.errors += 1
+            print("[comandos] Error en el barrido de reintentos:", e)
+
+    def run(self) -> None:
+        print("[comandos] hilo de reintentos iniciado")
+        while not self._stop.wait(self.retry_interval):
+            self._sweep_once()
+
+    def start(self) -> None:
+        if self._thread is None and self._retry is not None:
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+
+    def unacked_devices(self, db: Session, hours: float) -> List[Dict[str, Any]]:
+        """Dispositivos con comandos que agotaron los reintentos en las últimas `hours` horas."""
+        since = datetime.now() - timedelta(hours=hours)
+        return [
+            {"device_id": r.device_iot_id, "lot_id": r.lot_id, "unacked_commands": r.commands,
+             "last_issued_at": r.last_issued_at.isoformat()}
+            for r in db.execute(_UNACKED_SQL, {"since": since})
+        ]
+
+    # ── Histogramas de latencia ─────────────────────────────
+    def _observe(self, device_id: int, lot_id: Optional[int], stage: str, seconds: float) -> None:
+        keys = [("all", 0), ("device", device_id)]
+        if lot_id is not None:
+            keys.append(("lot", lot_id))
+        with self._lock:
+            for key in keys:
+                stages = self._histograms.get(key)
+                if stages is None:
+                    stages = self._histograms[key] = {s: Histogram(LATENCY_BUCKETS) for s in STAGES}
+                stages[stage].observe(max(0.0, seconds))
+
+    def latency(self, device_id: Optional[int] = None, lot_id: Optional[int] = None) -> Dict[str, Any]:
+        """Histogramas de un dispositivo, de un lote o, sin filtros, el resumen de todos."""
+        with self._lock:
+            if device_id is not None or lot_id is not None:
+                key = ("device", device_id) if device_id is not None else ("lot", lot_id)
+                stages = self._histograms.get(key)
+                return {
+                    key[0] + "_id": key[1],
+                    "stages": {s: _summary(h, buckets=True) for s, h in stages.items()} if stages else None
+                }
+            overall = self._histograms.get(("all", 0))
+            by_scope: Dict[str, Dict[str, Any]] = {"device": {}, "lot": {}}
+            slow = []
+            for (scope, scope_id), stages in self._histograms.items():
+                if scope == "all":
+                    continue
+                by_scope[scope][str(scope_id)] = {s: _summary(h) for s, h in stages.items()}
+                p95 = _quantile(stages["ack"], 0.95)
+                if scope == "device" and stages["ack"].count and (p95 is None or p95 > COMMAND_SLOW_SECONDS):
+                    slow.append({"device_id": scope_id, "ack_p95_s": p95, "acks": stages["ack"].count})
+            return {
+                "stages": {s: _summary(h, buckets=True) for s, h in overall.items()} if overall else None,
+                "devices": by_scope["device"],
+                "lots": by_scope["lot"],
+                "slow_devices": slow,
+                "slow_threshold_s": COMMAND_SLOW_SECONDS
+            }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "issued": self.issued,
+            "delivered": self.delivered,
+            "redelivered": self.redelivered,
+            "acked": self.acked,
+            "failed": self.failed,
+            "duplicate_acks": self.duplicate_acks,
+            "skipped_already_acked": self.skipped,
+            "retried": self.retried,
+            "unacked": self.unacked,
+            "superseded": self.superseded,
+            "errors": self.errors,
+            "ack_timeout_s": self.ack_timeout,
+            "retry_max_delay_s": self.max_delay,
+            "max_attempts": self.max_attempts
+        }
+
+
+def _quantile(hist: Histogram, q: float) -> Optional[float]:
+    """Límite superior del bucket que contiene el cuantil q (None si cae en +Inf)."""
+    if not hist.count:
+        return None
+    target, running = q * hist.count, 0
+    for bound, n in zip(hist.bounds, hist.counts):
+        running += n
+        if running >= target:
+            return bound
+    return None
+
+
+def _summary(hist: Histogram, buckets: bool = False) -> Dict[str, Any]:
+    out = {
+        "count": hist.count,
+        "mean_s": round(hist.total / hist.count, 3) if hist.count else None,
+        "p50_s": _quantile(hist, 0.50),
+        "p95_s": _quantile(hist, 0.95),
+        "p99_s": _quantile(hist, 0.99)
+    }
+    if buckets:
+        out["buckets"] = dict(hist.cumulative())
+    return out
+
+
+command_tracker = CommandTracker()
@@ -0,0 +1,260 @@
+import asyncio
+import os
+import anyio
+from datetime import datetime
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+from fastapi import WebSocket, WebSocketDisconnect
+from pydantic import ValidationError
+from starlette.concurrency import run_in_threadpool
+from app.database import SessionLocal
+from app.command_bus import command_bus
+from app.command_tracker import command_tracker
+from app.servo_queue import servo_queues
+from app.devices.dedup import reading_dedup
+from app.devices.ingest_queue import reading_queue
+from app.devices.schemas import DeviceIotReadingUpdateByLot
+from app.devices.services import DeviceService, MAX_BATCH_READINGS
+
+# =======================================================
+# Canal WebSocket por dispositivo (/devices/ws/{device_id})
+# =======================================================
+#
+# Una conexión persistente por dispositivo lleva lecturas hacia arriba y comandos
+# hacia abajo, sin el handshake ni las cabeceras HTTP de cada mensaje.
+#
+# Subida: cada mensaje es una lectura con la forma de DeviceIotReadingUpdateByLot o
+# {"readings": [...]}; device_id lo fija la ruta. Se aplican con la misma ruta de ingesta
+# que el POST en bloque (o van a la cola write-behind si está activa) y se responde
+# {"type": "ack", "results": [...]} en el mismo orden.
+# Bajada: los comandos de servo_queues del dispositivo se envían como
+# {"type": "command", "action": ..., "command_id": ...} en cuanto llegan. Si se conecta
+# con ?acks=true, el dispositivo confirma cada uno con
+# {"type": "command_ack", "command_id": ..., "result": "ok" | "error"} y recibe
+# {"type": "command_ack", "command_id": ..., "success": ...}.
+#
+# Cada conexión tiene una cola de salida acotada (WS_SEND_QUEUE_MAX) que vacía una
+# sola tarea. Si el dispositivo no lee, la cola se llena y se deja de leer lo que envía
+# (y de sacar comandos de su cola), de modo que la presión vuelve por TCP en vez de
+# acumular memoria. Los comandos que quedaron sin enviar al cerrarse se vuelven a encolar
+# en el orden en que se emitieron: el que falló al enviarse (vuelve a la cabeza), los de
+# la cola de salida y el que esperaba lugar en ella.
+
+WS_SEND_QUEUE_MAX = int(os.getenv("WS_SEND_QUEUE_MAX", "64"))
+WS_COMMAND_WAIT   = float(os.getenv("WS_COMMAND_WAIT", "25"))   # s por espera de comandos
+
+CLOSE_REPLACED = 4001   # otra conexión del mismo dispositivo tomó el canal
+
+
+class DeviceConnection:
+    __slots__ = ("device_id", "acks", "websocket", "outbox", "unsent", "in_flight", "task",
+                 "connected_at", "received", "sent")
+
+    def __init__(self, device_id: int, acks: bool, websocket: WebSocket, send_queue_max: int):
+        self.device_id = device_id
+        self.acks = acks
+        self.websocket = websocket
+        self.outbox: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue(maxsize=send_queue_max)
+        self.unsent: "Deque[Dict[str, Any]]" = deque()      # sacados de outbox sin enviar: van primero
+        self.in_flight: Optional[Dict[str, Any]] = None     # comando esperando lugar en outbox
+        self.task = asyncio.current_task()
+        self.connected_at = datetime.now()
+        self.received = 0
+        self.sent = 0
+
+
+class DeviceChannels:
+    """Registro device_id → conexión abierta (una por dispositivo)."""
+
+    def __init__(self, send_queue_max: int = WS_SEND_QUEUE_MAX):
+        self.send_queue_max = send_queue_max
+        self._connections: Dict[int, DeviceConnection] = {}
+        self.opened = 0
+        self.replaced = 0
+        self.readings = 0
+        self.commands = 0
+        self.requeued = 0
+        self.command_acks = 0
+        self.errors = 0
+
+    async def serve(self, websocket: WebSocket, device_id: int, acks: bool = False) -> None:
+        await websocket.accept()
+        conn = DeviceConnection(device_id, acks, websocket, self.send_queue_max)
+        previous = self._connections.get(device_id)
+        self._connections[device_id] = conn
+        self.opened += 1
+        if previous is not None:
+            # La conexión anterior deja de leer y de sacar comandos de la cola del dispositivo
+            self.replaced += 1
+            previous.task.get_loop().call_soon_threadsafe(previous.task.cancel)
+
+        tasks = [asyncio.create_task(loop(conn)) for loop in (self._receive_loop, self._send_loop, self._command_loop)]
+        try:
+            # Termina cuando cualquiera de los tres sentidos termina (desconexión o error)
+            try:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            except asyncio.CancelledError:
+                if self._connections.get(device_id) is conn:
+                    raise
+                conn.task.uncancel()   # reemplazada por otra conexión: cierre normal
+                done = ()
+            for task in done:
+                error = None if task.cancelled() else task.exception()
+                if error is not None and not isinstance(error, WebSocketDisconnect):
+                    self.errors += 1
+                    print(f"[ws] Device {device_id}: conexión cerrada por error:", error)
+        finally:
+            for task in tasks:
+                task.cancel()
+            replaced = self._connections.get(device_id) is not conn
+            if not replaced:
+                del self._connections[device_id]
+            with anyio.CancelScope(shield=True):
+                await asyncio.gather(*tasks, return_exceptions=True)
+                self._requeue(conn)
+                if replaced:
+                    try:
+                        await websocket.close(code=CLOSE_REPLACED)
+                    except Exception:
+                        pass
+
+    # ── Subida: lecturas ────────────────────────────────────
+    async def _receive_loop(self, conn: DeviceConnection) -> None:
+        while True:
+            message = await conn.websocket.receive_json()
+            conn.received += 1
+            if isinstance(message, dict) and message.get("type") == "command_ack":
+                reply = await self._command_ack(conn.device_id, message)
+            else:
+                reply = await self._ingest(conn.device_id, message)
+            await conn.outbox.put(reply)   # espera si el dispositivo no está leyendo
+
+    async def _ingest(self, device_id: int, message: Any) -> Dict[str, Any]:
+        payloads = message.get("readings") if isinstance(message, dict) and "readings" in message else [message]
+        if not isinstance(payloads, list) or not all(isinstance(p, dict) for p in payloads):
+            return {"type": "error", "message": "Se espera una lectura o {\"readings\": [...]}"}
+        if len(payloads) > MAX_BATCH_READINGS:
+            return {"type": "error", "message": f"El lote supera el máximo de {MAX_BATCH_READINGS} lecturas"}
+        try:
+            readings = [DeviceIotReadingUpdateByLot(**{**p, "device_id": device_id}) for p in payloads]
+        except ValidationError as e:
+            return {"type": "error", "message": "Lectura inválida", "detail": e.errors(include_url=False, include_context=False)}
+        self.readings += len(readings)
+        if reading_queue.enabled:
+            results = [self._enqueue(index, r) for index, r in enumerate(readings)]
+        else:
+            try:
+                results = await run_in_threadpool(_apply_readings, readings)
+            except Exception as e:
+                self.errors += 1
+                return {"type": "error", "message": f"Error al aplicar las lecturas: {e}"}
+        for result, reading in zip(results, readings):
+            if reading.seq is not None:
+                result["seq"] = reading.seq
+        return {"type": "ack", "results": results}
+
+    async def _command_ack(self, device_id: int, message: Dict[str, Any]) -> Dict[str, Any]:
+        command_id = message.get("command_id")
+        result = message.get("result", "ok")
+        if not isinstance(command_id, str) or result not in ("ok", "error"):
+            return {"type": "error", "message": "Se espera {\"type\": \"command_ack\", \"command_id\": ..., \"result\": \"ok\" | \"error\"}"}
+        try:
+            entry = await run_in_threadpool(_ack_command, command_id, device_id, result == "ok", message.get("detail"))
+        except ValueError as e:
+            return {"type": "command_ack", "command_id": command_id, "success": False, "message": str(e)}
+        except Exception as e:
+            self.errors += 1
+            return {"type": "error", "message": f"Error al confirmar el comando: {e}"}
+        if entry is None:
+            return {"type": "command_ack", "command_id": command_id, "success": False, "message": "Comando no encontrado"}
+        self.command_acks += 1
+        return {"type": "command_ack", "command_id": command_id, "success": True, "duplicate": entry["duplicate"]}
+
+    @staticmethod
+    def _enqueue(index: int, reading: DeviceIotReadingUpdateByLot) -> Dict[str, Any]:
+        """Modo write-behind, como el POST de una lectura."""
+        dedup_key = reading_dedup.key_for(reading.seq, reading.idempotency_key, reading.boot)
+        if dedup_key and reading_dedup.lookup(reading.device_id, dedup_key, reading.seq) is not None:
+            return {"index": index, "success": True, "status": 200, "duplicate": True}
+        if not reading_queue.put(reading):
+            return {"index": index, "success": False, "status": 503,
+                    "message": "Cola de ingesta llena, reintente más tarde"}
+        return {"index": index, "success": True, "status": 202, "queued": True}
+
+    # ── Bajada: comandos y respuestas ───────────────────────
+    async def _command_loop(self, conn: DeviceConnection) -> None:
+        while True:
+            command = await servo_queues.wait_take(conn.device_id, WS_COMMAND_WAIT, conn.acks)
+            if command is None:
+                continue
+            conn.in_flight = {"type": "command", **command.to_dict()}
+            await conn.outbox.put(conn.in_flight)   # si se cancela aquí, _requeue lo reencola
+            conn.in_flight = None
+            self.commands += 1
+
+    async def _send_loop(self, conn: DeviceConnection) -> None:
+        while True:
+            message = conn.unsent.popleft() if conn.unsent else await conn.outbox.get()
+            try:
+                await conn.websocket.send_json(message, mode="text")
+            except BaseException:
+                conn.unsent.appendleft(message)   # vuelve a la cabeza, antes que los más nuevos
+                raise
+            conn.sent += 1
+
+    def _requeue(self, conn: DeviceConnection) -> None:
+        """Vuelve a encolar, en el orden de emisión, los comandos que no llegaron a enviarse."""
+        pending = list(conn.unsent)
+        conn.unsent.clear()
+        while not conn.outbox.empty():
+            pending.append(conn.outbox.get_nowait())
+        if conn.in_flight is not None:
+            pending.append(conn.in_flight)
+            conn.in_flight = None
+        self._publish_again(conn.device_id, [m for m in pending if m.get("type") == "command"])
+
+    def _publish_again(self, device_id: int, messages: List[Dict[str, Any]]) -> None:
+        for message in messages:
+            command_bus.publish(device_id, message["action"], source="ws-requeue",
+                                command_id=message["command_id"] or None)
+            self.requeued += 1
+
+    def stats(self) -> Dict[str, Any]:
+        connections = list(self._connections.values())
+        return {
+            "connections": len(connections),
+            "opened": self.opened,
+            "replaced": self.replaced,
+            "readings": self.readings,
+            "commands": self.commands,
+            "commands_requeued": self.requeued,
+            "command_acks": self.command_acks,
+            "errors": self.errors,
+            "outbox_queued": sum(c.outbox.qsize() for c in connections),
+            "send_queue_max": self.send_queue_max
+        }
+
+
+def _apply_readings(readings: List[DeviceIotReadingUpdateByLot]) -> List[Dict[str, Any]]:
+    db = SessionLocal()
+    try:
+        return DeviceService(db).apply_readings_batch(readings)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _ack_command(command_id: str, device_id: int, ok: bool, detail: Any) -> Any:
+    db = SessionLocal()
+    try:
+        return command_tracker.ack(db, command_id, device_id, ok, detail if isinstance(detail, str) else None)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+device_channels = DeviceChannels()
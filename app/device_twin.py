@@ -0,0 +1,314 @@
+import os
+import threading
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+from sqlalchemy import and_, event, select, update
+from sqlalchemy.orm import Session
+from app.database import SessionLocal
+from app.devices.models import DeviceIot
+from app.devices_request.models import DeviceIoT
+from app.transition_journal import transition_journal
+
+# =======================================================
+# Gemelo en memoria de device_iot
+# =======================================================
+#
+# Un registro compacto por dispositivo con las columnas de device_iot. Las lecturas
+# calientes (ingesta, apertura/cierre, medidor actual, fugas) se sirven desde aquí.
+# Toda escritura se anota en la sesión que la hace y se aplica al gemelo después del
+# commit (write-through): los cambios por ORM se detectan en after_flush y las
+# sentencias directas se anotan con stage(). Cada registro lleva la versión (número de
+# secuencia del gemelo) de su último cambio; una escritura basada en una versión más
+# vieja que la del registro es obsoleta y el registro se descarta para releerlo.
+# Cada TWIN_RECONCILE_INTERVAL segundos se compara todo con la base (cambios de otros
+# workers o hechos fuera de la API).
+#
+# El gemelo de un worker puede ir hasta ese intervalo por detrás de otro worker, así que
+# las decisiones de seguridad (fugas, cierre por volumen) leen el estado de la base con
+# load_many y cambian el estado con change_device_status(strict=True).
+
+TWIN_RECONCILE_INTERVAL = float(os.getenv("TWIN_RECONCILE_INTERVAL", "60"))   # s
+
+COLUMNS = tuple(c.name for c in DeviceIot.__table__.columns)
+DEVICE_CLASSES = (DeviceIot, DeviceIoT)   # device_iot está mapeada en los dos módulos
+
+_PENDING_KEY = "pending_twin_writes"
+_SEEN_KEY = "twin_seen_versions"
+
+
+class DeviceState:
+    __slots__ = COLUMNS + ("version",)
+
+    def __init__(self, version: int, **values: Any):
+        for column in COLUMNS:
+            setattr(self, column, values.get(column))
+        self.version = version
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {column: getattr(self, column) for column in COLUMNS}
+
+
+class DeviceTwin:
+    def __init__(self, reconcile_interval: float = TWIN_RECONCILE_INTERVAL):
+        self.reconcile_interval = reconcile_interval
+        self._records: Dict[int, DeviceState] = {}
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.stale_writes = 0
+        self.reconciles = 0
+        self.drift_fixed = 0
+
+    @property
+    def seq(self) -> int:
+        """Versión actual del gemelo: una lectura hecha ahora ve todo lo aplicado hasta aquí."""
+        return self._seq
+
+    def _next(self) -> int:
+        self._seq += 1
+        return self._seq
+
+    # ── Lecturas ────────────────────────────────────────────
+    def peek(self, device_id: int) -> Optional[DeviceState]:
+        """Registro en memoria sin consultar la base."""
+        return self._records.get(device_id)
+
+    def get(self, db: Session, device_id: int) -> Optional[DeviceState]:
+        """Estado del dispositivo; si no está en memoria lo carga. None si no existe."""
+        record = self._records.get(device_id)
+        if record is not None:
+            self.hits += 1
+            return record
+        return self.get_many(db, [device_id]).get(device_id)
+
+    def get_many(self, db: Session, device_ids: Iterable[int]) -> Dict[int, DeviceState]:
+        """Estados de varios dispositivos; los que faltan se cargan con una sola consulta."""
+        out: Dict[int, DeviceState] = {}
+        missing = []
+        for device_id in set(device_ids):
+            record = self._records.get(device_id)
+            if record is not None:
+                out[device_id] = record
+            else:
+                missing.append(device_id)
+        self.hits += len(out)
+        if not missing:
+            return out
+        self.misses += len(missing)
+        seen = self._seq
+        table = DeviceIot.__table__
+        rows = db.execute(select(table).where(table.c.id.in_(missing))).mappings().all()
+        with self._lock:
+            for row in rows:
+                record = self._records.get(row["id"])
+                # Si alguien escribió mientras se leía, vale lo escrito
+                if record is None or record.version <= seen:
+                    record = self._records[row["id"]] = DeviceState(seen, **row)
+                out[row["id"]] = record
+        return out
+
+    def load_many(self, db: Session, device_ids: Iterable[int], for_update: bool = False) -> Dict[int, DeviceState]:
+        """
+        Estados leídos de la base en la transacción de `db`, aunque estén en memoria;
+        de paso refrescan el gemelo. Para decisiones que no pueden usar un estado viejo.
+        for_update bloquea las filas hasta el commit (en orden de id, sin interbloqueos).
+        """
+        ids = set(device_ids)
+        if not ids:
+            return {}
+        seen = self._seq
+        table = DeviceIot.__table__
+        query = select(table).where(table.c.id.in_(ids)).order_by(table.c.id)
+        if for_update:
+            query = query.with_for_update()
+        rows = db.execute(query).mappings().all()
+        out: Dict[int, DeviceState] = {}
+        with self._lock:
+            for row in rows:
+                out[row["id"]] = state = DeviceState(seen, **row)
+                record = self._records.get(row["id"])
+                if record is None or record.version <= seen:
+                    self._records[row["id"]] = state
+        self.misses += len(ids)
+        return out
+
+    # ── Escrituras (write-through al confirmar) ─────────────
+    def stage(self, db: Session, device_id: int, values: Dict[str, Any], seen: int) -> None:
+        """Anotar un cambio hecho con una sentencia directa; se aplica si la transacción confirma."""
+        db.info.setdefault(_PENDING_KEY, []).append((device_id, values, seen))
+
+    def apply(self, device_id: int, values: Optional[Dict[str, Any]], seen: int) -> bool:
+        """
+        Aplica un cambio ya confirmado (values None = dispositivo eliminado).
+        Devuelve False si el registro cambió después de la lectura en que se basó el cambio.
+        """
+        with self._lock:
+            record = self._records.get(device_id)
+            if values is None:
+                self._records.pop(device_id, None)
+                return True
+            if record is None:
+                if set(COLUMNS) <= set(values):
+                    self._records[device_id] = DeviceState(self._next(), **values)
+                return True
+            if record.version > seen:
+                # Otro cambio llegó primero y no se sabe cuál es el último: releer de la base
+                del self._records[device_id]
+                self.stale_writes += 1
+                return False
+            for column, value in values.items():
+                if column in COLUMNS:
+                    setattr(record, column, value)
+            record.version = self._next()
+            self.writes += 1
+            return True
+
+    def invalidate(self, device_id: int) -> None:
+        with self._lock:
+            self._records.pop(device_id, None)
+
+    # ── Hooks de la sesión ──────────────────────────────────
+    def _on_load(self, target, context, *args) -> None:
+        context.session.info.setdefault(_SEEN_KEY, {}).setdefault(target.id, self._seq)
+
+    def _after_flush(self, session: Session, flush_context) -> None:
+        seen_by_id = session.info.get(_SEEN_KEY, {})
+        pending = session.info.setdefault(_PENDING_KEY, [])
+        for obj in session.new:
+            if isinstance(obj, DEVICE_CLASSES):
+                pending.append((obj.id, {c: obj.__dict__.get(c) for c in COLUMNS}, self._seq))
+        for obj in session.dirty:
+            if isinstance(obj, DEVICE_CLASSES) and session.is_modified(obj, include_collections=False):
+                values = {c: obj.__dict__[c] for c in COLUMNS if c in obj.__dict__}
+                pending.append((obj.id, values, seen_by_id.get(obj.id, self._seq)))
+        for obj in session.deleted:
+            if isinstance(obj, DEVICE_CLASSES):
+                pending.append((obj.id, None, self._seq))
+
+    def _after_commit(self, session: Session) -> None:
+        session.info.pop(_SEEN_KEY, None)
+        for device_id, values, seen in session.info.pop(_PENDING_KEY, ()):
+            self.apply(device_id, values, seen)
+
+    def _after_rollback(self, session: Session, previous_transaction=None) -> None:
+        session.info.pop(_SEEN_KEY, None)
+        session.info.pop(_PENDING_KEY, None)
+
+    # ── Reconciliación periódica ────────────────────────────
+    def reconcile(self, db: Session) -> int:
+        """Corrige los registros que difieren de la base. Devuelve cuántos corrigió."""
+        seen = self._seq
+        rows = db.execute(select(DeviceIot.__table__)).mappings().all()
+        fixed = 0
+        with self._lock:
+            present = set()
+            for row in rows:
+                present.add(row["id"])
+                record = self._records.get(row["id"])
+                if record is None:
+                    self._records[row["id"]] = DeviceState(seen, **row)
+                    continue
+                if record.version > seen:
+                    continue   # cambió durante la lectura: la fila leída puede ser más vieja
+                if any(getattr(record, c) != row[c] for c in COLUMNS):
+                    for c in COLUMNS:
+                        setattr(record, c, row[c])
+                    record.version = self._next()
+                    fixed += 1
+            for device_id in [d for d, r in self._records.items() if d not in present and r.version <= seen]:
+                del self._records[device_id]
+                fixed += 1
+        self.reconciles += 1
+        self.drift_fixed += fixed
+        return fixed
+
+    def _reconcile_once(self) -> None:
+        db = SessionLocal()
+        try:
+            fixed = self.reconcile(db)
+            if fixed:
+                print(f"[gemelo] {fixed} dispositivos corregidos desde la base")
+        except Exception as e:
+            print("[gemelo] Error en la reconciliación:", e)
+        finally:
+            db.close()
+
+    def run(self) -> None:
+        print("[gemelo] hilo de reconciliación iniciado")
+        self._reconcile_once()
+        while not self._stop.wait(self.reconcile_interval):
+            self._reconcile_once()
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "devices": len(self._records),
+            "version": self._seq,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "stale_writes": self.stale_writes,
+            "reconciles": self.reconciles,
+            "drift_fixed": self.drift_fixed,
+            "reconcile_interval": self.reconcile_interval
+        }
+
+
+device_twin = DeviceTwin()
+
+for _cls in DEVICE_CLASSES:
+    event.listen(_cls, "load", device_twin._on_load)
+    event.listen(_cls, "refresh", device_twin._on_load)
+event.listen(Session, "after_flush", device_twin._after_flush)
+event.listen(Session, "after_commit", device_twin._after_commit)
+event.listen(Session, "after_soft_rollback", device_twin._after_rollback)
+
+
+def change_device_status(
+    db: Session,
+    state: DeviceState,
+    status: int,
+    source: str,
+    request_id: Optional[int] = None,
+    ts: Optional[datetime] = None,
+    strict: bool = False
+) -> bool:
+    """
+    Cambia el estado con un UPDATE condicionado al estado que muestra `state` y lo anota
+    en el journal. Si la base ya no coincide (el gemelo estaba desactualizado) relee la
+    fila y reintenta una vez; con strict no reintenta: la decisión se tomó con un estado
+    que ya no vale. Devuelve False si no cambió el estado (o el dispositivo ya no existe).
+    """
+    table = DeviceIot.__table__
+    for _ in range(1 if strict else 2):
+        if state.status == status:
+            return True
+        seen = state.version
+        expected = table.c.status.is_(None) if state.status is None else table.c.status == state.status
+        result = db.execute(update(table).where(and_(table.c.id == state.id, expected)).values(status=status))
+        if result.rowcount == 1:
+            transition_journal.record_after_commit(
+                db, state.id, state.lot_id, state.status, status, source, request_id, ts
+            )
+            device_twin.stage(db, state.id, {"status": status}, seen)
+            return True
+        device_twin.invalidate(state.id)
+        device_twin.stale_writes += 1
+        state = device_twin.get(db, state.id)
+        if state is None:
+            return False
+    return False
@@ -0,0 +1,89 @@
+import math
+import struct
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+# =======================================================
+# Formato binario compacto de lecturas para dispositivos con enlace limitado
+# =======================================================
+#
+# Registro little-endian:
+#   cabecera  <B I I H I   versión, device_id, lot_id, device_type_id, ts (epoch s, 0 = ahora)
+#   valores   <f * N       un float32 por campo del layout de la versión; NaN = campo ausente
+#
+# El layout de cada versión sale de Device.properties["packed_layout"] del tipo de
+# dispositivo, por ejemplo {"1": ["sensor_value", "final_volume"]}. Si la plantilla no
+# define layouts se usa DEFAULT_LAYOUTS.
+
+PACKED_CONTENT_TYPE = "application/vnd.disriego.reading"
+
+HEADER = struct.Struct("<BIIHI")
+DEFAULT_LAYOUTS: Dict[int, List[str]] = {1: ["sensor_value", "final_volume"]}
+
+_value_structs: Dict[int, struct.Struct] = {}
+
+
+def _values_struct(count: int) -> struct.Struct:
+    compiled = _value_structs.get(count)
+    if compiled is None:
+        compiled = _value_structs[count] = struct.Struct(f"<{count}f")
+    return compiled
+
+
+def layout_from_properties(properties: Optional[Dict[str, Any]], version: int) -> Optional[List[str]]:
+    """Campos del layout `version` definidos en la plantilla del tipo de dispositivo."""
+    layouts = properties.get("packed_layout") if properties else None
+    if isinstance(layouts, dict):
+        fields = layouts.get(str(version), layouts.get(version))
+        return list(fields) if fields else None
+    return DEFAULT_LAYOUTS.get(version)
+
+
+def decode_packed_reading(
+    body: bytes, layout_for: Callable[[int, int], Optional[List[str]]]
+) -> Dict[str, Any]:
+    """
+    Decodifica un registro binario a los campos de DeviceIotReadingUpdateByLot.
+    layout_for(device_type_id, version) devuelve la lista de campos de esa versión.
+    Lanza ValueError si el registro no es válido.
+    """
+    view = memoryview(body)
+    if len(view) < HEADER.size:
+        raise ValueError("Registro binario incompleto")
+    version, device_id, lot_id, device_type_id, epoch = HEADER.unpack_from(view, 0)
+
+    fields = layout_for(device_type_id, version)
+    if not fields:
+        raise ValueError(f"Versión {version} sin layout para el tipo de dispositivo {device_type_id}")
+    values = _values_struct(len(fields))
+    if len(view) != HEADER.size + values.size:
+        raise ValueError(
+            f"Tamaño inválido: se esperaban {HEADER.size + values.size} bytes y llegaron {len(view)}"
+        )
+
+    reading: Dict[str, Any] = {
+        "device_id": device_id,
+        "lot_id": lot_id,
+        "device_type_id": device_type_id,
+        "sensor_value": None,
+        "ts": datetime.fromtimestamp(epoch) if epoch else None
+    }
+    for name, value in zip(fields, values.unpack_from(view, HEADER.size)):
+        if not math.isnan(value):
+            reading[name] = value
+    return reading
+
+
+def encode_packed_reading(
+    device_id: int,
+    lot_id: int,
+    device_type_id: int,
+    values: Dict[str, float],
+    fields: List[str],
+    version: int = 1,
+    ts: Optional[datetime] = None
+) -> bytes:
+    """Operación inversa, útil para gateways y simuladores escritos en Python."""
+    epoch = int(ts.timestamp()) if ts else 0
+    packed = [float(values[name]) if values.get(name) is not None else math.nan for name in fields]
+    return HEADER.pack(version, device_id, lot_id, device_type_id, epoch) + _values_struct(len(fields)).pack(*packed)
@@ -0,0 +1,251 @@
+import math
+import os
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+from app.devices.models import DeviceCompressionState
+from app.devices.templates import device_templates
+
+# =======================================================
+# Compresión del histórico de lecturas (deadband / swinging door)
+# =======================================================
+#
+# Se configura por tipo de dispositivo en Device.properties["compression"], por ejemplo:
+#   {"algorithm": "swinging_door", "tolerance": 0.5, "max_gap_seconds": 3600}
+#   {"algorithm": "deadband", "tolerance": 0.2}
+# Sin esa clave el tipo de dispositivo guarda todas sus lecturas.
+# deadband reconstruye la señal manteniendo el último valor guardado (escalón);
+# swinging_door la reconstruye interpolando linealmente entre puntos guardados.
+# Sólo decide qué puntos van a device_iot_reading; data_devices se actualiza siempre.
+#
+# El estado de cada dispositivo (pivote, punto retenido y puertas) vive en
+# device_compression_state: se lee con bloqueo en la transacción de la lectura y se
+# escribe antes del commit. Cualquier worker sigue la señal donde la dejó otro, el punto
+# retenido sobrevive a un reinicio y un rollback deja el estado (y el punto retenido)
+# como estaba antes de la transacción.
+
+COMPRESSION_MAX_GAP = float(os.getenv("COMPRESSION_MAX_GAP", "3600"))  # s máximos entre puntos guardados
+
+DEADBAND = "deadband"
+SWINGING_DOOR = "swinging_door"
+ALGORITHMS = (DEADBAND, SWINGING_DOOR)
+
+# Campos que obligan a guardar la lectura aunque el valor no cambie
+ALWAYS_KEEP = ("final_volume",)
+
+
+class CompressionConfig:
+    __slots__ = ("algorithm", "tolerance", "max_gap", "always_keep")
+
+    def __init__(self, algorithm: str, tolerance: float, max_gap: float, always_keep: Iterable[str]):
+        self.algorithm = algorithm
+        self.tolerance = tolerance
+        self.max_gap = max_gap
+        self.always_keep = tuple(always_keep)
+
+    @classmethod
+    def from_properties(cls, properties: Optional[Dict[str, Any]]) -> Optional["CompressionConfig"]:
+        """Configuración desde la plantilla; None si el tipo no comprime o la configuración no es válida."""
+        conf = properties.get("compression") if properties else None
+        if not isinstance(conf, dict) or conf.get("algorithm") not in ALGORITHMS:
+            return None
+        try:
+            tolerance = float(conf.get("tolerance", 0))
+            max_gap = float(conf.get("max_gap_seconds", COMPRESSION_MAX_GAP))
+        except (TypeError, ValueError):
+            return None
+        if tolerance < 0:
+            return None
+        return cls(conf["algorithm"], tolerance, max_gap, conf.get("always_keep", ALWAYS_KEEP))
+
+
+_STATES_KEY = "compression_states"
+
+
+class SignalState:
+    """
+    Estado por dispositivo: último punto guardado, último punto recibido (retenido)
+    y, para swinging door, las pendientes de las “puertas” superior e inferior.
+    """
+    __slots__ = ("archived_t", "archived_v", "held", "held_t", "slope_hi", "slope_lo")
+
+    def __init__(self, t: float, v: float):
+        self.archived_t = t
+        self.archived_v = v
+        self.held: Optional[Dict[str, Any]] = None
+        self.held_t = t
+        self.slope_hi = float("inf")
+        self.slope_lo = float("-inf")
+
+    @classmethod
+    def from_row(cls, row: DeviceCompressionState) -> "SignalState":
+        state = cls(row.archived_t, row.archived_v)
+        state.held_t = row.held_t
+        state.slope_hi = row.slope_hi if row.slope_hi is not None else float("inf")
+        state.slope_lo = row.slope_lo if row.slope_lo is not None else float("-inf")
+        if row.held is not None:
+            state.held = dict(row.held, ts=datetime.fromisoformat(row.held["ts"]))
+        return state
+
+    def to_row(self, device_id: int) -> Dict[str, Any]:
+        held = dict(self.held, ts=self.held["ts"].isoformat()) if self.held is not None else None
+        return {
+            "device_iot_id": device_id, "archived_t": self.archived_t, "archived_v": self.archived_v,
+            "held_t": self.held_t, "held": held,
+            "slope_hi": self.slope_hi if math.isfinite(self.slope_hi) else None,
+            "slope_lo": self.slope_lo if math.isfinite(self.slope_lo) else None
+        }
+
+    def archive(self, t: float, v: float) -> None:
+        self.archived_t = t
+        self.archived_v = v
+        self.held = None
+        self.slope_hi = float("inf")
+        self.slope_lo = float("-inf")
+
+
+class HistoryCompressor:
+    """
+    Filtra las filas del histórico dejando sólo los puntos necesarios para reconstruir
+    la señal dentro de la tolerancia configurada.
+    """
+
+    def __init__(self):
+        self.received = 0
+        self.stored = 0
+
+    # ── Estado en la transacción ────────────────────────────
+    def load(self, db: Session, device_ids: Iterable[int]) -> None:
+        """Lee y bloquea de una vez el estado de varios dispositivos (en orden de id)."""
+        states = db.info.setdefault(_STATES_KEY, {})
+        missing = sorted(set(device_ids) - set(states))
+        if not missing:
+            return
+        rows = db.execute(
+            select(DeviceCompressionState).where(DeviceCompressionState.device_iot_id.in_(missing))
+            .order_by(DeviceCompressionState.device_iot_id).with_for_update()
+        ).scalars()
+        for row in rows:
+            states[row.device_iot_id] = SignalState.from_row(row)
+        for device_id in missing:
+            states.setdefault(device_id, None)   # sin estado: su primer punto se guarda
+
+    def _state(self, db: Session, device_id: int) -> Optional[SignalState]:
+        if device_id not in db.info.get(_STATES_KEY, {}):
+            self.load(db, [device_id])
+        return db.info[_STATES_KEY][device_id]
+
+    def _save(self, session: Session) -> None:
+        """before_commit: escribe el estado de los dispositivos que pasaron por offer."""
+        states = session.info.get(_STATES_KEY)
+        rows = [state.to_row(device_id) for device_id, state in sorted((states or {}).items()) if state is not None]
+        if not rows:
+            return
+        table = DeviceCompressionState.__table__
+        if session.get_bind().dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["device_iot_id"],
+            set_={c: stmt.excluded[c] for c in ("archived_t", "archived_v", "held_t", "held", "slope_hi", "slope_lo")}
+        )
+        session.execute(stmt, rows)
+
+    @staticmethod
+    def _clear(session: Session, *args) -> None:
+        session.info.pop(_STATES_KEY, None)
+
+    def offer(self, db: Session, devices_id: Optional[int], row: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Recibe la fila de una lectura y devuelve las filas a guardar (ninguna, una o dos)."""
+        config = CompressionConfig.from_properties(device_templates.get(db, devices_id)) if devices_id else None
+        value = row.get("sensor_value")
+        if config is None or value is None:
+            self.received += 1
+            self.stored += 1
+            return [row]
+
+        t = row["ts"].timestamp()
+        device_id = row["device_iot_id"]
+        keep = any(field in row["data"] for field in config.always_keep)
+        self.received += 1
+        state = self._state(db, device_id)
+        if state is None or t <= state.held_t:
+            # Primer punto del dispositivo o lectura fuera de orden: se guarda tal cual
+            if state is None:
+                db.info[_STATES_KEY][device_id] = SignalState(t, value)
+            self.stored += 1
+            return [row]
+
+        if config.algorithm == DEADBAND:
+            out = self._deadband(state, config, row, t, value, keep)
+        else:
+            out = self._swinging_door(state, config, row, t, value, keep)
+        self.stored += len(out)
+        return out
+
+    def compressed(self, db: Session, devices_id: Optional[int]) -> bool:
+        """El tipo de dispositivo comprime su histórico."""
+        return bool(devices_id) and CompressionConfig.from_properties(device_templates.get(db, devices_id)) is not None
+
+    @staticmethod
+    def _deadband(
+        state: SignalState, config: CompressionConfig, row: Dict[str, Any], t: float, value: float, keep: bool
+    ) -> List[Dict[str, Any]]:
+        """Guarda el punto cuando sale de la banda ±tolerance alrededor del último guardado."""
+        state.held_t = t
+        if keep or abs(value - state.archived_v) > config.tolerance or t - state.archived_t >= config.max_gap:
+            state.archive(t, value)
+            return [row]
+        return []
+
+    @staticmethod
+    def _swinging_door(
+        state: SignalState, config: CompressionConfig, row: Dict[str, Any], t: float, value: float, keep: bool
+    ) -> List[Dict[str, Any]]:
+        """
+        Se retiene el punto recibido mientras la recta desde el último punto guardado
+        hasta él pase a menos de ±tolerance de todos los puntos intermedios (queda
+        dentro de las puertas). Si sale de las puertas se guarda el punto retenido
+        y las puertas se reinician desde él.
+        """
+        if keep or t - state.archived_t >= config.max_gap:
+            out = [state.held] if state.held is not None else []
+            state.archive(t, value)
+            state.held_t = t
+            return out + [row]
+
+        dt = t - state.archived_t
+        slope = (value - state.archived_v) / dt
+        if state.slope_lo <= slope <= state.slope_hi:
+            state.slope_hi = min(state.slope_hi, (value + config.tolerance - state.archived_v) / dt)
+            state.slope_lo = max(state.slope_lo, (value - config.tolerance - state.archived_v) / dt)
+            state.held, state.held_t = row, t
+            return []
+
+        held = state.held
+        held_t = state.held_t
+        held_v = held["sensor_value"]
+        state.archive(held_t, held_v)
+        dt = t - held_t
+        state.slope_hi = (value + config.tolerance - held_v) / dt
+        state.slope_lo = (value - config.tolerance - held_v) / dt
+        state.held, state.held_t = row, t
+        return [held]
+
+    def stats(self, db: Session) -> Dict[str, Any]:
+        return {
+            "devices_tracked": db.execute(select(func.count()).select_from(DeviceCompressionState)).scalar(),
+            "received": self.received,
+            "stored": self.stored,
+            "compression_ratio": round(self.received / self.stored, 3) if self.stored else None
+        }
+
+
+history_compressor = HistoryCompressor()
+
+event.listen(Session, "before_commit", history_compressor._save)
+event.listen(Session, "after_commit", history_compressor._clear)
+event.listen(Session, "after_soft_rollback", history_compressor._clear)
@@ -0,0 +1,209 @@
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set, Tuple
+from sqlalchemy import func, text
+from sqlalchemy.orm import Session
+from app.devices.models import DeviceReadingDedup
+
+# =======================================================
+# Deduplicación de lecturas reintentadas por los dispositivos
+# =======================================================
+
+DEDUP_SEQ_WINDOW     = 64                                             # bits de la ventana por dispositivo
+DEDUP_CACHE_SIZE     = int(os.getenv("DEDUP_CACHE_SIZE", "50000"))    # respuestas guardadas en memoria
+DEDUP_RETENTION_HOURS = int(os.getenv("DEDUP_RETENTION_HOURS", "24"))
+DEDUP_PRUNE_EVERY    = 1000                                           # reclamos entre cada purga de la tabla
+
+NEW = "new"
+DUPLICATE = "duplicate"
+RESET = "reset"
+
+DUPLICATE_RESPONSE = {"success": True, "data": {"duplicate": True}}
+
+
+class SeqWindow:
+    """
+    Ventana anti-repetición por dispositivo: el mayor seq visto y un bitmap
+    de los DEDUP_SEQ_WINDOW anteriores (bit i = seq high - i ya aplicado).
+
+    Reinicios del equipo: si la lectura trae boot (contador de arranques), un boot mayor
+    es un arranque nuevo y sus seq van en claves aparte ("seq:<boot>:<n>"). Sin boot no
+    se distingue un reinicio de un reintento viejo o de una subida repetida: un retroceso
+    mayor que la ventana lo decide la tabla persistida y nunca se borran claves.
+    """
+    __slots__ = ("high", "mask", "boot")
+
+    def __init__(self, high: int = -1, mask: int = 0, boot: Optional[int] = None):
+        self.high = high
+        self.mask = mask
+        self.boot = boot
+
+    def classify(self, seq: int, boot: Optional[int] = None) -> str:
+        if self.high < 0:
+            return NEW
+        if boot != self.boot:
+            if boot is not None and (self.boot is None or boot > self.boot):
+                return RESET
+            return NEW  # de un arranque anterior: decide la tabla persistida
+        if seq > self.high:
+            return NEW
+        offset = self.high - seq
+        if offset >= DEDUP_SEQ_WINDOW:
+            return NEW  # fuera de la ventana: decide la tabla persistida
+        return DUPLICATE if (self.mask >> offset) & 1 else NEW
+
+    def mark(self, seq: int, boot: Optional[int] = None) -> None:
+        if self.high >= 0 and boot != self.boot:
+            if boot is None or (self.boot is not None and boot < self.boot):
+                return  # lectura de un arranque anterior: no mueve la ventana
+            self.reset()
+        if self.high < 0:
+            self.high, self.mask, self.boot = seq, 1, boot
+        elif seq > self.high:
+            shift = seq - self.high
+            self.mask = ((self.mask << shift) | 1) & ((1 << DEDUP_SEQ_WINDOW) - 1)
+            self.high = seq
+        elif self.high - seq < DEDUP_SEQ_WINDOW:
+            self.mask |= 1 << (self.high - seq)
+
+    def reset(self) -> None:
+        self.high, self.mask, self.boot = -1, 0, None
+
+
+class ReadingDedup:
+    """
+    Primer filtro en memoria (ventana de seq y respuestas recientes) para responder
+    reintentos sin tocar la base; segundo filtro persistido en device_reading_dedup,
+    reclamado dentro de la misma transacción que aplica la lectura.
+    """
+
+    def __init__(self, cache_size: int = DEDUP_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._windows: Dict[int, SeqWindow] = {}
+        self._responses: "OrderedDict[Tuple[int, str], Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._claims = 0
+        self.hits = 0
+        self.persisted_hits = 0
+
+    @staticmethod
+    def key_for(seq: Optional[int], idempotency_key: Optional[str], boot: Optional[int] = None) -> Optional[str]:
+        if idempotency_key:
+            return f"key:{idempotency_key}"
+        if seq is not None:
+            return f"seq:{seq}" if boot is None else f"seq:{boot}:{seq}"
+        return None
+
+    @staticmethod
+    def boot_of(key: str) -> Optional[int]:
+        """Arranque de una clave "seq:<boot>:<n>" (None en "seq:<n>")."""
+        parts = key.split(":")
+        return int(parts[1]) if len(parts) == 3 else None
+
+    def lookup(self, device_id: int, key: str, seq: Optional[int]) -> Optional[Dict[str, Any]]:
+        """Respuesta a devolver si la lectura ya se aplicó según la memoria; None si no se sabe."""
+        with self._lock:
+            verdict = None
+            if key.startswith("seq:") and seq is not None:
+                window = self._windows.get(device_id)
+                verdict = window.classify(seq, self.boot_of(key)) if window is not None else None
+                if verdict == RESET:
+                    return None   # el equipo se reinició: la respuesta guardada es del arranque anterior
+            cached = self._responses.get((device_id, key))
+            if cached is not None:
+                self._responses.move_to_end((device_id, key))
+                self.hits += 1
+                return cached
+            if verdict == DUPLICATE:
+                self.hits += 1
+                return DUPLICATE_RESPONSE
+        return None
+
+    def claim(self, db: Session, items: List[Tuple[int, str, Optional[int]]]) -> Set[Tuple[int, str]]:
+        """
+        Registra (device_id, key, seq) en device_reading_dedup sin hacer commit.
+        Devuelve los pares que no existían; el resto son reintentos ya aplicados.
+        """
+        if not items:
+            return set()
+        self._reset_restarted_devices(db, items)
+
+        rows = [{"device_iot_id": d, "dedup_key": k, "seq": s,
+                 "boot": self.boot_of(k) if k.startswith("seq:") else None} for d, k, s in items]
+        table = DeviceReadingDedup.__table__
+        if db.get_bind().dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        stmt = (
+            insert(table).values(rows)
+            .on_conflict_do_nothing(index_elements=["device_iot_id", "dedup_key"])
+            .returning(table.c.device_iot_id, table.c.dedup_key)
+        )
+        accepted = {(r.device_iot_id, r.dedup_key) for r in db.execute(stmt)}
+        self.persisted_hits += len({(d, k) for d, k, _ in items}) - len(accepted)
+
+        self._claims += 1
+        if self._claims % DEDUP_PRUNE_EVERY == 0:
+            db.execute(text(f"DELETE FROM {table.name} WHERE created_at < :limit"),
+                       {"limit": datetime.now() - timedelta(hours=DEDUP_RETENTION_HOURS)})
+        return accepted
+
+    def _reset_restarted_devices(self, db: Session, items: List[Tuple[int, str, Optional[int]]]) -> None:
+        """Si el equipo se reinició (boot mayor) su ventana vuelve a empezar; las claves persistidas quedan."""
+        unknown = {d for d, k, s in items if s is not None and k.startswith("seq:") and d not in self._windows}
+        if unknown:
+            # Tras reiniciar el proceso, recuperar el mayor seq persistido del último arranque
+            rows = (
+                db.query(DeviceReadingDedup.device_iot_id, DeviceReadingDedup.boot, func.max(DeviceReadingDedup.seq))
+                .filter(DeviceReadingDedup.device_iot_id.in_(unknown),
+                        DeviceReadingDedup.seq.isnot(None))
+                .group_by(DeviceReadingDedup.device_iot_id, DeviceReadingDedup.boot)
+                .all()
+            )
+            latest: Dict[int, Tuple[Optional[int], int]] = {}
+            for device_id, boot, high in rows:
+                current = latest.get(device_id)
+                if current is None or (boot if boot is not None else -1) > (current[0] if current[0] is not None else -1):
+                    latest[device_id] = (boot, high)
+            with self._lock:
+                for device_id, (boot, high) in latest.items():
+                    self._windows.setdefault(device_id, SeqWindow(high, 1, boot))
+
+        restarted: Set[int] = set()
+        with self._lock:
+            for device_id, key, seq in items:
+                window = self._windows.get(device_id)
+                if seq is None or not key.startswith("seq:") or window is None:
+                    continue
+                if window.classify(seq, self.boot_of(key)) == RESET:
+                    window.reset()
+                    restarted.add(device_id)
+        for device_id in restarted:
+            print(f"[dedup] Device {device_id}: arranque nuevo, secuencia reiniciada")
+
+    def remember(self, device_id: int, key: str, seq: Optional[int], response: Dict[str, Any]) -> None:
+        """Guardar en memoria una lectura ya confirmada y su respuesta."""
+        with self._lock:
+            if seq is not None and key.startswith("seq:"):
+                window = self._windows.get(device_id)
+                if window is None:
+                    window = self._windows[device_id] = SeqWindow()
+                window.mark(seq, self.boot_of(key))
+            self._responses[(device_id, key)] = response
+            self._responses.move_to_end((device_id, key))
+            while len(self._responses) > self.cache_size:
+                self._responses.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "devices_tracked": len(self._windows),
+            "cached_responses": len(self._responses),
+            "memory_hits": self.hits,
+            "persisted_hits": self.persisted_hits
+        }
+
+
+reading_dedup = ReadingDedup()
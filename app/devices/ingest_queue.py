@@ -0,0 +1,149 @@
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List
+from app.database import SessionLocal
+from app.devices.schemas import DeviceIotReadingUpdateByLot
+from app.devices.services import DeviceService
+
+# =======================================================
+# Ingesta write-behind: la lectura se encola y se responde 202;
+# un hilo la escribe en bloque junto a las demás.
+# =======================================================
+
+INGEST_MODE            = os.getenv("INGEST_MODE", "sync")          # "sync" | "write_behind"
+INGEST_QUEUE_MAXSIZE   = int(os.getenv("INGEST_QUEUE_MAXSIZE", "10000"))
+INGEST_FLUSH_MAX_ITEMS = int(os.getenv("INGEST_FLUSH_MAX_ITEMS", "500"))
+INGEST_FLUSH_INTERVAL  = float(os.getenv("INGEST_FLUSH_INTERVAL", "1.0"))  # segundos
+
+
+class ReadingQueue:
+    """
+    Cola acotada en memoria con un hilo de volcado.
+    Vuelca cuando junta flush_max_items lecturas o cuando pasan flush_interval segundos
+    desde la primera lectura pendiente. La detección de fugas y el final_volume se
+    evalúan al volcar, con la misma lógica de /sensor_update_by_lot/batch.
+    """
+
+    def __init__(self, maxsize: int, flush_max_items: int, flush_interval: float):
+        self._queue: "queue.Queue[DeviceIotReadingUpdateByLot]" = queue.Queue(maxsize=maxsize)
+        self.flush_max_items = flush_max_items
+        self.flush_interval = flush_interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()   # contadores: los tocan los hilos HTTP y el de volcado
+        self.enqueued = 0
+        self.rejected = 0
+        self.flushed = 0
+        self.failed = 0
+        self.flushes = 0
+
+    @property
+    def enabled(self) -> bool:
+        return INGEST_MODE == "write_behind"
+
+    def put(self, reading: DeviceIotReadingUpdateByLot) -> bool:
+        """Encola sin bloquear. Devuelve False si la cola está llena."""
+        if reading.ts is None:
+            # Sellar con la hora de llegada, no con la del volcado
+            reading.ts = datetime.now()
+        try:
+            self._queue.put_nowait(reading)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def _collect(self) -> List[DeviceIotReadingUpdateByLot]:
+        """Espera la primera lectura y junta más hasta el tamaño o el tiempo límite."""
+        try:
+            first = self._queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return []
+        items = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(items) < self.flush_max_items:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    @staticmethod
+    def _group_by_device(items: List[DeviceIotReadingUpdateByLot]) -> List[DeviceIotReadingUpdateByLot]:
+        """
+        Ordena las lecturas por dispositivo conservando el orden de llegada de cada uno.
+        No descarta ninguna: apply_readings_batch es el que junta los cambios de cada fila
+        de device_iot en una sola escritura por lote.
+        """
+        by_device: Dict[Any, List[DeviceIotReadingUpdateByLot]] = {}
+        for item in items:
+            by_device.setdefault(item.device_id, []).append(item)
+        return [item for group in by_device.values() for item in group]
+
+    def _flush(self, items: List[DeviceIotReadingUpdateByLot]) -> None:
+        batch = self._group_by_device(items)
+        db = SessionLocal()
+        try:
+            results = DeviceService(db).apply_readings_batch(batch)
+            with self._lock:
+                self.flushed += sum(1 for r in results if r["success"])
+                self.failed += sum(1 for r in results if not r["success"])
+        except Exception as e:
+            db.rollback()
+            print(f"[ingesta] Error al volcar {len(batch)} lecturas, reintentando una a una:", e)
+            service = DeviceService(db)
+            for reading in batch:
+                response = service.update_device_reading_by_lot(reading)
+                with self._lock:
+                    if response.status_code == 200:
+                        self.flushed += 1
+                    else:
+                        self.failed += 1
+        finally:
+            db.close()
+        with self._lock:
+            self.flushes += 1
+
+    def run(self) -> None:
+        print("[ingesta] hilo de volcado iniciado")
+        while not self._stop.is_set() or not self._queue.empty():
+            items = self._collect()
+            if items:
+                self._flush(items)
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Detiene el hilo después de volcar lo pendiente."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "mode": INGEST_MODE,
+                "pending": self._queue.qsize(),
+                "capacity": self._queue.maxsize,
+                "enqueued": self.enqueued,
+                "rejected": self.rejected,
+                "flushed": self.flushed,
+                "failed": self.failed,
+                "flushes": self.flushes
+            }
+
+
+reading_queue = ReadingQueue(INGEST_QUEUE_MAXSIZE, INGEST_FLUSH_MAX_ITEMS, INGEST_FLUSH_INTERVAL)
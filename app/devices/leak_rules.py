@@ -0,0 +1,295 @@
+import abc
+import os
+from collections import deque
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import bindparam, func, select, text, update
+from sqlalchemy.orm import Session
+from app.devices.models import DeviceLeakState
+
+# =======================================================
+# Motor de reglas para detección de fugas sobre el flujo de lecturas
+# =======================================================
+#
+# La ventana y el incidente de cada válvula viven en device_leak_state: todos los workers
+# ven la misma ventana y sólo uno abre el incidente. La fila se lee sin bloqueo y sólo se
+# escribe si el lote cambió la ventana, las lecturas sin flujo (topadas en quiet_cap) o el
+# incidente; en régimen normal (sin flujo con la válvula cerrada) no hay escrituras. La
+# escritura es condicional a la versión leída: si otro worker la cambió entremedio, se
+# relee con bloqueo y se vuelve a evaluar. Todo viaja en la transacción del lote de
+# lecturas: si se revierte, el estado también.
+
+LEAK_THRESHOLD       = float(os.getenv("LEAK_THRESHOLD", "0"))        # L por lectura para contar como flujo
+LEAK_WINDOW          = int(os.getenv("LEAK_WINDOW", "5"))             # lecturas en la ventana deslizante
+LEAK_MIN_HITS        = int(os.getenv("LEAK_MIN_HITS", "3"))           # lecturas con flujo para abrir incidente
+LEAK_CLEAR_THRESHOLD = float(os.getenv("LEAK_CLEAR_THRESHOLD", "0"))  # histéresis: nivel para considerar sin flujo
+LEAK_CLEAR_HITS      = int(os.getenv("LEAK_CLEAR_HITS", "3"))         # lecturas seguidas sin flujo para cerrar
+
+FAILURE_TYPE_ID = 2    # type_failure.id para “Fuga”
+MAINT_STATUS_ID = 24   # vars.id para “pendiente” en maintenance_status_id
+
+TRIGGER = "trigger"
+CLEAR = "clear"
+
+
+class ValveWindow:
+    """Ventana deslizante de lecturas del medidor asociadas a una válvula."""
+    __slots__ = ("values", "hits", "quiet", "open_incident", "threshold")
+
+    def __init__(self, size: int, threshold: float):
+        self.values = deque(maxlen=size)
+        self.hits = 0           # lecturas de la ventana por encima del umbral con la válvula cerrada
+        self.quiet = 0          # lecturas seguidas por debajo del nivel de cierre
+        self.open_incident = False
+        self.threshold = threshold
+
+    @classmethod
+    def from_state(cls, state: DeviceLeakState, size: int, threshold: float) -> "ValveWindow":
+        window = cls(size, threshold)
+        window.values.extend(bool(v) for v in (state.recent or [])[-size:])
+        window.hits = sum(window.values)
+        window.quiet = state.quiet or 0
+        window.open_incident = bool(state.open_incident)
+        return window
+
+    def push(self, value: float, valve_open: bool, clear_threshold: float, quiet_cap: int) -> None:
+        flowing = value > self.threshold and not valve_open
+        if len(self.values) == self.values.maxlen and self.values[0]:
+            self.hits -= 1
+        self.values.append(flowing)
+        if flowing:
+            self.hits += 1
+        if value <= clear_threshold or valve_open:
+            self.quiet = min(self.quiet + 1, quiet_cap)
+        else:
+            self.quiet = 0
+
+
+class LeakRule(abc.ABC):
+    """
+    Regla base. Recibe la ventana de una válvula y devuelve TRIGGER, CLEAR o None.
+    Para agregar reglas basta con heredar y registrarlas en el detector.
+    """
+    name = "base"
+
+    @abc.abstractmethod
+    def evaluate(self, window: ValveWindow) -> Optional[str]:
+        ...
+
+
+class SustainedFlowRule(LeakRule):
+    """
+    Abre incidente si al menos min_hits de las últimas lecturas muestran flujo con la válvula
+    no abierta; lo cierra tras clear_hits lecturas seguidas por debajo del nivel de cierre.
+    """
+    name = "sustained_flow"
+
+    def __init__(self, min_hits: int = LEAK_MIN_HITS, clear_hits: int = LEAK_CLEAR_HITS):
+        self.min_hits = min_hits
+        self.clear_hits = clear_hits
+
+    def evaluate(self, window: ValveWindow) -> Optional[str]:
+        if window.hits >= self.min_hits:
+            return TRIGGER
+        if window.quiet >= self.clear_hits:
+            return CLEAR
+        return None
+
+
+class LeakDetector:
+    """
+    Evalúa las reglas por lotes de lecturas sobre la ventana de cada válvula.
+    Sólo informa transiciones: un incidente abierto no se vuelve a reportar
+    hasta que las reglas lo cierren, así una fuga genera un único registro.
+    No hace commit: el estado viaja en la transacción de la lectura.
+    """
+
+    def __init__(
+        self,
+        rules: Optional[List[LeakRule]] = None,
+        window: int = LEAK_WINDOW,
+        threshold: float = LEAK_THRESHOLD,
+        clear_threshold: float = LEAK_CLEAR_THRESHOLD,
+        quiet_cap: Optional[int] = None
+    ):
+        self.rules: List[LeakRule] = rules if rules is not None else [SustainedFlowRule()]
+        self.window = window
+        self.threshold = threshold
+        self.clear_threshold = clear_threshold
+        # Las reglas no miran más allá de este número de lecturas seguidas sin flujo
+        self.quiet_cap = quiet_cap if quiet_cap is not None else max(LEAK_CLEAR_HITS, window)
+        self.opened = 0
+        self.cleared = 0
+        self.evaluated = 0
+        self.writes = 0
+        self.conflicts = 0
+
+    def register(self, rule: LeakRule) -> None:
+        self.rules.append(rule)
+
+    @staticmethod
+    def _pending_leaks(db: Session, valve_ids: Iterable[int]) -> set:
+        """Válvulas con una fuga en mantenimiento pendiente (incidente abierto antes de device_leak_state)."""
+        rows = db.execute(text("""
+            SELECT DISTINCT device_iot_id
+              FROM maintenance
+             WHERE type_failure_id = :tfid
+               AND maintenance_status_id = :msid
+               AND device_iot_id IN :valve_ids
+        """).bindparams(bindparam("valve_ids", expanding=True)),
+            {"tfid": FAILURE_TYPE_ID, "msid": MAINT_STATUS_ID, "valve_ids": list(valve_ids)}).fetchall()
+        return {valve_id for (valve_id,) in rows}
+
+    def _read_states(self, db: Session, valve_ids: List[int], lock: bool = False) -> Dict[int, DeviceLeakState]:
+        """Filas de estado de las válvulas (bloqueadas hasta el commit si lock); crea las que faltan."""
+        query = (
+            select(DeviceLeakState).where(DeviceLeakState.device_iot_id.in_(valve_ids))
+            .order_by(DeviceLeakState.device_iot_id)
+            .execution_options(populate_existing=True)
+        )
+        if lock:
+            query = query.with_for_update()
+        states = {s.device_iot_id: s for s in db.execute(query).scalars()}
+        missing = [valve_id for valve_id in valve_ids if valve_id not in states]
+        if not missing:
+            return states
+        try:
+            with db.begin_nested():   # si falla no arrastra la transacción de la lectura
+                pending = self._pending_leaks(db, missing)
+        except Exception as e:
+            print("[FUGA] No se pudieron cargar los incidentes abiertos:", e)
+            pending = set()
+        table = DeviceLeakState.__table__
+        if db.get_bind().dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        # Otro worker puede crear la misma fila a la vez: gana el primero y se relee
+        db.execute(insert(table).on_conflict_do_nothing(index_elements=["device_iot_id"]), [
+            {"device_iot_id": valve_id, "recent": [], "quiet": 0, "open_incident": valve_id in pending, "version": 0}
+            for valve_id in missing
+        ])
+        states.update(
+            (s.device_iot_id, s)
+            for s in db.execute(query.where(DeviceLeakState.device_iot_id.in_(missing))).scalars()
+        )
+        return states
+
+    def _evaluate_valve(
+        self, valve_id: int, state: DeviceLeakState, values: List[Tuple[float, bool]], now: datetime
+    ) -> Tuple[Optional[Dict[str, Any]], List[Tuple[int, float]], List[int]]:
+        """
+        Recorre las lecturas de una válvula sobre su estado guardado.
+        Devuelve (fila a escribir o None si el estado no cambió, aperturas, cierres).
+        """
+        window = ValveWindow.from_state(state, self.window, self.threshold)
+        before = ([int(v) for v in window.values], window.quiet, window.open_incident)
+        opened_at = state.opened_at
+        opened: List[Tuple[int, float]] = []
+        cleared: List[int] = []
+        for value, valve_open in values:
+            window.push(value, valve_open, self.clear_threshold, self.quiet_cap)
+            self.evaluated += 1
+            verdicts = [rule.evaluate(window) for rule in self.rules]
+            if not window.open_incident and TRIGGER in verdicts:
+                window.open_incident = True
+                opened_at = now
+                opened.append((valve_id, value))
+            elif window.open_incident and verdicts and all(v == CLEAR for v in verdicts):
+                window.open_incident = False
+                opened_at = None
+                cleared.append(valve_id)
+        after = ([int(v) for v in window.values], window.quiet, window.open_incident)
+        if after == before:
+            return None, opened, cleared
+        row = {"b_id": valve_id, "b_version": state.version, "recent": after[0], "quiet": after[1],
+               "open_incident": after[2], "opened_at": opened_at}
+        return row, opened, cleared
+
+    def _write(self, db: Session, rows: List[Dict[str, Any]]) -> List[int]:
+        """Escribe las filas si siguen en la versión leída; devuelve las válvulas que otro worker cambió."""
+        table = DeviceLeakState.__table__
+        stmt = (
+            update(table)
+            .where(table.c.device_iot_id == bindparam("b_id"), table.c.version == bindparam("b_version"))
+            .values(recent=bindparam("recent"), quiet=bindparam("quiet"),
+                    open_incident=bindparam("open_incident"), opened_at=bindparam("opened_at"),
+                    version=table.c.version + 1, updated_at=func.now())
+        )
+        conflicts = []
+        for row in rows:
+            if db.execute(stmt, row).rowcount != 1:
+                conflicts.append(row["b_id"])
+        self.writes += len(rows) - len(conflicts)
+        return conflicts
+
+    def evaluate_batch(
+        self, db: Session, samples: Iterable[Tuple[int, float, bool]]
+    ) -> Tuple[List[Tuple[int, float]], List[int]]:
+        """
+        samples: (valve_id, sensor_value, valve_open) en orden de llegada.
+        Agrupa por válvula y recorre cada grupo una sola vez.
+        Devuelve (incidentes abiertos [(valve_id, valor que lo disparó)], válvulas cuyo incidente se cerró).
+        """
+        grouped: Dict[int, List[Tuple[float, bool]]] = {}
+        for valve_id, value, valve_open in samples:
+            grouped.setdefault(valve_id, []).append((value, valve_open))
+        if not grouped:
+            return [], []
+
+        now = datetime.now()
+        outcome: Dict[int, Tuple[List[Tuple[int, float]], List[int]]] = {}
+        rows: List[Dict[str, Any]] = []
+        for valve_id, state in self._read_states(db, sorted(grouped)).items():
+            row, opened, cleared = self._evaluate_valve(valve_id, state, grouped[valve_id], now)
+            outcome[valve_id] = (opened, cleared)
+            if row is not None:
+                rows.append(row)
+        conflicts = self._write(db, rows)
+        if conflicts:
+            # Otro worker cambió el estado después de leerlo: releer bloqueado y evaluar otra vez
+            self.conflicts += len(conflicts)
+            locked = self._read_states(db, sorted(conflicts), lock=True)
+            rows = []
+            for valve_id, state in locked.items():
+                row, opened, cleared = self._evaluate_valve(valve_id, state, grouped[valve_id], now)
+                outcome[valve_id] = (opened, cleared)
+                if row is not None:
+                    rows.append(row)
+            self._write(db, rows)
+
+        opened_all = [o for valve_id in sorted(outcome) for o in outcome[valve_id][0]]
+        cleared_all = [c for valve_id in sorted(outcome) for c in outcome[valve_id][1]]
+        self.opened += len(opened_all)
+        self.cleared += len(cleared_all)
+        return opened_all, cleared_all
+
+    def discard(self, db: Session, valve_ids: Iterable[int]) -> None:
+        """Deshace, en la misma transacción, la apertura de incidentes que no se van a registrar."""
+        valve_ids = list(valve_ids)
+        if valve_ids:
+            table = DeviceLeakState.__table__
+            db.execute(update(table).where(table.c.device_iot_id.in_(valve_ids))
+                                    .values(open_incident=False, opened_at=None, version=table.c.version + 1))
+
+    def stats(self, db: Session) -> Dict[str, object]:
+        tracked, open_incidents = db.execute(
+            select(func.count(), func.count().filter(DeviceLeakState.open_incident.is_(True)))
+            .select_from(DeviceLeakState)
+        ).one()
+        return {
+            "rules": [rule.name for rule in self.rules],
+            "window": self.window,
+            "threshold": self.threshold,
+            "clear_threshold": self.clear_threshold,
+            "valves_tracked": tracked,
+            "open_incidents": open_incidents,
+            "evaluated": self.evaluated,
+            "writes": self.writes,
+            "conflicts": self.conflicts,
+            "opened": self.opened,
+            "cleared": self.cleared
+        }
+
+
+leak_detector = LeakDetector()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, JSON, ForeignKey, Float, Date, Boolean , Numeric, func
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, JSON, ForeignKey, Float, Date, Boolean , Numeric, Index, func
 from sqlalchemy.orm import relationship , validates
 from app.database import Base
 from app.devices_request.models import Vars
@@ -87,7 +87,7 @@ class DeviceIot(Base):
     @validates('status')
     def validate_status(self, key, value):
         """Validar que el estado del dispositivo sea uno de los valores válidos para 'device_status'"""
-        valid_device_status_ids = [11, 12, 13, 14, 15, 16,20,21,22]  # Los valores válidos para device_status
+        valid_device_status_ids = [11, 12, 13, 14, 15, 16,20,21,22,26]  # Los valores válidos para device_status
 
         if value not in valid_device_status_ids:
             raise ValueError(f"El estado {value} no es válido para un dispositivo. Los valores válidos son: {valid_device_status_ids}")
@@ -212,4 +212,190 @@ class ConsumptionMeasurement(Base):
     id = Column(Integer, primary_key=True, index=True)
     request_id = Column(Integer, ForeignKey("request.id", ondelete="CASCADE"), nullable=False)
     final_volume = Column(Numeric(10, 2), nullable=False)
-    created_at = Column(DateTime, server_default=func.now())
\ No newline at end of file
+    created_at = Column(DateTime, server_default=func.now())
+
+
+class ConsumptionVolumeSync(Base):
+    """
+    Último final_volume informado por el dispositivo para un request y momento (ts) de la
+    lectura que lo trajo. Ese valor ya incluye el consumo de las lecturas anteriores: los
+    incrementos pendientes de cualquier worker con ts <= ts no se suman en el checkpoint.
+    """
+    __tablename__ = "consumption_volume_sync"
+
+    request_id = Column(Integer, primary_key=True)
+    final_volume = Column(Float, nullable=False)
+    ts = Column(DateTime, nullable=False)
+
+
+class DeviceIotReading(Base):
+    """
+    Histórico append-only de lecturas de los dispositivos IoT.
+    En PostgreSQL la tabla se particiona por rango mensual sobre ts; la clave
+    primaria (device_iot_id, ts) incluye la columna de partición.
+    device_iot.data_devices conserva únicamente la última lectura.
+    """
+    __tablename__ = "device_iot_reading"
+    __table_args__ = (
+        Index("ix_device_iot_reading_lot_ts", "lot_id", "ts"),
+        {"postgresql_partition_by": "RANGE (ts)"},
+    )
+
+    # Sin FK a device_iot para no pagar la verificación en cada inserción
+    device_iot_id = Column(Integer, primary_key=True)
+    ts = Column(DateTime, primary_key=True)
+    lot_id = Column(Integer, nullable=True)
+    sensor_value = Column(Float, nullable=True)
+    data = Column(JSON, nullable=True)  # Lectura completa tal como llegó del dispositivo
+
+
+class DeviceReadingDedup(Base):
+    """
+    Ventana persistida de lecturas ya aplicadas, para descartar reintentos del dispositivo.
+    dedup_key es "seq:<n>" o "seq:<boot>:<n>" (número de secuencia) o "key:<idempotency_key>".
+    """
+    __tablename__ = "device_reading_dedup"
+
+    device_iot_id = Column(Integer, primary_key=True)
+    dedup_key = Column(String(80), primary_key=True)
+    seq = Column(BigInteger, nullable=True)
+    boot = Column(BigInteger, nullable=True)          # arranque del equipo (claves "seq:<boot>:<n>")
+    created_at = Column(DateTime, server_default=func.now(), index=True)
+
+
+class DeviceLeakState(Base):
+    """
+    Estado de detección de fugas por válvula, compartido por todos los workers:
+    ventana de lecturas recientes (1 = flujo con la válvula no abierta), lecturas seguidas
+    sin flujo e incidente abierto. Se escribe sólo si cambia, condicionada a la versión
+    leída, así una válvula tiene a lo sumo un incidente abierto.
+    """
+    __tablename__ = "device_leak_state"
+
+    device_iot_id = Column(Integer, primary_key=True)
+    recent = Column(JSON, nullable=False)
+    quiet = Column(Integer, nullable=False, default=0)
+    open_incident = Column(Boolean, nullable=False, default=False)
+    opened_at = Column(DateTime, nullable=True)
+    version = Column(Integer, nullable=False, default=0)   # sube con cada escritura (escritura condicional)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+class DeviceCompressionState(Base):
+    """
+    Estado de la compresión del histórico por dispositivo, compartido por todos los workers:
+    último punto guardado (pivote), punto retenido aún no guardado y pendientes de las
+    puertas (swinging door; NULL = sin límite). Tiempos en segundos epoch.
+    """
+    __tablename__ = "device_compression_state"
+
+    device_iot_id = Column(Integer, primary_key=True)
+    archived_t = Column(Float, nullable=False)
+    archived_v = Column(Float, nullable=False)
+    held_t = Column(Float, nullable=False)
+    held = Column(JSON, nullable=True)
+    slope_hi = Column(Float, nullable=True)
+    slope_lo = Column(Float, nullable=True)
+
+
+class RequestVolumeClose(Base):
+    """
+    Marca del cierre automático por volumen de un request. Se inserta en la misma
+    transacción que cierra la válvula; la clave primaria asegura que cada request se
+    cierre una sola vez aunque varios workers alcancen el objetivo.
+    """
+    __tablename__ = "request_volume_close"
+
+    request_id = Column(Integer, primary_key=True)
+    device_iot_id = Column(Integer, nullable=False)
+    volume = Column(Float, nullable=False)
+    closed_at = Column(DateTime, nullable=False)
+
+
+class DeviceReadingRollup(Base):
+    """
+    Agregados de lecturas por intervalo (minuto, hora, día), por dispositivo y por lote.
+    Se mantienen de forma incremental al ingerir lecturas; bucket es el inicio del intervalo.
+    """
+    __tablename__ = "device_reading_rollup"
+
+    scope = Column(String(10), primary_key=True)         # "device" | "lot"
+    scope_id = Column(Integer, primary_key=True)         # device_iot.id o lot_id según scope
+    resolution = Column(Integer, primary_key=True)       # segundos del intervalo
+    bucket = Column(DateTime, primary_key=True)
+    samples = Column(Integer, nullable=False)
+    sum_value = Column(Float, nullable=False)
+    min_value = Column(Float, nullable=False)
+    max_value = Column(Float, nullable=False)
+    last_value = Column(Float, nullable=False)
+    last_ts = Column(DateTime, nullable=False)
+
+
+class DeviceStatusTransition(Base):
+    """
+    Journal append-only de cambios de estado de los dispositivos (scheduler, aprobación y
+    rechazo de solicitudes, apertura/cierre manual, fugas). Lo escribe en lotes
+    app.transition_journal; el intervalo de cada estado termina en la siguiente fila del dispositivo.
+    """
+    __tablename__ = "device_status_transition"
+    __table_args__ = (
+        Index("ix_device_status_transition_device_ts", "device_iot_id", "ts"),
+        Index("ix_device_status_transition_lot_ts", "lot_id", "ts"),
+    )
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    device_iot_id = Column(Integer, nullable=False)
+    lot_id = Column(Integer, nullable=True)
+    request_id = Column(Integer, nullable=True)
+    from_status = Column(Integer, nullable=True)      # None si no se conoce
+    to_status = Column(Integer, nullable=False)
+    source = Column(String(20), nullable=False)       # scheduler, approve, reject, api, leak, ...
+    ts = Column(DateTime, nullable=False)
+
+
+class DeviceCommandQueue(Base):
+    """
+    Cola FIFO de comandos pendientes por dispositivo (open, close, close_manual) que cada
+    ESP32 recoge con GET /devices/devices/servo-command?device_id=...; la lectura borra el
+    comando. device_iot_id 0 es la cola de los comandos sin dispositivo (firmware antiguo).
+    """
+    __tablename__ = "device_command_queue"
+    __table_args__ = (
+        Index("ix_device_command_queue_device_id", "device_iot_id", "id"),
+    )
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    command_id = Column(String(32), nullable=True)    # device_command_log.id
+    device_iot_id = Column(Integer, nullable=False)
+    action = Column(String(20), nullable=False)
+    source = Column(String(20), nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+class DeviceCommandLog(Base):
+    """
+    Seguimiento de cada comando del servo: emisión, entregas, confirmación del dispositivo
+    y reintentos. La fila sobrevive a la entrega (la de device_command_queue se borra);
+    los reintentos reencolan el mismo id. Lo mantiene app.command_tracker.
+    """
+    __tablename__ = "device_command_log"
+    __table_args__ = (
+        Index("ix_device_command_log_retry", "status", "next_retry_at"),
+        Index("ix_device_command_log_device_issued", "device_iot_id", "issued_at"),
+    )
+
+    id = Column(String(32), primary_key=True)
+    device_iot_id = Column(Integer, nullable=False)
+    lot_id = Column(Integer, nullable=True)
+    action = Column(String(20), nullable=False)
+    source = Column(String(20), nullable=False)
+    status = Column(String(10), nullable=False)       # queued, delivered, acked, failed, unacked
+    attempts = Column(Integer, nullable=False, default=0)   # entregas al dispositivo
+    expects_ack = Column(Boolean, nullable=False, default=False)
+    issued_at = Column(DateTime, nullable=False)
+    delivered_at = Column(DateTime, nullable=True)    # primera entrega
+    last_delivered_at = Column(DateTime, nullable=True)
+    acked_at = Column(DateTime, nullable=True)
+    next_retry_at = Column(DateTime, nullable=True)
+    detail = Column(String(200), nullable=True)       # mensaje del dispositivo al confirmar
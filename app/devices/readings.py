@@ -0,0 +1,248 @@
+import os
+import threading
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Set
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+from app.database import SessionLocal
+from app.devices.models import DeviceIotReading
+
+# =======================================================
+# Almacén de series de tiempo para las lecturas de sensores
+# =======================================================
+
+READING_TABLE = DeviceIotReading.__tablename__
+
+# Meses por delante del actual cuyas particiones se crean en segundo plano
+READING_PARTITIONS_AHEAD   = int(os.getenv("READING_PARTITIONS_AHEAD", "2"))
+READING_PARTITION_INTERVAL = float(os.getenv("READING_PARTITION_INTERVAL", "3600"))   # s
+
+# Particiones mensuales ya verificadas en este proceso (ej. "2025_05"). Una partición
+# creada en una transacción sólo se agrega al confirmarla: si la transacción se revierte
+# el CREATE TABLE también, y la próxima inserción tiene que volver a crearla.
+# PartitionMaintainer las crea por adelantado en su propia transacción; el CREATE TABLE
+# dentro de la transacción de las lecturas queda sólo como respaldo (ej. lecturas con ts
+# fuera de ese rango), para no tomar bloqueos de DDL en la ruta de ingesta.
+_known_partitions: Set[str] = set()
+_partitions_lock = threading.Lock()
+_PENDING_KEY = "pending_reading_partitions"
+
+
+def _after_commit(session: Session) -> None:
+    created = session.info.pop(_PENDING_KEY, None)
+    if created:
+        with _partitions_lock:
+            _known_partitions.update(created)
+
+
+def _after_rollback(session: Session, previous_transaction=None) -> None:
+    session.info.pop(_PENDING_KEY, None)
+
+
+event.listen(Session, "after_commit", _after_commit)
+event.listen(Session, "after_soft_rollback", _after_rollback)
+
+
+def _month_bounds(ts: datetime):
+    """Devuelve el inicio del mes de ts y el inicio del mes siguiente."""
+    start = datetime(ts.year, ts.month, 1)
+    if ts.month == 12:
+        end = datetime(ts.year + 1, 1, 1)
+    else:
+        end = datetime(ts.year, ts.month + 1, 1)
+    return start, end
+
+
+def _partition_ddl(start: datetime, end: datetime) -> str:
+    return f"""
+        CREATE TABLE IF NOT EXISTS {READING_TABLE}_{start.strftime("%Y_%m")}
+        PARTITION OF {READING_TABLE}
+        FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')
+    """
+
+
+class ReadingStore:
+    """
+    Acceso a la tabla device_iot_reading.
+    No hace commit: las inserciones viajan en la transacción de quien lo usa.
+    """
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    def _is_postgres(self) -> bool:
+        return self.db.get_bind().dialect.name == "postgresql"
+
+    fallbacks = 0   # particiones creadas en la transacción de las lecturas
+
+    def ensure_partitions(self, timestamps: Iterable[datetime]) -> None:
+        """
+        Respaldo de PartitionMaintainer: crea en la transacción actual la partición mensual
+        de cada timestamp que falte; se verifica una sola vez por proceso después de que la
+        transacción que la creó confirma.
+        """
+        if not self._is_postgres():
+            return
+        for ts in timestamps:
+            start, end = _month_bounds(ts)
+            suffix = start.strftime("%Y_%m")
+            if suffix in _known_partitions:
+                continue
+            self.db.connection()  # asegura una transacción abierta para que commit/rollback la cierren
+            pending = self.db.info.setdefault(_PENDING_KEY, set())
+            if suffix in pending:
+                continue
+            self.db.execute(text(_partition_ddl(start, end)))
+            pending.add(suffix)
+            ReadingStore.fallbacks += 1
+            print(f"[lecturas] Partición {suffix} creada en la transacción de la ingesta")
+
+    def append(self, rows: List[Dict[str, Any]]) -> None:
+        """
+        Inserta lecturas en bloque. Cada fila: device_iot_id, ts, lot_id, sensor_value, data.
+        Una lectura repetida para el mismo (device_iot_id, ts) se ignora.
+        """
+        if not rows:
+            return
+        self.ensure_partitions({r["ts"] for r in rows})
+        table = DeviceIotReading.__table__
+        if self._is_postgres():
+            from sqlalchemy.dialects.postgresql import insert
+            stmt = insert(table).on_conflict_do_nothing(index_elements=["device_iot_id", "ts"])
+        else:
+            stmt = table.insert().prefix_with("OR IGNORE")
+        self.db.execute(stmt, rows)
+
+    def query(
+        self,
+        device_id: int,
+        start: datetime,
+        end: datetime,
+        bucket_seconds: Optional[int] = None,
+        limit: int = 1000
+    ) -> List[Dict[str, Any]]:
+        """
+        Lecturas de un dispositivo en [start, end).
+        Con bucket_seconds se reduce en el servidor a min/max/avg/count por intervalo.
+        """
+        params = {"device_id": device_id, "start": start, "end": end, "limit": limit}
+        if not bucket_seconds:
+            rows = self.db.execute(text(f"""
+                SELECT ts, sensor_value, data
+                  FROM {READING_TABLE}
+                 WHERE device_iot_id = :device_id
+                   AND ts >= :start AND ts < :end
+                 ORDER BY ts
+                 LIMIT :limit
+            """), params).fetchall()
+            return [
+                {"ts": r.ts, "sensor_value": r.sensor_value, "data": r.data}
+                for r in rows
+            ]
+
+        params["bucket"] = bucket_seconds
+        if self._is_postgres():
+            bucket_expr = (
+                "TIMESTAMP 'epoch' + FLOOR(EXTRACT(EPOCH FROM ts) / :bucket) * :bucket "
+                "* INTERVAL '1 second'"
+            )
+        else:
+            bucket_expr = "DATETIME((CAST(STRFTIME('%s', ts) AS INTEGER) / :bucket) * :bucket, 'unixepoch')"
+        rows = self.db.execute(text(f"""
+            SELECT {bucket_expr} AS bucket,
+                   COUNT(*)          AS samples,
+                   MIN(sensor_value) AS min_value,
+                   MAX(sensor_value) AS max_value,
+                   AVG(sensor_value) AS avg_value
+              FROM {READING_TABLE}
+             WHERE device_iot_id = :device_id
+               AND ts >= :start AND ts < :end
+             GROUP BY 1
+             ORDER BY 1
+             LIMIT :limit
+        """), params).fetchall()
+        return [
+            {
+                "bucket": r.bucket,
+                "samples": r.samples,
+                "min": r.min_value,
+                "max": r.max_value,
+                "avg": float(r.avg_value) if r.avg_value is not None else None
+            }
+            for r in rows
+        ]
+
+
+class PartitionMaintainer:
+    """
+    Crea en segundo plano la partición del mes actual y las de los próximos
+    READING_PARTITIONS_AHEAD meses, cada una en su propia transacción.
+    """
+
+    def __init__(self, ahead: int = READING_PARTITIONS_AHEAD, interval: float = READING_PARTITION_INTERVAL):
+        self.ahead = ahead
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self.created = 0
+        self.runs = 0
+
+    def ensure_upcoming(self, db: Session, now: Optional[datetime] = None) -> int:
+        """Crea las particiones que falten desde el mes de now. Devuelve cuántas verificó."""
+        if not ReadingStore(db)._is_postgres():
+            return 0
+        start, end = _month_bounds(now or datetime.now())
+        created = 0
+        for _ in range(self.ahead + 1):
+            suffix = start.strftime("%Y_%m")
+            if suffix not in _known_partitions:
+                db.execute(text(_partition_ddl(start, end)))
+                db.commit()
+                with _partitions_lock:
+                    _known_partitions.add(suffix)
+                created += 1
+            start, end = end, _month_bounds(end)[1]
+        self.created += created
+        self.runs += 1
+        return created
+
+    def _run_once(self) -> None:
+        db = SessionLocal()
+        try:
+            created = self.ensure_upcoming(db)
+            if created:
+                print(f"[lecturas] {created} particiones verificadas por adelantado")
+        except Exception as e:
+            db.rollback()
+            print("[lecturas] Error creando particiones por adelantado:", e)
+        finally:
+            db.close()
+
+    def run(self) -> None:
+        print("[lecturas] hilo de particiones iniciado")
+        self._run_once()
+        while not self._stop.wait(self.interval):
+            self._run_once()
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "known_partitions": sorted(_known_partitions),
+            "created_ahead": self.created,
+            "created_in_ingest": ReadingStore.fallbacks,
+            "runs": self.runs,
+            "months_ahead": self.ahead
+        }
+
+
+partition_maintainer = PartitionMaintainer()
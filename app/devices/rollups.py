@@ -0,0 +1,265 @@
+import argparse
+import sys
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+from sqlalchemy import and_, case, func, or_
+from sqlalchemy.orm import Session
+from app.devices.compression import CompressionConfig
+from app.devices.models import Device, DeviceIot, DeviceIotReading, DeviceReadingRollup
+
+# =======================================================
+# Rollups de lecturas (minuto / hora / día) por dispositivo y por lote
+# =======================================================
+#
+# Uso para reconstruir desde el histórico:
+#   python -m app.devices.rollups rebuild --start 2025-01-01 --end 2025-02-01
+# El histórico de los tipos con compresión sólo tiene los puntos guardados, no todas las
+# lecturas: sus rollups (y los de sus lotes) no se reconstruyen, se conservan los que hay.
+
+RESOLUTIONS: Dict[str, int] = {"minute": 60, "hour": 3600, "day": 86400}
+SCOPE_DEVICE = "device"
+SCOPE_LOT = "lot"
+SCOPES = (SCOPE_DEVICE, SCOPE_LOT)
+
+ROLLUP_TABLE = DeviceReadingRollup.__tablename__
+
+RollupKey = Tuple[str, int, int, datetime]
+
+
+def truncate(ts: datetime, resolution: int) -> datetime:
+    """Inicio del intervalo de ts (minuto, hora o día calendario)."""
+    if resolution >= 86400:
+        return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    if resolution >= 3600:
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(second=0, microsecond=0)
+
+
+class RollupStore:
+    """
+    Acceso a device_reading_rollup.
+    No hace commit (salvo rebuild): los agregados viajan en la transacción de la lectura.
+    """
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    def _is_postgres(self) -> bool:
+        return self.db.get_bind().dialect.name == "postgresql"
+
+    @staticmethod
+    def aggregate(rows: Iterable[Dict[str, Any]]) -> Dict[RollupKey, Dict[str, Any]]:
+        """Agrega en memoria filas del histórico (device_iot_id, ts, lot_id, sensor_value) por intervalo."""
+        out: Dict[RollupKey, Dict[str, Any]] = {}
+        for row in rows:
+            value = row.get("sensor_value")
+            if value is None:
+                continue
+            ts = row["ts"]
+            scopes = [(SCOPE_DEVICE, row["device_iot_id"])]
+            if row.get("lot_id") is not None:
+                scopes.append((SCOPE_LOT, row["lot_id"]))
+            for resolution in RESOLUTIONS.values():
+                bucket = truncate(ts, resolution)
+                for scope, scope_id in scopes:
+                    key = (scope, scope_id, resolution, bucket)
+                    agg = out.get(key)
+                    if agg is None:
+                        out[key] = {
+                            "scope": scope, "scope_id": scope_id, "resolution": resolution, "bucket": bucket,
+                            "samples": 1, "sum_value": value, "min_value": value, "max_value": value,
+                            "last_value": value, "last_ts": ts
+                        }
+                        continue
+                    agg["samples"] += 1
+                    agg["sum_value"] += value
+                    if value < agg["min_value"]:
+                        agg["min_value"] = value
+                    if value > agg["max_value"]:
+                        agg["max_value"] = value
+                    if ts >= agg["last_ts"]:
+                        agg["last_value"], agg["last_ts"] = value, ts
+        return out
+
+    def apply(self, rows: List[Dict[str, Any]]) -> None:
+        """Suma las lecturas a los rollups con un único upsert en bloque."""
+        if not rows:
+            return
+        aggregates = self.aggregate(rows)
+        if not aggregates:
+            return
+        table = DeviceReadingRollup.__table__
+        if self._is_postgres():
+            from sqlalchemy.dialects.postgresql import insert
+            least, greatest = func.least, func.greatest
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+            least, greatest = func.min, func.max
+        stmt = insert(table)
+        new = stmt.excluded
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["scope", "scope_id", "resolution", "bucket"],
+            set_={
+                "samples": table.c.samples + new.samples,
+                "sum_value": table.c.sum_value + new.sum_value,
+                "min_value": least(table.c.min_value, new.min_value),
+                "max_value": greatest(table.c.max_value, new.max_value),
+                "last_value": case((new.last_ts >= table.c.last_ts, new.last_value), else_=table.c.last_value),
+                "last_ts": greatest(table.c.last_ts, new.last_ts),
+            }
+        )
+        # Orden fijo de claves para que dos transacciones concurrentes no se bloqueen mutuamente
+        self.db.execute(stmt, [aggregates[k] for k in sorted(aggregates)])
+
+    def _compressed_devices(self) -> Tuple[Set[int], Set[int]]:
+        """(dispositivos, lotes) cuyo histórico está comprimido según la plantilla de su tipo."""
+        types = {
+            d.id for d in self.db.query(Device.id, Device.properties).all()
+            if CompressionConfig.from_properties(d.properties if isinstance(d.properties, dict) else None)
+        }
+        if not types:
+            return set(), set()
+        rows = self.db.query(DeviceIot.id, DeviceIot.lot_id).filter(DeviceIot.devices_id.in_(types)).all()
+        return {r.id for r in rows}, {r.lot_id for r in rows if r.lot_id is not None}
+
+    def rebuild(self, start: datetime, end: datetime) -> int:
+        """
+        Recalcula los rollups de [start, end) desde device_iot_reading, un día por transacción.
+        Se saltan los dispositivos con compresión del histórico y los lotes donde tienen
+        lecturas: rehacerlos con los puntos guardados perdería las lecturas descartadas.
+        """
+        compressed, compressed_lots = self._compressed_devices()
+        day = truncate(start, RESOLUTIONS["day"])
+        total = 0
+        while day < end:
+            next_day = day + timedelta(days=1)
+            rows = (
+                self.db.query(DeviceIotReading.device_iot_id, DeviceIotReading.ts,
+                              DeviceIotReading.lot_id, DeviceIotReading.sensor_value)
+                .filter(DeviceIotReading.ts >= day, DeviceIotReading.ts < next_day)
+                .order_by(DeviceIotReading.ts)
+                .all()
+            )
+            raw = [r._asdict() for r in rows if r.device_iot_id not in compressed]
+            skipped_lots = compressed_lots | {r.lot_id for r in rows if r.device_iot_id in compressed}
+            skipped_lots.discard(None)
+            for row in raw:
+                if row["lot_id"] in skipped_lots:
+                    row["lot_id"] = None  # cuenta para el dispositivo, no para el lote conservado
+            kept = []
+            if compressed:
+                kept.append(and_(DeviceReadingRollup.scope == SCOPE_DEVICE,
+                                 DeviceReadingRollup.scope_id.in_(compressed)))
+            if skipped_lots:
+                kept.append(and_(DeviceReadingRollup.scope == SCOPE_LOT,
+                                 DeviceReadingRollup.scope_id.in_(skipped_lots)))
+            delete = self.db.query(DeviceReadingRollup).filter(
+                DeviceReadingRollup.bucket >= day, DeviceReadingRollup.bucket < next_day
+            )
+            if kept:
+                delete = delete.filter(~or_(*kept))
+            delete.delete(synchronize_session=False)
+            self.apply(raw)
+            self.db.commit()
+            total += len(raw)
+            print(f"[rollups] {day.date()}: {len(raw)} lecturas, {len(rows) - len(raw)} comprimidas sin reconstruir")
+            day = next_day
+        return total
+
+    @staticmethod
+    def pick_resolution(start: datetime, end: datetime, resolution_seconds: Optional[int], limit: int) -> int:
+        """
+        Rollup más grueso que no supera la resolución pedida. Sin resolución, el más fino
+        que entrega hasta limit puntos en el rango; si ninguno alcanza, el diario.
+        """
+        levels = sorted(RESOLUTIONS.values(), reverse=True)
+        if resolution_seconds:
+            for level in levels:
+                if level <= resolution_seconds:
+                    return level
+            return levels[-1]
+        span = (end - start).total_seconds()
+        for level in reversed(levels):
+            if span / level <= limit:
+                return level
+        return levels[0]
+
+    def query(
+        self,
+        scope: str,
+        scope_id: int,
+        start: datetime,
+        end: datetime,
+        resolution_seconds: Optional[int] = None,
+        limit: int = 1000
+    ) -> Dict[str, Any]:
+        """
+        Serie agregada en [start, end) leída del rollup elegido. Si la resolución pedida es
+        más gruesa que el rollup, los intervalos se vuelven a agrupar en memoria.
+        """
+        level = self.pick_resolution(start, end, resolution_seconds, limit)
+        step = resolution_seconds if resolution_seconds and resolution_seconds > level else level
+        rows = (
+            self.db.query(DeviceReadingRollup)
+            .filter(DeviceReadingRollup.scope == scope,
+                    DeviceReadingRollup.scope_id == scope_id,
+                    DeviceReadingRollup.resolution == level,
+                    DeviceReadingRollup.bucket >= truncate(start, level),
+                    DeviceReadingRollup.bucket < end)
+            .order_by(DeviceReadingRollup.bucket)
+            .all()
+        )
+
+        points: List[Dict[str, Any]] = []
+        for r in rows:
+            if step == level:
+                bucket = r.bucket
+            else:
+                # Intervalos alineados a epoch, igual que /readings con bucket_seconds
+                epoch = int((r.bucket - datetime(1970, 1, 1)).total_seconds())
+                bucket = datetime(1970, 1, 1) + timedelta(seconds=epoch - epoch % step)
+            if points and points[-1]["bucket"] == bucket:
+                p = points[-1]
+                p["samples"] += r.samples
+                p["sum"] += r.sum_value
+                p["min"] = min(p["min"], r.min_value)
+                p["max"] = max(p["max"], r.max_value)
+                p["last"] = r.last_value
+                continue
+            if len(points) == limit:
+                break
+            points.append({
+                "bucket": bucket, "samples": r.samples, "sum": r.sum_value,
+                "min": r.min_value, "max": r.max_value, "last": r.last_value
+            })
+        for p in points:
+            p["avg"] = p["sum"] / p["samples"] if p["samples"] else None
+        return {"rollup_seconds": level, "bucket_seconds": step, "points": points}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from app.database import SessionLocal
+
+    parser = argparse.ArgumentParser(prog="python -m app.devices.rollups")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rebuild = sub.add_parser("rebuild", help="Reconstruir rollups desde device_iot_reading")
+    rebuild.add_argument("--start", type=datetime.fromisoformat, required=True)
+    rebuild.add_argument("--end", type=datetime.fromisoformat, default=None)
+    args = parser.parse_args(argv)
+
+    db = SessionLocal()
+    try:
+        end = args.end or datetime.now()
+        total = RollupStore(db).rebuild(args.start, end)
+        print(f"[rollups] reconstrucción terminada: {total} lecturas")
+        return 0
+    except Exception as e:
+        db.rollback()
+        print("[rollups] Error:", e)
+        return 1
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,32 @@
-from fastapi import APIRouter, Depends, Form, HTTPException, Query
+import json
+from fastapi import APIRouter, Depends, Form, HTTPException, Query, WebSocket
+from fastapi import Request as HttpRequest
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
 from sqlalchemy.orm import Session
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Union
 from datetime import datetime , timedelta
 from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 from app.devices.schemas import DeviceAssignRequest, DeviceReassignRequest
 from app.database import get_db
 from app.devices_request.models import Request , DeviceIoT
 from app.devices.services import DeviceService
+from app.devices.ingest_queue import reading_queue
+from app.devices.topology import lot_index
+from app.devices.volume_close import active_requests
+from app.devices.leak_rules import leak_detector
+from app.devices.templates import device_templates
+from app.devices.dedup import reading_dedup
+from app.command_bus import command_bus
+from app.device_channel import device_channels
+from app.command_tracker import command_tracker
+from app.servo_queue import SERVO_SSE_KEEPALIVE, SERVO_WAIT_MAX, SERVO_WAIT_TIMEOUT, servo_queues
+from app.transition_journal import transition_journal
+from app.device_twin import change_device_status, device_twin
+from app.devices.compression import history_compressor
+from app.devices.totalizer import meter_totalizer
+from app.devices.codec import PACKED_CONTENT_TYPE, decode_packed_reading, layout_from_properties
 from app.devices.models import User, Notification 
 from app.devices.schemas import (
     DeviceCreate, 
@@ -17,6 +37,7 @@ from app.devices.schemas import (
     DeviceFilter,
     DeviceIotReadingUpdateByLot,
     ServoCommand,
+    ServoCommandAck,
     ValveDevice
 )
 
@@ -155,14 +176,192 @@ def filter_devices(
 
         
 
-@router.post("/sensor_update_by_lot", response_model=Dict[str, Any])
+async def reading_payload(request: HttpRequest) -> Union[DeviceIotReadingUpdateByLot, bytes]:
+    """
+    Lectura JSON validada con el esquema, o el cuerpo crudo si llega en el formato
+    binario compacto (Content-Type: application/vnd.disriego.reading).
+    """
+    body = await request.body()
+    if request.headers.get("content-type", "").startswith(PACKED_CONTENT_TYPE):
+        return body
+    try:
+        return DeviceIotReadingUpdateByLot.model_validate_json(body)
+    except ValidationError as e:
+        errors = [{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)]
+        raise RequestValidationError(errors)
+
+
+@router.post(
+    "/sensor_update_by_lot",
+    response_model=Dict[str, Any],
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {
+                    "schema": {"$ref": "#/components/schemas/DeviceIotReadingUpdateByLot"}
+                },
+                PACKED_CONTENT_TYPE: {
+                    "schema": {"type": "string", "format": "binary"}
+                }
+            }
+        }
+    }
+)
 def update_sensor_data_by_lot(
-    reading: DeviceIotReadingUpdateByLot,
+    payload: Union[DeviceIotReadingUpdateByLot, bytes] = Depends(reading_payload),
     db: Session = Depends(get_db)
 ):
+    """
+    Recibe una lectura en JSON o en el formato binario compacto definido en app.devices.codec.
+    El layout binario se toma de Device.properties["packed_layout"] del tipo de dispositivo.
+    """
+    if isinstance(payload, bytes):
+        try:
+            fields = decode_packed_reading(
+                payload,
+                lambda devices_id, version: layout_from_properties(device_templates.get(db, devices_id), version)
+            )
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"success": False, "data": str(e)})
+        # Los campos ya vienen tipados desde el registro binario
+        reading = DeviceIotReadingUpdateByLot.model_construct(**fields)
+    else:
+        reading = payload
+
+    if reading_queue.enabled:
+        # Modo write-behind: se responde de inmediato y el hilo de volcado escribe en bloque
+        dedup_key = reading_dedup.key_for(reading.seq, reading.idempotency_key, reading.boot)
+        if dedup_key:
+            cached = reading_dedup.lookup(reading.device_id, dedup_key, reading.seq)
+            if cached is not None:
+                return JSONResponse(status_code=200, content=cached)
+        if not reading_queue.put(reading):
+            return JSONResponse(
+                status_code=503,
+                content={"success": False, "data": "Cola de ingesta llena, reintente más tarde"}
+            )
+        return JSONResponse(status_code=202, content={"success": True, "data": {"queued": True}})
     device_service = DeviceService(db)
     return device_service.update_device_reading_by_lot(reading)
 
+@router.get("/ingest/stats", response_model=Dict[str, Any])
+def get_ingest_stats():
+    """Estado de la cola de ingesta write-behind"""
+    return {"success": True, "data": reading_queue.stats()}
+
+@router.get("/topology/stats", response_model=Dict[str, Any])
+def get_topology_stats():
+    """Aciertos/fallos del índice en memoria lote → válvula/medidor"""
+    return {"success": True, "data": lot_index.stats()}
+
+@router.get("/leaks/stats", response_model=Dict[str, Any])
+def get_leak_detector_stats(db: Session = Depends(get_db)):
+    """Estado del motor de reglas de detección de fugas"""
+    return {"success": True, "data": leak_detector.stats(db)}
+
+@router.get("/compression/stats", response_model=Dict[str, Any])
+def get_compression_stats(db: Session = Depends(get_db)):
+    """Lecturas recibidas frente a puntos guardados en el histórico"""
+    return {"success": True, "data": history_compressor.stats(db)}
+
+@router.get("/totalizer/stats", response_model=Dict[str, Any])
+def get_totalizer_stats():
+    """Acumuladores de consumo en memoria y checkpoints realizados"""
+    return {"success": True, "data": meter_totalizer.stats()}
+
+@router.get("/volume-close/stats", response_model=Dict[str, Any])
+def get_volume_close_stats():
+    """Índice de requests vigentes y cierres automáticos por volumen"""
+    return {"success": True, "data": active_requests.stats()}
+
+@router.get("/dedup/stats", response_model=Dict[str, Any])
+def get_dedup_stats():
+    """Reintentos de lecturas descartados en memoria y en la ventana persistida"""
+    return {"success": True, "data": reading_dedup.stats()}
+
+@router.post("/sensor_update_by_lot/batch", response_model=Dict[str, Any])
+def update_sensor_data_by_lot_batch(
+    readings: List[DeviceIotReadingUpdateByLot],
+    db: Session = Depends(get_db)
+):
+    """
+    Aplica un arreglo de lecturas en una sola transacción y devuelve el resultado de cada una.
+    Pensado para gateways que acumulan lecturas durante cortes de conectividad.
+    """
+    device_service = DeviceService(db)
+    return device_service.update_device_readings_batch(readings)
+
+@router.get("/rollups/{scope}/{scope_id}", response_model=Dict[str, Any])
+def get_reading_rollups(
+    scope: str,
+    scope_id: int,
+    start: datetime = Query(...),
+    end: datetime = Query(...),
+    resolution_seconds: Optional[int] = Query(None, ge=60),
+    limit: int = Query(1000, ge=1, le=10000),
+    db: Session = Depends(get_db)
+):
+    """
+    Serie agregada (count/sum/min/max/last/avg) de un dispositivo o lote en [start, end).
+    - scope: "device" o "lot"
+    - resolution_seconds: resolución deseada; se usa el rollup más grueso (minuto/hora/día)
+      que no la supera. Sin ella se elige según el rango y limit.
+    """
+    device_service = DeviceService(db)
+    return device_service.get_reading_rollups(scope, scope_id, start, end, resolution_seconds, limit)
+
+@router.get("/timeline/lot/{lot_id}", response_model=Dict[str, Any])
+def get_lot_status_timeline(
+    lot_id: int,
+    start: datetime = Query(...),
+    end: datetime = Query(...),
+    db: Session = Depends(get_db)
+):
+    """
+    Intervalos de estado de los dispositivos del lote en [start, end) desde el journal de
+    transiciones, con los segundos de válvula abierta por dispositivo y por request.
+    """
+    device_service = DeviceService(db)
+    return device_service.get_status_timeline(start, end, lot_id=lot_id)
+
+@router.get("/timeline/{device_id}", response_model=Dict[str, Any])
+def get_device_status_timeline(
+    device_id: int,
+    start: datetime = Query(...),
+    end: datetime = Query(...),
+    db: Session = Depends(get_db)
+):
+    """Intervalos de estado de un dispositivo en [start, end) y segundos abierta por request"""
+    device_service = DeviceService(db)
+    return device_service.get_status_timeline(start, end, device_id=device_id)
+
+@router.get("/twin/stats", response_model=Dict[str, Any])
+def get_twin_stats():
+    """Aciertos, escrituras y correcciones del gemelo en memoria de device_iot"""
+    return {"success": True, "data": device_twin.stats()}
+
+@router.get("/journal/stats", response_model=Dict[str, Any])
+def get_journal_stats():
+    """Transiciones registradas, escritas en lotes y pendientes en el buffer"""
+    return {"success": True, "data": transition_journal.stats()}
+
+@router.get("/readings/{device_id}", response_model=Dict[str, Any])
+def get_device_readings(
+    device_id: int,
+    start: datetime = Query(...),
+    end: datetime = Query(...),
+    bucket_seconds: Optional[int] = Query(None, ge=1),
+    limit: int = Query(1000, ge=1, le=10000),
+    db: Session = Depends(get_db)
+):
+    """
+    Histórico de lecturas de un dispositivo en [start, end).
+    - bucket_seconds: si se envía, devuelve min/max/avg/count por intervalo en lugar de los puntos crudos
+    """
+    device_service = DeviceService(db)
+    return device_service.get_device_readings(device_id, start, end, bucket_seconds, limit)
+
 @router.get("/notifications/user/{user_id}", response_model=Dict[str, Any])
 def get_user_notifications(
     user_id: int, 
@@ -244,24 +443,140 @@ def mark_all_notifications_as_read(user_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=f"Error al marcar las notificaciones como leídas: {str(e)}")
 
 
-_servo_action: Dict[str, str] = {"action": None}
-
 @router.post("/devices/servo-command", response_model=Dict[str, str])
 def set_servo_command(command: ServoCommand):
     """
-    Establece el comando del servo. action debe ser "open" o "close".
+    Encola un comando para el servo del dispositivo. action debe ser "open" o "close".
     """
-    global _servo_action
     if command.action not in ("open", "close"):
         return {"error": "action debe ser 'open' o 'close'"}
-    _servo_action["action"] = command.action
-    return {"action": command.action}
+    published = command_bus.publish(command.device_id, command.action, source="http")
+    return {"action": command.action, "command_id": published.command_id}
 
 @router.get("/devices/servo-command", response_model=Dict[str, str])
-def get_servo_command():
-    cmd = _servo_action.get("action")
-    _servo_action["action"] = None
-    return {"action": cmd or ""}
+def get_servo_command(device_id: Optional[int] = Query(None), acks: bool = Query(False)):
+    """
+    Siguiente comando pendiente del dispositivo (FIFO, se borra al entregarlo).
+    Sin device_id se atiende la cola del firmware antiguo. Con acks=true el dispositivo
+    confirmará el comando con su command_id; si no lo hace, se le vuelve a enviar.
+    """
+    cmd = servo_queues.take(device_id, acks)
+    return cmd.to_dict() if cmd else {"action": ""}
+
+@router.get("/devices/servo-command/wait", response_model=Dict[str, str])
+async def wait_servo_command(
+    request: HttpRequest,
+    device_id: Optional[int] = Query(None),
+    timeout: float = Query(SERVO_WAIT_TIMEOUT, ge=0, le=SERVO_WAIT_MAX),
+    acks: bool = Query(False)
+):
+    """
+    Long-poll: responde en cuanto haya un comando para el dispositivo o, si no llega
+    ninguno, con action vacía al cumplirse timeout segundos. Si el cliente se desconectó
+    mientras esperaba, el comando recogido vuelve a la cola.
+    """
+    cmd = await servo_queues.wait_take(device_id, timeout, acks)
+    if cmd is None:
+        return {"action": ""}
+    if await request.is_disconnected():
+        servo_queues.requeue(device_id, [cmd])
+        return {"action": ""}
+    return cmd.to_dict()
+
+@router.get("/devices/servo-command/stream")
+async def stream_servo_commands(
+    request: HttpRequest,
+    device_id: Optional[int] = Query(None),
+    acks: bool = Query(False)
+):
+    """
+    Server-Sent Events: un evento "command" por cada comando del dispositivo y un
+    comentario keepalive cada SERVO_SSE_KEEPALIVE segundos sin comandos.
+    Un comando cuyo evento no se llegó a escribir (conexión cerrada) vuelve a la cola.
+    """
+    async def events():
+        unsent = None
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                cmd = await servo_queues.wait_take(device_id, SERVO_SSE_KEEPALIVE, acks)
+                if cmd is None:
+                    yield ": keepalive\n\n"
+                    continue
+                if await request.is_disconnected():
+                    servo_queues.requeue(device_id, [cmd])
+                    break
+                # El generador sólo continúa después de que el evento se escribió
+                unsent = cmd
+                yield f"event: command\ndata: {json.dumps({'device_id': device_id, **cmd.to_dict()})}\n\n"
+                unsent = None
+        finally:
+            if unsent is not None:
+                servo_queues.requeue(device_id, [unsent])
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@router.post("/devices/servo-command/{command_id}/ack", response_model=Dict[str, Any])
+def ack_servo_command(command_id: str, payload: ServoCommandAck, db: Session = Depends(get_db)):
+    """
+    Confirmación del dispositivo: result "ok" si ejecutó el comando, "error" si no pudo.
+    Repetir la confirmación no cambia nada (duplicate=true).
+    """
+    if payload.result not in ("ok", "error"):
+        raise HTTPException(status_code=400, detail="result debe ser 'ok' o 'error'")
+    try:
+        entry = command_tracker.ack(db, command_id, payload.device_id, payload.result == "ok", payload.detail)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Comando no encontrado")
+    return {"success": True, "data": entry}
+
+@router.get("/devices/servo-command/{command_id}", response_model=Dict[str, Any])
+def get_servo_command_status(command_id: str, db: Session = Depends(get_db)):
+    """Estado de un comando: entregas, confirmación y próximo reintento"""
+    entry = command_tracker.get(db, command_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Comando no encontrado")
+    return {"success": True, "data": entry}
+
+@router.websocket("/ws/{device_id}")
+async def device_channel(websocket: WebSocket, device_id: int, acks: bool = Query(False)):
+    """
+    Canal persistente del dispositivo: recibe lecturas (forma de DeviceIotReadingUpdateByLot
+    o {"readings": [...]}) y responde con un ack; envía los comandos del servo al llegar.
+    Con acks=true el dispositivo confirma cada comando con {"type": "command_ack", ...}.
+    """
+    await device_channels.serve(websocket, device_id, acks)
+
+@router.get("/ws/stats", response_model=Dict[str, Any])
+def get_device_channel_stats():
+    """Conexiones WebSocket abiertas y mensajes en cada sentido"""
+    return {"success": True, "data": device_channels.stats()}
+
+@router.get("/servo-command/stats", response_model=Dict[str, Any])
+def get_servo_queue_stats():
+    """Comandos encolados, entregados y vencidos de las colas por dispositivo"""
+    return {"success": True, "data": {**servo_queues.stats(), "tracking": command_tracker.stats()}}
+
+@router.get("/servo-command/latency", response_model=Dict[str, Any])
+def get_servo_command_latency(device_id: Optional[int] = Query(None), lot_id: Optional[int] = Query(None)):
+    """
+    Histogramas de latencia de los comandos (emisión → entrega → confirmación) de este
+    worker: de un dispositivo, de un lote o el resumen con los dispositivos lentos.
+    """
+    return {"success": True, "data": command_tracker.latency(device_id, lot_id)}
+
+@router.get("/servo-command/unacked", response_model=Dict[str, Any])
+def get_unacked_servo_commands(hours: float = Query(24, gt=0, le=24 * 30), db: Session = Depends(get_db)):
+    """Dispositivos con comandos que agotaron los reintentos sin confirmar (válvulas que no responden)"""
+    return {"success": True, "data": command_tracker.unacked_devices(db, hours)}
+
+@router.get("/commands/stats", response_model=Dict[str, Any])
+def get_command_bus_stats():
+    """Comandos publicados, despachados y descartados por el bus interno"""
+    return {"success": True, "data": command_bus.stats()}
 
 @router.post("/devices/open-valve", response_model=Dict[str, str])
 def open_valve(payload: ValveDevice, db: Session = Depends(get_db)):
@@ -279,13 +594,11 @@ def open_valve(payload: ValveDevice, db: Session = Depends(get_db)):
     )
     if not active_request:
         raise HTTPException(status_code=403, detail="No hay una solicitud activa en este momento.")
-    device = db.query(DeviceIoT).get(device_id)
-    if not device:
+    device = device_twin.get(db, device_id)
+    if not device or not change_device_status(db, device, 22, "api", request_id=active_request.id):
         raise HTTPException(status_code=404, detail="Dispositivo no encontrado.")
-    device.status = 22
+    command_bus.publish_after_commit(db, device_id, "open", source="api")
     db.commit()
-    db.refresh(device)
-    _servo_action["action"] = "open"
     return {"action": "open"}
 
 @router.post("/devices/close-valve", response_model=Dict[str, str])
@@ -304,13 +617,11 @@ def close_valve(payload: ValveDevice, db: Session = Depends(get_db)):
     )
     if not active_request:
         raise HTTPException(status_code=403, detail="No hay una solicitud activa en este momento.")
-    device = db.query(DeviceIoT).get(device_id)
-    if not device:
+    device = device_twin.get(db, device_id)
+    if not device or not change_device_status(db, device, 21, "api", request_id=active_request.id):
         raise HTTPException(status_code=404, detail="Dispositivo no encontrado.")
-    device.status = 21
+    command_bus.publish_after_commit(db, device_id, "close_manual", source="api")
     db.commit()
-    db.refresh(device)
-    _servo_action["action"] = "close_manual"
     return {"action": "close_manual"}
 
 
@@ -318,7 +629,8 @@ def close_valve(payload: ValveDevice, db: Session = Depends(get_db)):
 @router.get("/consumption/{device_id}", response_model=Dict[str, Any])
 def get_meter_consumption(device_id: int, db: Session = Depends(get_db)):
     """
-    Historial de volúmenes finales del medidor (tabla consumption_measurements).
+    Volumen consumido por request de la válvula, desde el totalizador en memoria
+    (se guarda periódicamente en consumption_measurements).
     """
     svc = DeviceService(db)
     return svc.get_meter_consumption(device_id)
@@ -326,7 +638,7 @@ def get_meter_consumption(device_id: int, db: Session = Depends(get_db)):
 @router.get("/meter/current/{device_id}", response_model=Dict[str, Any])
 def get_current_meter_reading(device_id: int, db: Session = Depends(get_db)):
     """
-    Lectura actual acumulada del medidor (campo data_devices.sensor_value).
+    Lectura actual acumulada del medidor (última sensor_value recibida).
     """
     svc = DeviceService(db)
     return svc.get_current_meter_reading(device_id)
\ No newline at end of file
@@ -109,6 +109,10 @@ class DeviceIotReadingUpdateByLot(BaseModel):
     lot_id: int
     device_type_id: int
     sensor_value: Optional[float] = None 
+    ts: Optional[datetime] = None  # Momento de la lectura (lecturas almacenadas en el gateway)
+    seq: Optional[int] = None  # Número de secuencia del dispositivo (deduplicación de reintentos)
+    idempotency_key: Optional[str] = Field(None, max_length=64)  # Alternativa a seq
+    boot: Optional[int] = None  # Contador de arranques del dispositivo (seq vuelve a empezar en cada uno)
 
     class Config:
         orm_mode = True
@@ -153,6 +157,13 @@ class NotificationResponse(NotificationBase):
 
 class ServoCommand(BaseModel):
     action: str
+    device_id: Optional[int] = Field(None, title="ID del dispositivo IoT (sin él va a la cola de firmware antiguo)")
+
+
+class ServoCommandAck(BaseModel):
+    device_id: Optional[int] = Field(None, title="ID del dispositivo IoT (si viene, debe ser el del comando)")
+    result: str = Field("ok", title="ok si ejecutó el comando, error si no pudo")
+    detail: Optional[str] = Field(None, title="Mensaje del dispositivo")
 
 
 class ValveDevice(BaseModel):
@@ -1,7 +1,7 @@
 from datetime import timedelta, datetime
 from typing import Dict, Any, Optional, List
 from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import text
+from sqlalchemy import bindparam, text, update
 from fastapi import HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.encoders import jsonable_encoder
@@ -23,7 +23,6 @@ from app.devices.models import (
     DeviceCategories,
     ConsumptionMeasurement,
 )
-
 from app.devices.schemas import (
     DeviceCreate,
     DeviceUpdate,
@@ -32,6 +31,26 @@ from app.devices.schemas import (
     DeviceIotReadingUpdateByLot,
     NotificationCreate
 )
+from app.devices.readings import ReadingStore
+from app.devices.rollups import RollupStore, SCOPES
+from app.devices.timeline import StatusTimeline
+from app.devices.topology import lot_index, VALVE_TYPE_ID, METER_TYPE_ID, DELETED_STATUS_ID
+from app.devices.leak_rules import leak_detector, FAILURE_TYPE_ID, MAINT_STATUS_ID
+from app.devices.dedup import reading_dedup, DUPLICATE_RESPONSE
+from app.devices.compression import history_compressor
+from app.devices.totalizer import meter_totalizer
+from app.devices.volume_close import active_requests
+from app.command_bus import command_bus
+from app.transition_journal import set_device_status
+from app.device_twin import DeviceState, change_device_status, device_twin
+
+# ─── Estados y tipos de falla ─────────────────────────────────────────────────
+STATUS_OPEN     = 22   # vars.id para “abierto”
+STATUS_FAILURE  = 26   # vars.id para “Fallo detectado”
+
+# Máximo de lecturas aceptadas por /sensor_update_by_lot/batch
+MAX_BATCH_READINGS = 5000
+
 
 
 
@@ -254,6 +273,7 @@ class DeviceService:
             self.db.add(new_device)
             self.db.commit()
             self.db.refresh(new_device)
+            lot_index.invalidate()
 
             return JSONResponse(
                 status_code=201,
@@ -295,6 +315,7 @@ class DeviceService:
                     setattr(device, key, value)
             self.db.commit()
             self.db.refresh(device)
+            lot_index.invalidate()
             return JSONResponse(
                 status_code=200,
                 content={
@@ -349,9 +370,10 @@ class DeviceService:
                 )
                 
             old_status = device.status
-            device.status = new_status
+            set_device_status(self.db, device, new_status, "status_change")
             self.db.commit()
             self.db.refresh(device)
+            lot_index.invalidate()
             
             # Si hay un lote asignado, notificamos al propietario del cambio de estado
             if device.lot_id:
@@ -445,10 +467,11 @@ class DeviceService:
             device.installation_date = assignment_data.installation_date
             device.maintenance_interval_id = assignment_data.maintenance_interval_id
             device.estimated_maintenance_date = assignment_data.estimated_maintenance_date
-            device.status = 12  # No Operativo
+            set_device_status(self.db, device, 12, "assign")  # No Operativo
 
             self.db.commit()
             self.db.refresh(device)
+            lot_index.invalidate()
 
            
             owner = (
@@ -533,6 +556,7 @@ class DeviceService:
 
             self.db.commit()
             self.db.refresh(device)
+            lot_index.invalidate()
 
            
             owner = (
@@ -575,9 +599,10 @@ class DeviceService:
                     status_code=404,
                     content={"success": False, "data": "Dispositivo no encontrado"}
                 )
-            deleted_status_id = 25  # Ajusta este valor según tu esquema de estados
-            device.status = deleted_status_id
+            deleted_status_id = DELETED_STATUS_ID
+            set_device_status(self.db, device, deleted_status_id, "delete")
             self.db.commit()
+            lot_index.invalidate()
             return JSONResponse(
                 status_code=200,
                 content={"success": True, "data": {"title": "Dispositivo eliminado", "message": "El dispositivo ha sido eliminado correctamente"}}
@@ -715,30 +740,318 @@ class DeviceService:
             self.db.add(new_device)
             self.db.commit()
             self.db.refresh(new_device)
+            lot_index.invalidate()
             return new_device
         except Exception as e:
             raise Exception(f"Error al insertar datos: {str(e)}")
         
 
+    @staticmethod
+    def _reading_row(device_id: int, lot_id: int, data: Dict[str, Any], ts: Optional[datetime] = None) -> Dict[str, Any]:
+        """Fila para device_iot_reading a partir de la lectura ya depurada"""
+        try:
+            sensor_value = float(data["sensor_value"]) if data.get("sensor_value") is not None else None
+        except (TypeError, ValueError):
+            sensor_value = None
+        return {
+            "device_iot_id": device_id,
+            "ts": ts or datetime.now(),
+            "lot_id": lot_id,
+            "sensor_value": sensor_value,
+            "data": data
+        }
+
+    def _lot_valve(self, lot_id: int, ctx: Dict[str, Dict]) -> Optional[DeviceState]:
+        """
+        Válvula del lote según el índice de topología. Su estado se lee de la base (no del
+        gemelo): decide si el flujo es una fuga y el gemelo de este worker puede ir atrasado.
+        """
+        valve_id = lot_index.valve_id(self.db, lot_id)
+        if valve_id is None:
+            return None
+        valves = ctx["valves"]
+        if valve_id not in valves:
+            valves[valve_id] = device_twin.load_many(self.db, [valve_id]).get(valve_id)
+        return valves[valve_id]
+
+    def _write_device_updates(self, devices: Dict[int, DeviceState], ctx: Dict[str, Dict]) -> None:
+        """Escribe en bloque lot_id/data_devices de las lecturas y los anota para el gemelo."""
+        updates = ctx.get("device_updates")
+        if not updates:
+            return
+        table = DeviceIot.__table__
+        rows = []
+        for device_id, values in sorted(updates.items()):
+            device = devices[device_id]
+            row = {"b_id": device_id,
+                   "lot_id": values.get("lot_id", device.lot_id),
+                   "data_devices": values.get("data_devices", device.data_devices)}
+            rows.append(row)
+            device_twin.stage(self.db, device_id, {"lot_id": row["lot_id"], "data_devices": row["data_devices"]},
+                              device.version)
+        self.db.execute(
+            update(table).where(table.c.id == bindparam("b_id"))
+                         .values(lot_id=bindparam("lot_id"), data_devices=bindparam("data_devices")),
+            rows
+        )
+
+    def _approved_request(self, valve_id: int, ctx: Dict[str, Dict]) -> Optional[Request]:
+        """Último request aprobado de la válvula, consultado una sola vez por válvula"""
+        requests_by_valve = ctx["requests"]
+        if valve_id not in requests_by_valve:
+            requests_by_valve[valve_id] = (
+                self.db.query(Request)
+                .filter(Request.device_iot_id == valve_id,
+                        Request.status == 17)  # aprobado
+                .order_by(Request.id.desc())
+                .first()
+            )
+        return requests_by_valve[valve_id]
+
+    def _consumption_measurement(self, request_id: int, ctx: Dict[str, Dict]) -> Optional[ConsumptionMeasurement]:
+        measurements = ctx["measurements"]
+        if request_id not in measurements:
+            measurements[request_id] = (
+                self.db.query(ConsumptionMeasurement)
+                .filter(ConsumptionMeasurement.request_id == request_id)
+                .first()
+            )
+        return measurements[request_id]
+
+    def _meter_sample(
+        self, meter_id: int, previous: Any, value: float, ts: datetime, lot_id: int, ctx: Dict[str, Dict]
+    ) -> tuple:
+        """Muestra para el totalizador: el incremento cuenta para el request aprobado si ts cae en su ventana"""
+        try:
+            previous = float(previous) if previous is not None else None
+        except (TypeError, ValueError):
+            previous = None
+        valve_id = lot_index.valve_id(self.db, lot_id)
+        request_obj = self._approved_request(valve_id, ctx) if valve_id is not None else None
+        if not meter_totalizer.in_window(request_obj, ts):
+            return (meter_id, previous, value, ts, None, valve_id)
+        return (meter_id, previous, value, ts, request_obj.id, valve_id)
+
+    def _late_meter_reading(self, meter_id: int, ts: datetime, ctx: Dict[str, Dict]) -> bool:
+        """Lectura de medidor más vieja que la última aplicada: no pisa data_devices ni suma consumo"""
+        applied = ctx.setdefault("meter_ts", {})
+        latest = applied.get(meter_id) or meter_totalizer.last_ts(meter_id)
+        if latest is not None and ts < latest:
+            return True
+        applied[meter_id] = ts
+        return False
+
+    def _after_readings_commit(self, ctx: Dict[str, Dict]) -> None:
+        """Estado en memoria que sólo se actualiza con la transacción ya confirmada"""
+        if ctx.get("topology_changed"):
+            lot_index.invalidate()
+        meter_totalizer.apply(ctx.get("meter_samples", ()))
+        for request_id, valve_id, final_volume, ts in ctx.get("final_volumes", ()):
+            meter_totalizer.sync_final_volume(request_id, valve_id, final_volume, ts)
+        if ctx.get("volume_checks"):
+            active_requests.evaluate(self.db, ctx["volume_checks"])
+
+    def _preload_reading_context(self, lot_ids: List[int], leak_lot_ids: List[int]) -> Dict[str, Dict]:
+        """
+        Carga en bloque las válvulas de los lotes con lecturas de medidor, los requests aprobados
+        y las mediciones de los lotes de un lote de lecturas, para no repetir las consultas
+        por cada lectura. La topología (lote → válvula) sale del índice en memoria.
+        """
+        ctx = {"valves": {}, "requests": {}, "measurements": {}}
+        valve_ids = sorted({
+            valve_id for valve_id in (lot_index.valve_id(self.db, lot_id) for lot_id in lot_ids)
+            if valve_id is not None
+        })
+        if not valve_ids:
+            return ctx
+
+        leak_valve_ids = {lot_index.valve_id(self.db, lot_id) for lot_id in leak_lot_ids} - {None}
+        if leak_valve_ids:
+            ctx["valves"] = {valve_id: None for valve_id in leak_valve_ids}
+            ctx["valves"].update(device_twin.load_many(self.db, leak_valve_ids))
+
+        ctx["requests"] = {valve_id: None for valve_id in valve_ids}
+        approved = (
+            self.db.query(Request)
+            .filter(Request.device_iot_id.in_(valve_ids),
+                    Request.status == 17)
+            .order_by(Request.id.desc())
+            .all()
+        )
+        for req in approved:
+            if ctx["requests"].get(req.device_iot_id) is None:
+                ctx["requests"][req.device_iot_id] = req
+
+        request_ids = [r.id for r in ctx["requests"].values() if r is not None]
+        ctx["measurements"] = {request_id: None for request_id in request_ids}
+        if request_ids:
+            for meas in (
+                self.db.query(ConsumptionMeasurement)
+                .filter(ConsumptionMeasurement.request_id.in_(request_ids))
+                .all()
+            ):
+                if ctx["measurements"].get(meas.request_id) is None:
+                    ctx["measurements"][meas.request_id] = meas
+        return ctx
+
+    def _apply_reading(self, data: Dict[str, Any], device: DeviceState, ctx: Dict[str, Dict]) -> List[Dict[str, Any]]:
+        """
+        Aplica una lectura sobre la sesión sin hacer commit. device es el registro del gemelo;
+        los cambios de lot_id/data_devices se juntan en ctx["device_updates"] y se escriben
+        en bloque con _write_device_updates.
+        Devuelve las filas a insertar en el histórico de lecturas (ya comprimido).
+        """
+        device_id = data.pop("device_id", None)
+        lot_id    = data.pop("lot_id", None)
+        d_type    = data.pop("device_type_id", None)
+        ts        = data.pop("ts", None) or datetime.now()
+        data.pop("seq", None)
+        data.pop("idempotency_key", None)
+        data.pop("boot", None)
+
+        # Valores vigentes: los del gemelo o los de una lectura anterior del mismo lote
+        pending = ctx.setdefault("device_updates", {}).get(device.id, {})
+        current_lot = pending.get("lot_id", device.lot_id)
+        current_data = pending.get("data_devices", device.data_devices)
+
+        # Asegurar lote
+        if current_lot != lot_id:
+            ctx["device_updates"].setdefault(device.id, {})["lot_id"] = lot_id
+            if device.devices_id in (VALVE_TYPE_ID, METER_TYPE_ID):
+                ctx["topology_changed"] = True
+
+        # Última lectura en data_devices (sólo si cambió y no es una lectura atrasada del medidor)
+        previous = current_data.get("sensor_value") if isinstance(current_data, dict) else None
+        late = d_type == METER_TYPE_ID and self._late_meter_reading(device.id, ts, ctx)
+        if current_data != data and not late:
+            ctx["device_updates"].setdefault(device.id, {})["data_devices"] = data
+
+        # Detección de fuga (sensor_value del medidor)
+        if d_type == METER_TYPE_ID and "sensor_value" in data:
+            try:
+                sensor_value = float(data["sensor_value"])
+                valid_value = True
+            except (TypeError, ValueError):
+                sensor_value = 0.0
+                valid_value = False
+
+            # Buscar válvula de este lote
+            valve = self._lot_valve(lot_id, ctx)
+
+            if valve:
+                # La evaluación se hace en bloque al final (motor de reglas de fuga)
+                ctx.setdefault("leak_samples", []).append(
+                    (valve.id, sensor_value, valve.status == STATUS_OPEN)
+                )
+
+            # Totalizador de consumo: se aplica en memoria después del commit
+            if valid_value and not late:
+                sample = self._meter_sample(device_id, previous, sensor_value, ts, lot_id, ctx)
+                ctx.setdefault("meter_samples", []).append(sample)
+                if sample[4] is not None:
+                    # Cierre por volumen: se evalúa con el acumulado ya confirmado
+                    ctx.setdefault("volume_checks", []).append((lot_id, sample[4]))
+
+        # Procesar final_volume si existe
+        if "final_volume" in data:
+            try:
+                final_volume = float(data["final_volume"])
+            except (TypeError, ValueError):
+                final_volume = 0.0
+            print(f"[final_volume] recibido {final_volume} L")
+
+            valve_id = lot_index.valve_id(self.db, lot_id)
+            if valve_id is None:
+                print(f"[final_volume] Lote {lot_id} sin válvula registrada")
+            else:
+                # Último request aprobado para esa válvula
+                request_obj = self._approved_request(valve_id, ctx)
+
+                if request_obj:
+                    meas = self._consumption_measurement(request_obj.id, ctx)
+                    if meas:
+                        if final_volume > 0 or meas.final_volume == 0:
+                            print(f"[final_volume] Req {request_obj.id}: {meas.final_volume} → {final_volume} L")
+                            meas.final_volume = final_volume
+                            ctx.setdefault("final_volumes", []).append((request_obj.id, valve_id, final_volume, ts))
+                    else:
+                        meas = ConsumptionMeasurement(
+                            request_id   = request_obj.id,
+                            final_volume = final_volume
+                        )
+                        self.db.add(meas)
+                        ctx["measurements"][request_obj.id] = meas
+                        ctx.setdefault("final_volumes", []).append((request_obj.id, valve_id, final_volume, ts))
+                        print(f"[final_volume] Guardado Req {request_obj.id}: {final_volume} L")
+                else:
+                    print(f"[final_volume] Sin request aprobado para válvula id={valve_id}")
+
+        # Rollups con todas las lecturas; la compresión del tipo decide qué puntos van al histórico
+        row = self._reading_row(device_id, lot_id, data, ts)
+        ctx.setdefault("rollup_rows", []).append(row)
+        return history_compressor.offer(self.db, device.devices_id, row)
+
+    def _process_leaks(self, ctx: Dict[str, Dict]) -> None:
+        """
+        Evalúa con el motor de reglas las muestras de fuga reunidas al aplicar las lecturas.
+        Sólo la apertura de un incidente genera el Request de cierre y el registro de maintenance.
+        """
+        samples = ctx.get("leak_samples")
+        if not samples:
+            return
+        opened, cleared = leak_detector.evaluate_batch(self.db, samples)
+        if not opened:
+            return
+
+        now = datetime.now()
+        maintenance_rows = []
+        for valve_id, sensor_value in opened:
+            valve = ctx["valves"].get(valve_id) or device_twin.load_many(self.db, [valve_id]).get(valve_id)
+            # a) Marcar estado de fallo, sólo si la válvula sigue como se leyó al decidir
+            if valve is None or not change_device_status(self.db, valve, STATUS_FAILURE, "leak", strict=True):
+                print(f"[fuga] Válvula {valve_id}: cambió de estado durante la evaluación, se descarta")
+                leak_detector.discard(self.db, [valve_id])
+                continue
+
+            # b) Cerrar la válvula (el comando sale al confirmar la transacción)
+            command_bus.publish_after_commit(self.db, valve.id, "close", source="leak")
+
+            # c) Crear un Request de cierre para la válvula
+            self.db.add(Request(
+                device_iot_id = valve.id,
+                lot_id        = valve.lot_id,
+                status        = 18,              # Pendiente
+                request_date  = now
+            ))
+
+            maintenance_rows.append({
+                "did":   valve.id,
+                "tfid":  FAILURE_TYPE_ID,
+                "desc":  f"Fuga detectada: {sensor_value:.3f} L con válvula cerrada",
+                "now":   now,
+                "msid":  MAINT_STATUS_ID
+            })
+            print(f"[FUGA] Device {valve.id}: estado {STATUS_FAILURE}, Request close creado y registro de maintenance insertado")
+
+        # d) Insertar registros en maintenance (SQL crudo, una sola sentencia)
+        if not maintenance_rows:
+            return
+        self.db.execute(text("""
+            INSERT INTO maintenance
+                (device_iot_id, type_failure_id, description_failure, date, maintenance_status_id)
+            VALUES
+                (:did, :tfid, :desc, :now, :msid)
+        """), maintenance_rows)
+
     def update_device_reading_by_lot(
             self, reading: DeviceIotReadingUpdateByLot
         ) -> Dict[str, Any]:
-            # ─── IDs de DeviceType ────────────────────────────────────────────────
-            VALVE_TYPE_ID   = 1    # válvula
-            METER_TYPE_ID   = 2    # medidor
-
-            # ─── Estados y tipos de falla ─────────────────────────────────────────
-            STATUS_OPEN     = 22   # vars.id para “abierto”
-            STATUS_FAILURE  = 26   # vars.id para “Fallo detectado”
-            FAILURE_TYPE_ID = 2    # type_failure.id para “Fuga”
-            MAINT_STATUS_ID = 24   # vars.id para “pendiente” en maintenance_status_id
-
+            ctx = {"valves": {}, "requests": {}, "measurements": {}}
             try:
                 # 1) Validación básica
                 data      = reading.dict()
                 device_id = data.get("device_id")
                 lot_id    = data.get("lot_id")
-                d_type    = data.get("device_type_id")
 
                 if device_id is None or lot_id is None:
                     return JSONResponse(
@@ -746,118 +1059,46 @@ class DeviceService:
                         content={"success": False, "data": "Faltan device_id o lot_id"}
                     )
 
-                device = self.db.query(DeviceIot).get(device_id)
+                # Reintento ya aplicado: se responde desde memoria sin tocar la base
+                seq = data.get("seq")
+                dedup_key = reading_dedup.key_for(seq, data.get("idempotency_key"), data.get("boot"))
+                if dedup_key:
+                    cached = reading_dedup.lookup(device_id, dedup_key, seq)
+                    if cached is not None:
+                        return JSONResponse(status_code=200, content=cached)
+
+                if data.get("device_type_id") == METER_TYPE_ID and data.get("sensor_value") is not None:
+                    # Como en el lote: la lectura anterior del medidor sale de su fila, bloqueada hasta el commit
+                    device = device_twin.load_many(self.db, [device_id], for_update=True).get(device_id)
+                else:
+                    device = device_twin.get(self.db, device_id)
                 if not device:
                     return JSONResponse(
                         status_code=404,
                         content={"success": False, "data": "Dispositivo no encontrado"}
                     )
 
-                # 2) Asegurar lote
-                if device.lot_id != lot_id:
-                    device.lot_id = lot_id
-
-                # 3) Guardar lecturas crudas
-                for key in ("device_id", "lot_id", "device_type_id"):
-                    data.pop(key, None)
-                device.data_devices = data
-
-                # 4) Detección de fuga (sensor_value del medidor)
-                if d_type == METER_TYPE_ID and "sensor_value" in data:
-                    try:
-                        sensor_value = float(data["sensor_value"])
-                    except (TypeError, ValueError):
-                        sensor_value = 0.0
-
-                    # Buscar válvula de este lote
-                    valve = (
-                        self.db.query(DeviceIot)
-                        .filter(DeviceIot.lot_id == lot_id,
-                                DeviceIot.devices_id == VALVE_TYPE_ID)
-                        .first()
-                    )
+                # Reintento registrado en la ventana persistida (ej. tras reiniciar el proceso)
+                if dedup_key and not reading_dedup.claim(self.db, [(device_id, dedup_key, seq)]):
+                    self.db.rollback()
+                    return JSONResponse(status_code=200, content=DUPLICATE_RESPONSE)
 
-                    if valve and sensor_value > 0 and valve.status != STATUS_OPEN:
-                        # a) Marcar estado de fallo
-                        valve.status = STATUS_FAILURE
+                # 2) Aplicar lectura (lote, data_devices, fuga, final_volume) y guardar histórico
+                rows = self._apply_reading(data, device, ctx)
+                self._write_device_updates({device_id: device}, ctx)
+                self._process_leaks(ctx)
+                meter_totalizer.mark_final_volumes(self.db, ctx.get("final_volumes", ()))
+                ReadingStore(self.db).append(rows)
+                RollupStore(self.db).apply(ctx.get("rollup_rows", []))
 
-                        # b) Crear un Request de cierre para la válvula
-                        cierre = Request(
-                            device_iot_id = valve.id,
-                            action        = "close",
-                            status        = 18,              # Pendiente
-                            created_at    = datetime.now()
-                        )
-                        self.db.add(cierre)
-
-                        # c) Insertar registro en maintenance (SQL crudo)
-                        sql = text("""
-                            INSERT INTO maintenance
-                                (device_iot_id, type_failure_id, description_failure, date, maintenance_status_id)
-                            VALUES
-                                (:did, :tfid, :desc, :now, :msid)
-                        """)
-                        self.db.execute(sql, {
-                            "did":   valve.id,
-                            "tfid":  FAILURE_TYPE_ID,
-                            "desc":  f"Fuga detectada: {sensor_value:.3f} L con válvula cerrada",
-                            "now":   datetime.now(),
-                            "msid":  MAINT_STATUS_ID
-                        })
-                        print(f"[FUGA] Device {valve.id}: estado {STATUS_FAILURE}, Request close creado y registro de maintenance insertado")
-
-                # 5) Procesar final_volume si existe
-                if "final_volume" in data:
-                    try:
-                        final_volume = float(data["final_volume"])
-                    except (TypeError, ValueError):
-                        final_volume = 0.0
-                    print(f"[final_volume] recibido {final_volume} L")
-
-                    valve = (
-                        self.db.query(DeviceIot)
-                        .filter(DeviceIot.lot_id == lot_id,
-                                DeviceIot.devices_id == VALVE_TYPE_ID)
-                        .first()
-                    )
-                    if not valve:
-                        print(f"[final_volume] Lote {lot_id} sin válvula registrada")
-                    else:
-                        # Último request aprobado para esa válvula
-                        request_obj = (
-                            self.db.query(Request)
-                            .filter(Request.device_iot_id == valve.id,
-                                    Request.status == 17)  # aprobado
-                            .order_by(Request.id.desc())
-                            .first()
-                        )
-
-                        if request_obj:
-                            meas = (
-                                self.db.query(ConsumptionMeasurement)
-                                .filter(ConsumptionMeasurement.request_id == request_obj.id)
-                                .first()
-                            )
-                            if meas:
-                                if final_volume > 0 or meas.final_volume == 0:
-                                    print(f"[final_volume] Req {request_obj.id}: {meas.final_volume} → {final_volume} L")
-                                    meas.final_volume = final_volume
-                            else:
-                                self.db.add(ConsumptionMeasurement(
-                                    request_id   = request_obj.id,
-                                    final_volume = final_volume
-                                ))
-                                print(f"[final_volume] Guardado Req {request_obj.id}: {final_volume} L")
-                        else:
-                            print(f"[final_volume] Sin request aprobado para válvula id={valve.id}")
-
-                # 6) Commit y refresco
+                # 3) Commit; la respuesta sale del gemelo ya actualizado
                 self.db.commit()
-                self.db.refresh(device)
-                return JSONResponse(
-                    status_code=200,
-                    content={"success": True, "data": jsonable_encoder(device)}
-                )
+                self._after_readings_commit(ctx)
+                device = device_twin.get(self.db, device_id)
+                content = {"success": True, "data": jsonable_encoder(device.to_dict() if device else None)}
+                if dedup_key:
+                    reading_dedup.remember(device_id, dedup_key, seq, content)
+                return JSONResponse(status_code=200, content=content)
 
             except Exception as e:
                 self.db.rollback()
@@ -869,6 +1110,122 @@ class DeviceService:
                     }
                 )
 
+    def apply_readings_batch(self, readings: List[DeviceIotReadingUpdateByLot]) -> List[Dict[str, Any]]:
+        """
+        Núcleo de la ingesta en bloque: aplica las lecturas, inserta el histórico y hace commit.
+        Lanza la excepción si falla la transacción. Devuelve un resultado por lectura.
+        """
+        payloads = [r.dict() for r in readings]
+        device_ids = {p["device_id"] for p in payloads if p.get("device_id") is not None}
+        devices = device_twin.get_many(self.db, device_ids) if device_ids else {}
+        meter_payloads = [
+            p for p in payloads
+            if p.get("device_type_id") == METER_TYPE_ID and p.get("sensor_value") is not None
+        ]
+        # Los incrementos del totalizador salen de la lectura anterior confirmada del medidor:
+        # la fila se lee de la base y queda bloqueada hasta el commit de este lote
+        devices.update(device_twin.load_many(
+            self.db, {p["device_id"] for p in meter_payloads if p.get("device_id") is not None}, for_update=True
+        ))
+        lot_ids = sorted({p["lot_id"] for p in payloads if p.get("lot_id") is not None})
+        leak_lot_ids = sorted({p["lot_id"] for p in meter_payloads if p.get("lot_id") is not None})
+        ctx = self._preload_reading_context(lot_ids, leak_lot_ids)
+        # Estado de la compresión de los dispositivos del lote, bloqueado hasta el commit
+        history_compressor.load(self.db, [
+            d.id for d in devices.values() if history_compressor.compressed(self.db, d.devices_id)
+        ])
+
+        # Reintentos: descartar los ya vistos en memoria, repetidos dentro del lote
+        # o ya registrados en la ventana persistida (un solo INSERT para todo el lote)
+        keys = [reading_dedup.key_for(p.get("seq"), p.get("idempotency_key"), p.get("boot")) for p in payloads]
+        duplicates = set()
+        to_claim: Dict[Any, int] = {}
+        for index, (data, key) in enumerate(zip(payloads, keys)):
+            device_id = data.get("device_id")
+            if not key or device_id not in devices:
+                continue
+            if (device_id, key) in to_claim or reading_dedup.lookup(device_id, key, data.get("seq")) is not None:
+                duplicates.add(index)
+            else:
+                to_claim[(device_id, key)] = index
+        accepted = reading_dedup.claim(
+            self.db, [(d, k, payloads[i].get("seq")) for (d, k), i in to_claim.items()]
+        )
+        duplicates.update(i for pair, i in to_claim.items() if pair not in accepted)
+
+        results: List[Dict[str, Any]] = []
+        history: List[Dict[str, Any]] = []
+        for index, data in enumerate(payloads):
+            device_id = data.get("device_id")
+            if device_id is None or data.get("lot_id") is None:
+                results.append({"index": index, "device_id": device_id, "success": False,
+                                "status": 400, "message": "Faltan device_id o lot_id"})
+                continue
+            device = devices.get(device_id)
+            if not device:
+                results.append({"index": index, "device_id": device_id, "success": False,
+                                "status": 404, "message": "Dispositivo no encontrado"})
+                continue
+            if index in duplicates:
+                results.append({"index": index, "device_id": device_id, "success": True,
+                                "status": 200, "duplicate": True})
+                continue
+            history.extend(self._apply_reading(data, device, ctx))
+            results.append({"index": index, "device_id": device_id, "success": True, "status": 200})
+
+        self._write_device_updates(devices, ctx)
+        self._process_leaks(ctx)
+        meter_totalizer.mark_final_volumes(self.db, ctx.get("final_volumes", ()))
+        ReadingStore(self.db).append(history)
+        RollupStore(self.db).apply(ctx.get("rollup_rows", []))
+        self.db.commit()
+        for (device_id, key), index in to_claim.items():
+            if index not in duplicates:
+                reading_dedup.remember(device_id, key, payloads[index].get("seq"), DUPLICATE_RESPONSE)
+        self._after_readings_commit(ctx)
+
+        return results
+
+    def update_device_readings_batch(
+            self, readings: List[DeviceIotReadingUpdateByLot]
+        ) -> JSONResponse:
+            """
+            Aplica un lote de lecturas en una sola transacción.
+            Las consultas de dispositivos, válvulas, requests y mediciones se hacen en bloque
+            y el histórico se inserta con una sola sentencia. Devuelve un resultado por lectura.
+            """
+            if len(readings) > MAX_BATCH_READINGS:
+                return JSONResponse(
+                    status_code=413,
+                    content={
+                        "success": False,
+                        "data": f"El lote supera el máximo de {MAX_BATCH_READINGS} lecturas"
+                    }
+                )
+            try:
+                results = self.apply_readings_batch(readings)
+                applied = sum(1 for r in results if r["success"])
+                return JSONResponse(
+                    status_code=200,
+                    content={
+                        "success": True,
+                        "data": {
+                            "received": len(results),
+                            "applied": applied,
+                            "failed": len(results) - applied,
+                            "results": results
+                        }
+                    }
+                )
+            except Exception as e:
+                self.db.rollback()
+                return JSONResponse(
+                    status_code=500,
+                    content={
+                        "success": False,
+                        "data": {"title": "Error al actualizar lecturas en lote", "message": str(e)}
+                    }
+                )
 
 
 
@@ -997,28 +1354,125 @@ class DeviceService:
             )
         
     def get_meter_consumption(self, device_iot_id: int) -> JSONResponse:
-        measurements = (
-            self.db.query(ConsumptionMeasurement)
-                   .join(Request, ConsumptionMeasurement.request_id == Request.id)
-                   .filter(Request.device_iot_id == device_iot_id)
-                   .order_by(ConsumptionMeasurement.created_at.desc())
-                   .all()
-        )
-        data = [
-            {
-                "request_id": m.request_id,
-                "final_volume": float(m.final_volume),
-                "timestamp": m.created_at.isoformat()
-            }
-            for m in measurements
-        ]
+        # Acumulados del totalizador (incluye lo aún no guardado en consumption_measurements)
+        data = meter_totalizer.consumption(self.db, device_iot_id)
         return JSONResponse(status_code=200, content={"success": True, "data": data})
 
     def get_current_meter_reading(self, device_id: int) -> JSONResponse:
-        device = self.db.query(DeviceIot).get(device_id)
-        if not device:
+        found, value = meter_totalizer.current(self.db, device_id)
+        if not found:
             return JSONResponse(status_code=404, content={"success": False, "message": "Medidor no encontrado"})
-        value = None
-        if device.data_devices and "sensor_value" in device.data_devices:
-            value = device.data_devices["sensor_value"]
-        return JSONResponse(status_code=200, content={"success": True, "data": {"sensor_value": value}})
\ No newline at end of file
+        return JSONResponse(status_code=200, content={"success": True, "data": {"sensor_value": value}})
+
+    def get_device_readings(
+        self,
+        device_id: int,
+        start: datetime,
+        end: datetime,
+        bucket_seconds: Optional[int] = None,
+        limit: int = 1000
+    ) -> JSONResponse:
+        """Histórico de lecturas de un dispositivo, opcionalmente agregado por intervalos"""
+        try:
+            if start >= end:
+                return JSONResponse(
+                    status_code=400,
+                    content={"success": False, "data": "El rango de fechas no es válido"}
+                )
+            points = ReadingStore(self.db).query(device_id, start, end, bucket_seconds, limit)
+            return JSONResponse(
+                status_code=200,
+                content={
+                    "success": True,
+                    "data": {
+                        "device_id": device_id,
+                        "bucket_seconds": bucket_seconds,
+                        "points": jsonable_encoder(points)
+                    }
+                }
+            )
+        except Exception as e:
+            return JSONResponse(
+                status_code=500,
+                content={
+                    "success": False,
+                    "data": {"title": "Error al obtener lecturas", "message": str(e)}
+                }
+            )
+
+    def get_status_timeline(
+        self,
+        start: datetime,
+        end: datetime,
+        device_id: Optional[int] = None,
+        lot_id: Optional[int] = None
+    ) -> JSONResponse:
+        """Intervalos de estado y tiempo con la válvula abierta (total, por dispositivo y por request)"""
+        try:
+            if start >= end:
+                return JSONResponse(
+                    status_code=400,
+                    content={"success": False, "data": "El rango de fechas no es válido"}
+                )
+            timeline = StatusTimeline(self.db)
+            intervals = timeline.intervals(start, end, device_id=device_id, lot_id=lot_id)
+            scope = {"device_iot_id": device_id} if device_id is not None else {"lot_id": lot_id}
+            return JSONResponse(
+                status_code=200,
+                content={
+                    "success": True,
+                    "data": jsonable_encoder({
+                        **scope,
+                        "start": start,
+                        "end": end,
+                        **timeline.open_durations(intervals),
+                        "intervals": intervals
+                    })
+                }
+            )
+        except Exception as e:
+            return JSONResponse(
+                status_code=500,
+                content={
+                    "success": False,
+                    "data": {"title": "Error al obtener la línea de tiempo", "message": str(e)}
+                }
+            )
+
+    def get_reading_rollups(
+        self,
+        scope: str,
+        scope_id: int,
+        start: datetime,
+        end: datetime,
+        resolution_seconds: Optional[int] = None,
+        limit: int = 1000
+    ) -> JSONResponse:
+        """Serie agregada de un dispositivo o lote desde el rollup más grueso que cumple la resolución"""
+        try:
+            if scope not in SCOPES:
+                return JSONResponse(
+                    status_code=400,
+                    content={"success": False, "data": f"scope debe ser uno de {', '.join(SCOPES)}"}
+                )
+            if start >= end:
+                return JSONResponse(
+                    status_code=400,
+                    content={"success": False, "data": "El rango de fechas no es válido"}
+                )
+            series = RollupStore(self.db).query(scope, scope_id, start, end, resolution_seconds, limit)
+            return JSONResponse(
+                status_code=200,
+                content={
+                    "success": True,
+                    "data": {"scope": scope, "scope_id": scope_id, **jsonable_encoder(series)}
+                }
+            )
+        except Exception as e:
+            return JSONResponse(
+                status_code=500,
+                content={
+                    "success": False,
+                    "data": {"title": "Error al obtener agregados", "message": str(e)}
+                }
+            )
@@ -0,0 +1,67 @@
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app.devices.models import Device
+
+# Tiempo máximo que una plantilla vive en caché (cubre cambios de otros workers o hechos fuera de la API)
+TEMPLATE_TTL = float(os.getenv("TEMPLATE_TTL", "300"))
+
+_PENDING_KEY = "pending_template_invalidations"
+
+
+class DeviceTemplateCache:
+    """
+    Caché en memoria de Device.properties (plantilla por tipo de dispositivo).
+    Las plantillas cambian muy poco; se consultan una vez y se guardan por devices.id.
+    Toda escritura de Device por ORM invalida su plantilla al confirmar la transacción.
+    """
+
+    def __init__(self, ttl: float = TEMPLATE_TTL):
+        self.ttl = ttl
+        self._properties: Dict[int, Tuple[Optional[Dict[str, Any]], float]] = {}
+        self._lock = threading.Lock()
+        self.invalidations = 0
+
+    def get(self, db: Session, devices_id: int) -> Optional[Dict[str, Any]]:
+        cached = self._properties.get(devices_id)
+        if cached is not None and time.monotonic() - cached[1] < self.ttl:
+            return cached[0]
+        device = db.get(Device, devices_id)
+        properties = device.properties if device and isinstance(device.properties, dict) else None
+        with self._lock:
+            self._properties[devices_id] = (properties, time.monotonic())
+        return properties
+
+    def invalidate(self, devices_id: Optional[int] = None) -> None:
+        with self._lock:
+            if devices_id is None:
+                self._properties.clear()
+            else:
+                self._properties.pop(devices_id, None)
+            self.invalidations += 1
+
+    # ── Hooks de la sesión ──────────────────────────────────
+    def _after_flush(self, session: Session, flush_context) -> None:
+        changed = {
+            obj.id for obj in (*session.new, *session.dirty, *session.deleted)
+            if isinstance(obj, Device) and obj.id is not None
+        }
+        if changed:
+            session.info.setdefault(_PENDING_KEY, set()).update(changed)
+
+    def _after_commit(self, session: Session) -> None:
+        for devices_id in session.info.pop(_PENDING_KEY, ()):
+            self.invalidate(devices_id)
+
+    def _after_rollback(self, session: Session, previous_transaction=None) -> None:
+        session.info.pop(_PENDING_KEY, None)
+
+
+device_templates = DeviceTemplateCache()
+
+event.listen(Session, "after_flush", device_templates._after_flush)
+event.listen(Session, "after_commit", device_templates._after_commit)
+event.listen(Session, "after_soft_rollback", device_templates._after_rollback)
@@ -0,0 +1,117 @@
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from sqlalchemy import DateTime, Integer, String, bindparam, text
+from sqlalchemy.orm import Session
+from app.devices.models import DeviceStatusTransition
+
+# =======================================================
+# Línea de tiempo de estados desde device_status_transition
+# =======================================================
+#
+# Cada fila abre un intervalo en su estado to_status que termina en la siguiente fila
+# del mismo dispositivo (LEAD sobre el índice (device_iot_id, ts)). Para un rango
+# [start, end) se leen las filas del rango más la última anterior a start de cada
+# dispositivo, que da el estado en que el rango empieza.
+
+JOURNAL_TABLE = DeviceStatusTransition.__tablename__
+STATUS_OPEN = 22
+
+_INTERVALS_SQL = """
+    WITH scope_devices AS (
+        {devices}
+    ),
+    boundary AS (
+        SELECT s.device_iot_id,
+               (SELECT MAX(p.ts) FROM {table} p
+                 WHERE p.device_iot_id = s.device_iot_id AND p.ts <= :start) AS since
+          FROM scope_devices s
+    ),
+    journal AS (
+        SELECT t.id, t.device_iot_id, t.lot_id, t.request_id, t.from_status, t.to_status, t.source, t.ts,
+               LEAD(t.ts) OVER (PARTITION BY t.device_iot_id ORDER BY t.ts, t.id) AS ended_at
+          FROM {table} t
+          JOIN boundary b ON b.device_iot_id = t.device_iot_id
+         WHERE t.ts >= COALESCE(b.since, :start) AND t.ts < :end
+    )
+    SELECT device_iot_id, lot_id, request_id, from_status, to_status, source, ts, ended_at
+      FROM journal
+     WHERE ended_at IS NULL OR ended_at > :start
+     ORDER BY device_iot_id, ts, id
+"""
+
+_DEVICE_SCOPE = "SELECT CAST(:device_id AS INTEGER) AS device_iot_id"
+# Dispositivos que hoy están en el lote o que registraron transiciones en él durante el rango
+_LOT_SCOPE = f"""
+        SELECT id AS device_iot_id FROM device_iot WHERE lot_id = :lot_id
+        UNION
+        SELECT device_iot_id FROM {JOURNAL_TABLE} WHERE lot_id = :lot_id AND ts >= :start AND ts < :end
+"""
+
+
+def _intervals_sql(devices: str):
+    return text(_INTERVALS_SQL.format(devices=devices, table=JOURNAL_TABLE)).bindparams(
+        bindparam("start", type_=DateTime), bindparam("end", type_=DateTime)
+    ).columns(
+        device_iot_id=Integer, lot_id=Integer, request_id=Integer, from_status=Integer,
+        to_status=Integer, source=String, ts=DateTime, ended_at=DateTime
+    )
+
+
+DEVICE_INTERVALS_SQL = _intervals_sql(_DEVICE_SCOPE)
+LOT_INTERVALS_SQL = _intervals_sql(_LOT_SCOPE)
+
+
+class StatusTimeline:
+    """Consultas de intervalos de estado y duración de apertura de válvulas."""
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    def intervals(
+        self,
+        start: datetime,
+        end: datetime,
+        device_id: Optional[int] = None,
+        lot_id: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """Intervalos de estado recortados a [start, min(end, ahora)) de un dispositivo o de un lote."""
+        if device_id is not None:
+            rows = self.db.execute(DEVICE_INTERVALS_SQL, {"device_id": device_id, "start": start, "end": end})
+        else:
+            rows = self.db.execute(LOT_INTERVALS_SQL, {"lot_id": lot_id, "start": start, "end": end})
+        horizon = min(end, datetime.now())
+        out = []
+        for r in rows:
+            began = max(r.ts, start)
+            ended = min(r.ended_at, end) if r.ended_at is not None else horizon
+            out.append({
+                "device_iot_id": r.device_iot_id,
+                "lot_id": r.lot_id,
+                "request_id": r.request_id,
+                "status": r.to_status,
+                "from_status": r.from_status,
+                "source": r.source,
+                "started_at": began,
+                "ended_at": ended,
+                "seconds": max(0.0, (ended - began).total_seconds())
+            })
+        return out
+
+    @staticmethod
+    def open_durations(intervals: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Segundos en estado Abierta (22) en total, por dispositivo y por request."""
+        by_device: Dict[int, float] = {}
+        by_request: Dict[int, float] = {}
+        total = 0.0
+        for i in intervals:
+            if i["status"] != STATUS_OPEN:
+                continue
+            total += i["seconds"]
+            by_device[i["device_iot_id"]] = by_device.get(i["device_iot_id"], 0.0) + i["seconds"]
+            if i["request_id"] is not None:
+                by_request[i["request_id"]] = by_request.get(i["request_id"], 0.0) + i["seconds"]
+        return {
+            "open_seconds": round(total, 3),
+            "by_device": [{"device_iot_id": k, "open_seconds": round(v, 3)} for k, v in sorted(by_device.items())],
+            "by_request": [{"request_id": k, "open_seconds": round(v, 3)} for k, v in sorted(by_request.items())]
+        }
@@ -0,0 +1,111 @@
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+from sqlalchemy.orm import Session
+from app.devices.models import DeviceIot
+
+# ─── IDs de DeviceType (tabla devices) ────────────────────────────────────────
+VALVE_TYPE_ID   = 1    # válvula
+METER_TYPE_ID   = 2    # medidor
+
+DELETED_STATUS_ID = 25  # borrado lógico: el dispositivo ya no atiende su lote
+
+# Tiempo máximo que el índice vive sin recargarse (cubre cambios hechos por otros workers)
+TOPOLOGY_TTL = float(os.getenv("TOPOLOGY_TTL", "300"))
+
+
+class LotTopologyIndex:
+    """
+    Índice en memoria lote → válvula y lote → medidor.
+    Se carga con una sola consulta y se invalida en cada cambio de dispositivos
+    (crear, actualizar, cambiar estado, asignar, reasignar, eliminar), de modo que la
+    ruta de lecturas no consulte la topología en cada lectura.
+    La recarga es de a un hilo: mientras uno recarga, los demás siguen con el índice
+    anterior (o esperan si todavía no hay ninguno).
+    """
+
+    def __init__(self, ttl: float = TOPOLOGY_TTL):
+        self.ttl = ttl
+        self._valves: Dict[int, int] = {}
+        self._meters: Dict[int, int] = {}
+        self._loaded_at: Optional[float] = None
+        self._generation = 0   # sube con cada invalidate; una carga empezada antes no queda vigente
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.invalidations = 0
+
+    def load(self, db: Session) -> None:
+        """Carga el índice completo. Si hay varios dispositivos del mismo tipo en un lote gana el de menor id."""
+        generation = self._generation
+        rows = (
+            db.query(DeviceIot.id, DeviceIot.lot_id, DeviceIot.devices_id)
+            .filter(DeviceIot.lot_id.isnot(None),
+                    DeviceIot.devices_id.in_((VALVE_TYPE_ID, METER_TYPE_ID)),
+                    (DeviceIot.status.is_(None)) | (DeviceIot.status != DELETED_STATUS_ID))
+            .order_by(DeviceIot.id)
+            .all()
+        )
+        valves: Dict[int, int] = {}
+        meters: Dict[int, int] = {}
+        for device_id, lot_id, devices_id in rows:
+            target = valves if devices_id == VALVE_TYPE_ID else meters
+            target.setdefault(lot_id, device_id)
+        with self._lock:
+            self._valves = valves
+            self._meters = meters
+            # Invalidado mientras se leía: el índice sirve, pero la próxima consulta recarga
+            self._loaded_at = time.monotonic() if generation == self._generation else None
+            self.loads += 1
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._loaded_at = None
+            self._generation += 1
+            self.invalidations += 1
+
+    def _fresh(self) -> bool:
+        loaded_at = self._loaded_at
+        return loaded_at is not None and time.monotonic() - loaded_at < self.ttl
+
+    def _ensure_loaded(self, db: Session) -> None:
+        if self._fresh():
+            self.hits += 1
+            return
+        self.misses += 1
+        # Con un índice anterior no se espera a la recarga de otro hilo
+        if not self._reload_lock.acquire(blocking=self.loads == 0):
+            return
+        try:
+            if not self._fresh():
+                self.load(db)
+        finally:
+            self._reload_lock.release()
+
+    def valve_id(self, db: Session, lot_id: int) -> Optional[int]:
+        """ID de la válvula del lote, o None si el lote no tiene válvula"""
+        self._ensure_loaded(db)
+        return self._valves.get(lot_id)
+
+    def meter_id(self, db: Session, lot_id: int) -> Optional[int]:
+        """ID del medidor del lote, o None si el lote no tiene medidor"""
+        self._ensure_loaded(db)
+        return self._meters.get(lot_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "loaded": self._loaded_at is not None,
+            "lots_with_valve": len(self._valves),
+            "lots_with_meter": len(self._meters),
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "invalidations": self.invalidations,
+            "ttl_seconds": self.ttl
+        }
+
+
+lot_index = LotTopologyIndex()
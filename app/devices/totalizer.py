@@ -0,0 +1,377 @@
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.orm import Session
+from app.database import SessionLocal
+from app.devices.models import ConsumptionMeasurement, ConsumptionVolumeSync
+from app.device_twin import device_twin
+from app.devices_request.models import Request
+
+# =======================================================
+# Totalizador de consumo por solicitud aprobada
+# =======================================================
+#
+# El medidor envía su lectura acumulada en sensor_value. Cada incremento entre dos
+# lecturas consecutivas que cae dentro de la ventana [open_date, close_date] del
+# request aprobado de la válvula del lote se suma al total de ese request.
+# El total vive en consumption_measurements: cada worker junta en memoria sólo los
+# incrementos todavía no guardados (con el ts de su lectura) y cada
+# TOTALIZER_CHECKPOINT_INTERVAL segundos los suma en la base con
+# final_volume = final_volume + incremento, así los checkpoints de varios workers se
+# acumulan en vez de pisarse. El checkpoint relee los totales guardados y los deja en
+# memoria: las consultas (consumo por válvula, volumen de un request, lectura actual
+# del medidor) responden desde ahí y sólo van a la base si no los conocen o si tienen
+# más de TOTALIZER_CACHE_TTL segundos (checkpoints de otros workers).
+#
+# Un final_volume informado por el dispositivo reemplaza el total y queda anotado en
+# consumption_volume_sync con el ts de su lectura; los incrementos pendientes de
+# cualquier worker con ts anterior ya están incluidos y el checkpoint los descarta.
+
+TOTALIZER_CHECKPOINT_INTERVAL = float(os.getenv("TOTALIZER_CHECKPOINT_INTERVAL", "30"))
+TOTALIZER_CACHE_TTL = float(os.getenv("TOTALIZER_CACHE_TTL", "60"))   # s
+
+
+class MeterTotalizer:
+    """
+    Incrementos pendientes por request, totales ya guardados y última lectura vista por
+    medidor. Las muestras se aplican después del commit de la lectura, así una transacción
+    fallida no deja incrementos contados.
+    """
+
+    def __init__(self, checkpoint_interval: float = TOTALIZER_CHECKPOINT_INTERVAL,
+                 cache_ttl: float = TOTALIZER_CACHE_TTL):
+        self.checkpoint_interval = checkpoint_interval
+        self.cache_ttl = cache_ttl
+        self._last: Dict[int, Tuple[float, datetime]] = {}               # meter_id → (sensor_value, ts)
+        self._pending: Dict[int, List[Tuple[datetime, float]]] = {}      # request_id → [(ts, incremento)]
+        self._inflight: Dict[int, List[Tuple[datetime, float]]] = {}     # tomados por el checkpoint en curso
+        self._valve_of: Dict[int, int] = {}                              # request_id → válvula
+        self._saved: Dict[int, Tuple[Optional[float], float]] = {}       # request_id → (final_volume, cargado)
+        self._valves: Dict[int, Tuple[List[Tuple[int, datetime]], float]] = {}   # válvula → ([(request_id, creado)], cargado)
+        self._current: Dict[int, Tuple[Optional[float], float]] = {}     # meter_id → (sensor_value, visto)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.samples = 0
+        self.resets = 0
+        self.checkpoints = 0
+        self.superseded = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    # ── Ingesta ─────────────────────────────────────────────
+    @staticmethod
+    def in_window(request: Optional[Request], ts: datetime) -> bool:
+        if request is None or request.open_date is None or ts < request.open_date:
+            return False
+        return request.close_date is None or ts <= request.close_date
+
+    def apply(self, samples: Iterable[Tuple[int, Optional[float], float, datetime, Optional[int], Optional[int]]]) -> None:
+        """
+        samples: (meter_id, lectura anterior guardada en data_devices, sensor_value, ts, request_id,
+        valve_id) en orden de llegada; request_id es None si la lectura no cae en una ventana activa.
+        La lectura anterior sale de la fila del medidor bloqueada en la transacción de la lectura,
+        así que es la última confirmada por cualquier worker.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for meter_id, previous, value, ts, request_id, valve_id in samples:
+                self.samples += 1
+                last = self._last.get(meter_id)
+                if last is not None and ts < last[1]:
+                    continue  # lectura atrasada: su incremento ya quedó contado
+                self._last[meter_id] = (value, ts)
+                self._current[meter_id] = (value, now)
+                if request_id is None or previous is None:
+                    continue
+                delta = value - previous
+                if delta < 0:
+                    # El contador del medidor se reinició: todo lo leído es consumo nuevo
+                    self.resets += 1
+                    delta = value
+                if delta == 0:
+                    continue
+                self._pending.setdefault(request_id, []).append((ts, delta))
+                if valve_id is not None:
+                    self._valve_of[request_id] = valve_id
+
+    def last_ts(self, meter_id: int) -> Optional[datetime]:
+        last = self._last.get(meter_id)
+        return last[1] if last is not None else None
+
+    @staticmethod
+    def mark_final_volumes(db: Session, items: Iterable[Tuple[int, int, float, datetime]]) -> None:
+        """
+        Anota en consumption_volume_sync, sin hacer commit, los final_volume informados por los
+        dispositivos: items son (request_id, valve_id, final_volume, ts de la lectura).
+        """
+        latest: Dict[int, Dict[str, Any]] = {}
+        for request_id, _valve_id, final_volume, ts in items:
+            if request_id not in latest or ts >= latest[request_id]["ts"]:
+                latest[request_id] = {"request_id": request_id, "final_volume": final_volume, "ts": ts}
+        if not latest:
+            return
+        table = ConsumptionVolumeSync.__table__
+        if db.get_bind().dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as upsert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as upsert
+        stmt = upsert(table).values(list(latest.values()))
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=["request_id"],
+            set_={"final_volume": stmt.excluded.final_volume, "ts": stmt.excluded.ts},
+            where=table.c.ts <= stmt.excluded.ts
+        ))
+
+    def sync_final_volume(self, request_id: int, valve_id: Optional[int], final_volume: float, ts: datetime) -> None:
+        """
+        El final_volume informado por el dispositivo ya se confirmó en la base y reemplaza
+        el acumulado: lo pendiente de este worker hasta ts queda incluido en ese valor.
+        """
+        with self._lock:
+            entries = self._pending.get(request_id)
+            if entries:
+                kept = [(t, d) for t, d in entries if t > ts]
+                self.superseded += len(entries) - len(kept)
+                if kept:
+                    self._pending[request_id] = kept
+                else:
+                    self._pending.pop(request_id, None)
+            self._saved[request_id] = (final_volume, time.monotonic())
+            if valve_id is not None:
+                self._valves.pop(valve_id, None)   # puede tener una medición nueva
+
+    # ── Consultas ───────────────────────────────────────────
+    def _fresh(self, loaded_at: float) -> bool:
+        return time.monotonic() - loaded_at < self.cache_ttl
+
+    def _pending_volume(self, request_id: int) -> Optional[float]:
+        """Sin guardar, incluido lo que el checkpoint en curso todavía no confirmó."""
+        entries = self._pending.get(request_id, []) + self._inflight.get(request_id, [])
+        return sum(d for _, d in entries) if entries else None
+
+    def _saved_volume(self, db: Session, request_id: int) -> Optional[float]:
+        cached = self._saved.get(request_id)
+        if cached is not None and self._fresh(cached[1]):
+            self.cache_hits += 1
+            return cached[0]
+        self.cache_misses += 1
+        saved = db.execute(
+            select(ConsumptionMeasurement.final_volume)
+            .where(ConsumptionMeasurement.request_id == request_id)
+        ).scalars().first()
+        value = float(saved) if saved is not None else None
+        with self._lock:
+            self._saved[request_id] = (value, time.monotonic())
+        return value
+
+    def volume(self, db: Session, request_id: int) -> Optional[float]:
+        """Volumen del request: lo guardado más lo pendiente de este worker (None si no tiene consumo)."""
+        saved = self._saved_volume(db, request_id)
+        with self._lock:
+            pending = self._pending_volume(request_id)
+        if saved is None and pending is None:
+            return None
+        return (saved or 0.0) + (pending or 0.0)
+
+    def _valve_requests(self, db: Session, valve_id: int) -> List[Tuple[int, datetime]]:
+        """Requests de la válvula con medición guardada, del más reciente al más antiguo."""
+        cached = self._valves.get(valve_id)
+        if cached is not None and self._fresh(cached[1]):
+            self.cache_hits += 1
+            return cached[0]
+        self.cache_misses += 1
+        rows = (
+            db.query(ConsumptionMeasurement.request_id, ConsumptionMeasurement.final_volume,
+                     ConsumptionMeasurement.created_at)
+              .join(Request, ConsumptionMeasurement.request_id == Request.id)
+              .filter(Request.device_iot_id == valve_id)
+              .order_by(ConsumptionMeasurement.created_at.desc(), ConsumptionMeasurement.id.desc())
+              .all()
+        )
+        now = time.monotonic()
+        entries = [(r.request_id, r.created_at or datetime.now()) for r in rows]
+        with self._lock:
+            for r in rows:
+                self._saved[r.request_id] = (float(r.final_volume), now)
+            self._valves[valve_id] = (entries, now)
+        return entries
+
+    def consumption(self, db: Session, valve_id: int) -> List[Dict[str, Any]]:
+        """Volumen por request de la válvula, del más reciente al más antiguo."""
+        entries = self._valve_requests(db, valve_id)
+        with self._lock:
+            saved = {request_id: self._saved.get(request_id, (None, 0.0))[0] for request_id, _ in entries}
+            pending = {
+                request_id: self._pending_volume(request_id) for request_id, valve in self._valve_of.items()
+                if valve == valve_id and (request_id in self._pending or request_id in self._inflight)
+            }
+        data = [
+            {
+                "request_id": request_id,
+                "final_volume": round((saved[request_id] or 0.0) + (pending.pop(request_id, None) or 0.0), 2),
+                "timestamp": created_at.isoformat()
+            }
+            for request_id, created_at in entries
+        ]
+        if pending:
+            # Requests de la válvula con consumo que todavía no llegó a ningún checkpoint
+            now = datetime.now().isoformat()
+            data[:0] = [
+                {"request_id": request_id, "final_volume": round(pending[request_id], 2), "timestamp": now}
+                for request_id in sorted(pending, reverse=True)
+            ]
+        return data
+
+    def current(self, db: Session, meter_id: int) -> Tuple[bool, Optional[float]]:
+        """(existe, lectura acumulada actual): la última vista o, si no, la fila del medidor en la base."""
+        cached = self._current.get(meter_id)
+        if cached is not None and self._fresh(cached[1]):
+            self.cache_hits += 1
+            return True, cached[0]
+        self.cache_misses += 1
+        device = device_twin.load_many(db, [meter_id]).get(meter_id)
+        if not device:
+            return False, None
+        value = None
+        if device.data_devices and "sensor_value" in device.data_devices:
+            value = device.data_devices["sensor_value"]
+        with self._lock:
+            self._current[meter_id] = (value, time.monotonic())
+        return True, value
+
+    # ── Checkpoint ──────────────────────────────────────────
+    def checkpoint(self, db: Session) -> int:
+        """
+        Suma en consumption_measurements los incrementos pendientes posteriores al último
+        final_volume informado de cada request. Devuelve cuántos requests guardó. Si la
+        transacción falla, los incrementos vuelven a quedar pendientes.
+        """
+        with self._lock:
+            taken, self._pending = self._pending, {}
+            self._inflight = taken
+        if not taken:
+            return 0
+        table = ConsumptionMeasurement.__table__
+        try:
+            # Bloquear los requests serializa con otros workers la creación de la medición
+            db.execute(
+                select(Request.id).where(Request.id.in_(taken.keys()))
+                .order_by(Request.id).with_for_update()
+            ).all()
+            synced = dict(db.execute(
+                select(ConsumptionVolumeSync.request_id, ConsumptionVolumeSync.ts)
+                .where(ConsumptionVolumeSync.request_id.in_(taken.keys()))
+            ).all())
+            pending: Dict[int, float] = {}
+            carry: Dict[int, Tuple[datetime, float]] = {}
+            superseded = 0
+            for request_id, entries in taken.items():
+                mark = synced.get(request_id)
+                kept = [(ts, d) for ts, d in entries if mark is None or ts > mark]
+                superseded += len(entries) - len(kept)
+                if not kept:
+                    continue
+                total = sum(d for _, d in kept)
+                # Sólo se guardan centésimas (Numeric(10, 2)); el resto queda para el próximo
+                saved = round(total, 2)
+                if saved:
+                    pending[request_id] = saved
+                if abs(total - saved) > 1e-9:
+                    carry[request_id] = (max(ts for ts, _ in kept), total - saved)
+            totals: Dict[int, float] = {}
+            inserted = set()
+            if pending:
+                existing = set(db.execute(
+                    select(table.c.request_id).where(table.c.request_id.in_(pending.keys()))
+                ).scalars())
+                updates = [{"b_request_id": r, "delta": d} for r, d in sorted(pending.items()) if r in existing]
+                if updates:
+                    db.execute(
+                        update(table).where(table.c.request_id == bindparam("b_request_id"))
+                                     .values(final_volume=table.c.final_volume + bindparam("delta")),
+                        updates
+                    )
+                inserts = [{"request_id": r, "final_volume": d} for r, d in sorted(pending.items()) if r not in existing]
+                if inserts:
+                    db.execute(insert(table), inserts)
+                    inserted = {row["request_id"] for row in inserts}
+                # Totales con los checkpoints de todos los workers (las filas siguen bloqueadas)
+                totals = {r: float(v) for r, v in db.execute(
+                    select(table.c.request_id, table.c.final_volume).where(table.c.request_id.in_(pending.keys()))
+                ).all()}
+            db.commit()
+        except Exception:
+            db.rollback()
+            with self._lock:
+                self._inflight = {}
+                for request_id, entries in taken.items():
+                    self._pending[request_id] = entries + self._pending.get(request_id, [])
+            raise
+        now = time.monotonic()
+        with self._lock:
+            self._inflight = {}
+            for request_id, entry in carry.items():
+                self._pending.setdefault(request_id, []).insert(0, entry)
+            for request_id, total in totals.items():
+                self._saved[request_id] = (total, now)
+            for request_id in inserted:
+                valve_id = self._valve_of.get(request_id)
+                if valve_id is not None:
+                    self._valves.pop(valve_id, None)
+            for request_id in taken:
+                if request_id not in self._pending:
+                    self._valve_of.pop(request_id, None)
+        self.superseded += superseded
+        self.checkpoints += 1
+        return len(pending)
+
+    def _checkpoint_once(self) -> None:
+        db = SessionLocal()
+        try:
+            saved = self.checkpoint(db)
+            if saved:
+                print(f"[totalizador] {saved} acumulados guardados")
+        except Exception as e:
+            db.rollback()
+            print("[totalizador] Error en checkpoint:", e)
+        finally:
+            db.close()
+
+    def run(self) -> None:
+        print("[totalizador] hilo de checkpoint iniciado")
+        while not self._stop.wait(self.checkpoint_interval):
+            self._checkpoint_once()
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Detiene el hilo y guarda lo pendiente."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+        self._checkpoint_once()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "meters_tracked": len(self._last),
+            "requests_pending": len(self._pending),
+            "samples": self.samples,
+            "counter_resets": self.resets,
+            "checkpoints": self.checkpoints,
+            "superseded_increments": self.superseded,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "checkpoint_interval": self.checkpoint_interval,
+            "cache_ttl": self.cache_ttl
+        }
+
+
+meter_totalizer = MeterTotalizer()
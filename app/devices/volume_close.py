@@ -0,0 +1,223 @@
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+from sqlalchemy import delete, func
+from sqlalchemy.orm import Session
+from app.command_bus import command_bus
+from app.device_twin import change_device_status, device_twin
+from app.devices.models import RequestVolumeClose
+from app.devices.topology import lot_index
+from app.devices.totalizer import meter_totalizer
+from app.devices_request.models import Request
+
+# =======================================================
+# Cierre automático por volumen (type_opening_id == 1)
+# =======================================================
+#
+# Índice en memoria válvula → último request aprobado (el mismo que usa el scheduler);
+# la lectura de un medidor llega con su lote y se resuelve lote → válvula → request
+# con dos búsquedas en diccionarios. Después de confirmar cada lote de lecturas, los
+# requests por volumen cuyo acumulado en el totalizador alcanzó volume_water pasan a
+# No operativo (12) y se envía el comando de cierre: la válvula se cierra con la misma
+# lectura que completa el volumen. El scheduler no la reabre, porque dentro de la
+# ventana sólo abre válvulas En espera (20).
+#
+# Cada request se cierra una sola vez: si un operador la reabre a mano, se respeta.
+# La marca del cierre vive en request_volume_close (no en la memoria de un worker) y el
+# estado de la válvula se relee de la base con la fila bloqueada antes de cerrarla.
+
+STATUS_WAITING   = 20
+STATUS_OPEN      = 22
+STATUS_CLOSED    = 12
+VOLUME_OPENING_ID = 1     # type_opening: apertura por volumen
+
+# Tiempo máximo sin recargar el índice (cubre aprobaciones hechas en otros workers)
+ACTIVE_REQUESTS_TTL = float(os.getenv("ACTIVE_REQUESTS_TTL", "300"))
+
+
+class ActiveRequest:
+    __slots__ = ("request_id", "valve_id", "lot_id", "type_opening_id", "target",
+                 "open_date", "close_date", "closed_at")
+
+    def __init__(self, row: Any):
+        self.request_id = row.id
+        self.valve_id = row.device_iot_id
+        self.lot_id = row.lot_id
+        self.type_opening_id = row.type_opening_id
+        self.target = float(row.volume_water) if row.volume_water else None
+        self.open_date = row.open_date
+        self.close_date = row.close_date
+        self.closed_at: Optional[datetime] = None
+
+    @property
+    def by_volume(self) -> bool:
+        return self.type_opening_id == VOLUME_OPENING_ID and self.target is not None
+
+
+class ActiveRequestIndex:
+    def __init__(self, ttl: float = ACTIVE_REQUESTS_TTL):
+        self.ttl = ttl
+        self._by_valve: Dict[int, ActiveRequest] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.refreshes = 0
+        self.checks = 0
+        self.auto_closes = 0
+        self.failed_closes = 0
+
+    # ── Carga ───────────────────────────────────────────────
+    def _latest_query(self, db: Session):
+        latest = (
+            db.query(func.max(Request.id))
+              .filter(Request.status == 17)
+              .group_by(Request.device_iot_id)
+        )
+        return db.query(Request.id, Request.device_iot_id, Request.lot_id, Request.type_opening_id,
+                        Request.volume_water, Request.open_date, Request.close_date) \
+                 .filter(Request.id.in_(latest.scalar_subquery()))
+
+    def _closed(self, db: Session, request_ids: List[int]) -> Dict[int, datetime]:
+        """Cierres por volumen ya registrados (por cualquier worker) de esos requests."""
+        if not request_ids:
+            return {}
+        rows = db.query(RequestVolumeClose.request_id, RequestVolumeClose.closed_at) \
+                 .filter(RequestVolumeClose.request_id.in_(request_ids)).all()
+        return dict(rows)
+
+    def load(self, db: Session) -> None:
+        """Carga el último request aprobado de cada válvula con los cierres ya registrados."""
+        rows = self._latest_query(db).all()
+        closed = self._closed(db, [row.id for row in rows if row.type_opening_id == VOLUME_OPENING_ID])
+        by_valve: Dict[int, ActiveRequest] = {}
+        for row in rows:
+            entry = ActiveRequest(row)
+            entry.closed_at = closed.get(entry.request_id)
+            by_valve[entry.valve_id] = entry
+        with self._lock:
+            self._by_valve = by_valve
+            self._loaded_at = time.monotonic()
+            self.loads += 1
+
+    def refresh(self, db: Session, valve_id: int) -> None:
+        """Relee el request vigente de una válvula (aprobación, rechazo o edición de un request)."""
+        self._ensure_loaded(db)
+        row = self._latest_query(db).filter(Request.device_iot_id == valve_id).first()
+        closed = self._closed(db, [row.id]) if row is not None else {}
+        with self._lock:
+            self._by_valve.pop(valve_id, None)
+            if row is not None:
+                entry = self._by_valve[valve_id] = ActiveRequest(row)
+                entry.closed_at = closed.get(entry.request_id)
+        self.refreshes += 1
+
+    def _ensure_loaded(self, db: Session) -> None:
+        loaded_at = self._loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at >= self.ttl:
+            self.load(db)
+
+    def for_lot(self, db: Session, lot_id: int) -> Optional[ActiveRequest]:
+        """Request vigente de la válvula del lote (None si no tiene válvula o request aprobado)."""
+        self._ensure_loaded(db)
+        valve_id = lot_index.valve_id(db, lot_id)
+        return self._by_valve.get(valve_id) if valve_id is not None else None
+
+    # ── Evaluación ──────────────────────────────────────────
+    def evaluate(self, db: Session, checks: Iterable[Tuple[int, int]]) -> int:
+        """
+        checks: (lot_id, request_id) de las lecturas de medidor ya confirmadas que sumaron
+        volumen a un request. Cierra las válvulas cuyo request por volumen alcanzó el objetivo.
+        Devuelve cuántas cerró.
+        """
+        due = []
+        for lot_id, request_id in dict.fromkeys(checks):
+            self.checks += 1
+            entry = self.for_lot(db, lot_id)
+            if entry is None or entry.request_id != request_id:
+                # El índice no conoce el request que el lote de lecturas leyó de la base
+                entry = self._refetch(db, lot_id, request_id)
+            if entry is None or not entry.by_volume or entry.closed_at is not None:
+                continue
+            volume = meter_totalizer.volume(db, request_id)
+            if volume is not None and volume >= entry.target:
+                due.append((entry, volume))
+        if not due:
+            return 0
+
+        now = datetime.now()
+        closed = []
+        try:
+            # Estado leído de la base y bloqueado hasta el commit: el gemelo puede ir atrasado
+            valves = device_twin.load_many(db, [entry.valve_id for entry, _ in due], for_update=True)
+            due = [(entry, volume) for entry, volume in due
+                   if valves.get(entry.valve_id) is not None
+                   and valves[entry.valve_id].status in (STATUS_WAITING, STATUS_OPEN)]
+            claimed = self._claim(db, due, now)
+            for entry, volume in due:
+                if entry.request_id not in claimed:
+                    continue   # otro worker ya lo cerró
+                if change_device_status(db, valves[entry.valve_id], STATUS_CLOSED, "volume",
+                                        request_id=entry.request_id, ts=now, strict=True):
+                    command_bus.publish_after_commit(db, entry.valve_id, "close", source="volume")
+                    closed.append((entry, volume))
+                else:
+                    db.execute(delete(RequestVolumeClose).where(RequestVolumeClose.request_id == entry.request_id))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            self.failed_closes += len(due)
+            print("[volumen] Error cerrando válvulas por volumen:", e)
+            return 0
+        for entry, _ in due:
+            if entry.request_id not in claimed:
+                entry.closed_at = entry.closed_at or now
+        for entry, volume in closed:
+            entry.closed_at = now
+            print(f"[volumen] Req {entry.request_id}: {volume:.2f}/{entry.target:.2f} L, válvula {entry.valve_id} cerrada")
+        self.auto_closes += len(closed)
+        return len(closed)
+
+    def _claim(self, db: Session, due: List[Tuple[ActiveRequest, float]], now: datetime) -> Set[int]:
+        """Registra el cierre de esos requests sin hacer commit; devuelve los que no estaban registrados."""
+        if not due:
+            return set()
+        rows = [{"request_id": e.request_id, "device_iot_id": e.valve_id, "volume": volume, "closed_at": now}
+                for e, volume in due]
+        table = RequestVolumeClose.__table__
+        if db.get_bind().dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        stmt = (
+            insert(table).values(rows)
+            .on_conflict_do_nothing(index_elements=["request_id"])
+            .returning(table.c.request_id)
+        )
+        return {r.request_id for r in db.execute(stmt)}
+
+    def _refetch(self, db: Session, lot_id: int, request_id: int) -> Optional[ActiveRequest]:
+        valve_id = lot_index.valve_id(db, lot_id)
+        if valve_id is None:
+            return None
+        self.refresh(db, valve_id)
+        entry = self._by_valve.get(valve_id)
+        return entry if entry is not None and entry.request_id == request_id else None
+
+    def stats(self) -> Dict[str, Any]:
+        entries = list(self._by_valve.values())
+        return {
+            "loaded": self._loaded_at is not None,
+            "active_requests": len(entries),
+            "by_volume": sum(1 for e in entries if e.by_volume),
+            "loads": self.loads,
+            "refreshes": self.refreshes,
+            "checks": self.checks,
+            "auto_closes": self.auto_closes,
+            "failed_closes": self.failed_closes,
+            "ttl_seconds": self.ttl
+        }
+
+
+active_requests = ActiveRequestIndex()
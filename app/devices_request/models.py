@@ -1,4 +1,4 @@
-from sqlalchemy import TIMESTAMP, Column, Date, Integer, String, DateTime, JSON, ForeignKey , Text
+from sqlalchemy import TIMESTAMP, Column, Date, Integer, String, DateTime, JSON, ForeignKey , Text, Index
 from sqlalchemy.orm import relationship
 from app.database import Base
 
@@ -16,6 +16,8 @@ class TypeOpen(Base):
 
 class Request(Base):
     __tablename__ = 'request'
+    # Último request aprobado por dispositivo (MAX(id) ... WHERE status = 17 GROUP BY device_iot_id)
+    __table_args__ = (Index("ix_request_status_device_id", "status", "device_iot_id", "id"),)
 
     id             = Column(Integer, primary_key=True, index=True)
     type_opening_id= Column(Integer)
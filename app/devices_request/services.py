@@ -8,6 +8,9 @@ from fastapi.encoders import jsonable_encoder
 from app.devices.models import DeviceIot, Lot, User , Property , PropertyLot , PropertyUser , Notification
 from app.devices_request.models import Request, TypeOpen , Vars , RequestRejectionReason , RequestRejection
 from app.devices.schemas import NotificationCreate
+from app.arduino_reader import wake_scheduler
+from app.devices.volume_close import active_requests
+from app.transition_journal import set_device_status
 
 class DeviceRequestService:
     def __init__(self, db: Session):
@@ -438,6 +441,8 @@ class DeviceRequestService:
             existing_request.close_date = close_date
             existing_request.volume_water = volume_water
             self.db.commit()
+            wake_scheduler(existing_request.device_iot_id)
+            active_requests.refresh(self.db, existing_request.device_iot_id)
             self.db.refresh(existing_request)
             return JSONResponse(
                 status_code=200,
@@ -586,8 +591,10 @@ class DeviceRequestService:
         if not device:
             return JSONResponse(status_code=404, content={"success": False, "data": "Dispositivo no encontrado"})
         req.status = 17   # Aprobado
-        device.status = 20 # En espera
+        set_device_status(self.db, device, 20, "approve", request_id=req.id)  # En espera
         self.db.commit()
+        wake_scheduler(req.device_iot_id)
+        active_requests.refresh(self.db, req.device_iot_id)
 
         lot = self.db.query(Lot).get(req.lot_id)
         lot_name = lot.name if lot else f"Lote {req.lot_id}"
@@ -629,8 +636,10 @@ class DeviceRequestService:
         self.db.add(rejection)
 
         req.status = 19   # Rechazado
-        device.status = 12 # No operativo
+        set_device_status(self.db, device, 12, "reject", request_id=req.id)   # No operativo
         self.db.commit()
+        wake_scheduler(req.device_iot_id)
+        active_requests.refresh(self.db, req.device_iot_id)
 
         lot = self.db.query(Lot).get(req.lot_id)
         lot_name = lot.name if lot else f"Lote {req.lot_id}"
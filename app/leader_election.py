@@ -0,0 +1,203 @@
+import os
+import select
+import threading
+import zlib
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional
+from sqlalchemy import text
+from app.database import engine
+
+# =======================================================
+# Elección de líder entre workers con advisory locks de PostgreSQL
+# =======================================================
+#
+# Cada worker intenta tomar pg_try_advisory_lock(key) en una conexión dedicada.
+# El lock es de sesión: lo conserva mientras la conexión viva, y PostgreSQL lo libera
+# si el proceso muere o la conexión se corta (keepalives TCP). Los demás workers
+# reintentan cada LEADER_HEARTBEAT segundos, así la conmutación tarda a lo sumo eso.
+# El líder además escucha canales LISTEN/NOTIFY para recibir avisos de otros workers.
+
+LEADER_HEARTBEAT = float(os.getenv("LEADER_HEARTBEAT", "2"))      # s entre latidos / reintentos
+LEADER_KEEPALIVE = int(os.getenv("LEADER_KEEPALIVE", "5"))        # s para detectar un líder caído por red
+LEADER_GATED_EVERY = 5   # con la compuerta cerrada igual se intenta cada tantos latidos (locks huérfanos)
+
+
+def lock_key(name: str) -> int:
+    """Clave estable (bigint) del advisory lock para un nombre de tarea."""
+    return zlib.crc32(f"disriego:{name}".encode())
+
+
+class LeaderElector:
+    """
+    Mantiene el liderazgo de una tarea de fondo. on_elected/on_demoted registran
+    callbacks de cambio de rol; on_notify recibe los NOTIFY del canal mientras se es líder.
+    Sin PostgreSQL (SQLite en desarrollo) se asume un único proceso, siempre líder.
+    can_acquire (opcional) limita cuándo intentar tomar el lock, p. ej. para repartir
+    shards entre workers; con la compuerta cerrada sólo se intenta cada LEADER_GATED_EVERY
+    latidos, así un lock que nadie más toma no queda huérfano.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        heartbeat: float = LEADER_HEARTBEAT,
+        channels: Iterable[str] = (),
+        can_acquire: Optional[Callable[[], bool]] = None
+    ):
+        self.name = name
+        self.can_acquire = can_acquire
+        self._attempts = 0
+        self.key = lock_key(name)
+        self.heartbeat = heartbeat
+        self.channels = list(channels)
+        self._conn = None
+        self._leader = False
+        self._stop = threading.Event()
+        self._thread = None
+        self._elected: List[Callable[[], None]] = []
+        self._demoted: List[Callable[[], None]] = []
+        self._notify: Dict[str, Callable[[str], None]] = {}
+        self.elections = 0
+        self.demotions = 0
+        self.notifications = 0
+        self.leader_since: Optional[datetime] = None
+        self.last_heartbeat: Optional[datetime] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._leader
+
+    @property
+    def is_postgres(self) -> bool:
+        return engine.dialect.name == "postgresql"
+
+    def on_elected(self, fn: Callable[[], None]) -> None:
+        self._elected.append(fn)
+
+    def on_demoted(self, fn: Callable[[], None]) -> None:
+        self._demoted.append(fn)
+
+    def on_notify(self, channel: str, fn: Callable[[str], None]) -> None:
+        self._notify[channel] = fn
+
+    def notify(self, channel: str, payload: str = "") -> None:
+        """Publicar un aviso para el líder (esté en este worker o en otro)."""
+        with engine.begin() as conn:
+            conn.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": channel, "payload": payload})
+
+    # ── Conexión dedicada ───────────────────────────────────
+    def _connect(self):
+        pooled = engine.raw_connection()
+        pooled.detach()  # fuera del pool: su vida es la del liderazgo
+        conn = pooled.driver_connection
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("SET application_name = %s", (f"disriego-{self.name}",))
+            cur.execute("SET tcp_keepalives_idle = %s", (LEADER_KEEPALIVE,))
+            cur.execute("SET tcp_keepalives_interval = %s", (max(1, LEADER_KEEPALIVE // 2),))
+            cur.execute("SET tcp_keepalives_count = 2")
+        return conn
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.close()  # cerrar la sesión libera el advisory lock
+            except Exception:
+                pass
+            self._conn = None
+
+    # ── Transiciones ────────────────────────────────────────
+    def _promote(self) -> None:
+        self._leader = True
+        self.elections += 1
+        self.leader_since = datetime.now()
+        print(f"[leader] {self.name}: este worker (pid {os.getpid()}) es el líder")
+        for fn in self._elected:
+            fn()
+
+    def _demote(self, reason: str) -> None:
+        self._close()
+        if not self._leader:
+            return
+        self._leader = False
+        self.demotions += 1
+        self.leader_since = None
+        print(f"[leader] {self.name}: liderazgo perdido ({reason})")
+        for fn in self._demoted:
+            fn()
+
+    def _try_acquire(self) -> None:
+        if self._conn is None:
+            self._conn = self._connect()
+        with self._conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (self.key,))
+            if not cur.fetchone()[0]:
+                return
+            for channel in self.channels:
+                cur.execute(f'LISTEN "{channel}"')
+        self._promote()
+
+    def _beat(self) -> None:
+        """Confirma que la sesión sigue viva y espera avisos hasta el próximo latido."""
+        with self._conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        self.last_heartbeat = datetime.now()
+        ready, _, _ = select.select([self._conn], [], [], self.heartbeat)
+        if not ready:
+            return
+        self._conn.poll()
+        while self._conn.notifies:
+            note = self._conn.notifies.pop(0)
+            self.notifications += 1
+            handler = self._notify.get(note.channel)
+            if handler:
+                handler(note.payload)
+
+    def run(self) -> None:
+        print(f"[leader] {self.name}: elección iniciada (pid {os.getpid()})")
+        while not self._stop.is_set():
+            try:
+                if self._leader:
+                    self._beat()
+                else:
+                    self._attempts += 1
+                    if self.can_acquire is None or self.can_acquire() \
+                            or self._attempts % LEADER_GATED_EVERY == 0:
+                        self._try_acquire()
+                    if not self._leader:
+                        self._stop.wait(self.heartbeat)
+            except Exception as e:
+                print(f"[leader] {self.name}: error en la conexión de liderazgo:", e)
+                self._demote("conexión perdida")
+                self._stop.wait(self.heartbeat)
+        self._demote("detenido")
+
+    def start(self) -> None:
+        if not self.is_postgres:
+            if not self._leader:
+                print(f"[leader] {self.name}: sin PostgreSQL, se asume un único worker")
+                self._promote()
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Suelta el liderazgo para que otro worker lo tome sin esperar el corte de la conexión."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "pid": os.getpid(),
+            "is_leader": self._leader,
+            "leader_since": self.leader_since.isoformat() if self.leader_since else None,
+            "last_heartbeat": self.last_heartbeat.isoformat() if self.last_heartbeat else None,
+            "heartbeat_seconds": self.heartbeat,
+            "elections": self.elections,
+            "demotions": self.demotions,
+            "notifications": self.notifications
+        }
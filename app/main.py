@@ -1,10 +1,20 @@
 from fastapi import FastAPI
-from app.database import Base, engine
+from app.database import Base, engine, SessionLocal
 from app.devices.routes import router as devices_router
 from app.devices_request.routes import router as devices_request_router
+from app.scheduler_routes import router as scheduler_router
 from app.middlewares import setup_middlewares
 from app.exceptions import setup_exception_handlers
-from app.arduino_reader import start_background_jobs
+from app.arduino_reader import start_background_jobs, stop_background_jobs
+from app.devices.ingest_queue import reading_queue
+from app.devices.readings import partition_maintainer
+from app.devices.topology import lot_index
+from app.devices.volume_close import active_requests
+from app.devices.totalizer import meter_totalizer
+from app.transition_journal import transition_journal
+from app.device_twin import device_twin
+from app.servo_queue import command_listener
+from app.command_tracker import command_tracker
 
 from app.arduino_reader import (
     device_status_scheduler
@@ -23,13 +33,54 @@ setup_exception_handlers(app)
 
 app.include_router(devices_router)
 app.include_router(devices_request_router)
+app.include_router(scheduler_router)
 
 Base.metadata.create_all(bind=engine)
 
 # ── Lanzar los dos hilos en el startup ─────────────────────
 @app.on_event("startup")
 def startup_event():
+    # Precargar los índices lote → válvula/medidor y válvula → request vigente para la ruta de lecturas
+    db = SessionLocal()
+    try:
+        lot_index.load(db)
+        active_requests.load(db)
+    except Exception as e:
+        print("[startup] No se pudieron precargar los índices en memoria:", e)
+    finally:
+        db.close()
+    # Particiones del histórico creadas antes de que lleguen lecturas de ese mes
+    partition_maintainer.start()
     start_background_jobs()
+    if reading_queue.enabled:
+        reading_queue.start()
+    meter_totalizer.start()
+    transition_journal.start()
+    device_twin.start()
+    command_tracker.start()
+
+@app.on_event("shutdown")
+def shutdown_event():
+    # Ceder el liderazgo del scheduler a otro worker
+    stop_background_jobs()
+    # Volcar las lecturas pendientes antes de salir
+    reading_queue.stop()
+    meter_totalizer.stop()
+    # Escribir las transiciones de estado que quedan en el buffer
+    transition_journal.stop()
+    device_twin.stop()
+    command_tracker.stop()
+    partition_maintainer.stop()
+    # Los puntos retenidos por la compresión quedan en device_compression_state
+
+# ── Escucha de comandos de otros workers (necesita el event loop) ──
+@app.on_event("startup")
+async def start_command_listener():
+    await command_listener.start()
+
+@app.on_event("shutdown")
+async def stop_command_listener():
+    await command_listener.stop()
 
 @app.get("/health", tags=["Health"])
 def health_check():
@@ -0,0 +1,224 @@
+import os
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Any, Deque, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# =======================================================
+# Métricas por tick del scheduler de válvulas
+# =======================================================
+#
+# Cada revisión deja un TickRecord: duración total y por fase, filas por fase,
+# transiciones aplicadas, comandos publicados, error y atraso entre cada deadline
+# vencido y el momento en que quedó aplicado (commit). Se guardan los últimos
+# SCHEDULER_METRICS_HISTORY ticks y acumulados que se exportan en formato Prometheus.
+
+SCHEDULER_METRICS_HISTORY = int(os.getenv("SCHEDULER_METRICS_HISTORY", "100"))
+
+PHASES = ("reconcile", "commit", "deadlines")
+TICK_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)   # s
+LAG_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)          # s
+
+METRIC_PREFIX = "disriego_scheduler"
+
+GAUGE_HELP = {
+    "is_leader": "1 si este worker tiene el lease del shard",
+    "pending_deadlines": "Deadlines en el heap del shard",
+    "next_deadline_seconds": "Segundos hasta el próximo deadline",
+}
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "total", "count")
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)   # el último es +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        out, running = [], 0
+        for bound, n in zip(self.bounds + (float("inf"),), self.counts):
+            running += n
+            out.append(("+Inf" if bound == float("inf") else repr(bound), running))
+        return out
+
+
+class TickRecord:
+    __slots__ = ("started_at", "reason", "duration", "phases", "rows", "transitions",
+                 "commands", "due", "max_lag", "error")
+
+    def __init__(self, started_at: datetime, reason: str):
+        self.started_at = started_at
+        self.reason = reason
+        self.duration = 0.0
+        self.phases: Dict[str, float] = {}
+        self.rows: Dict[str, int] = {}
+        self.transitions: Dict[int, int] = {}    # nuevo estado → cantidad
+        self.commands: Dict[str, int] = {}       # acción → cantidad
+        self.due = 0                             # deadlines vencidos atendidos
+        self.max_lag: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "started_at": self.started_at.isoformat(),
+            "reason": self.reason,
+            "duration_ms": round(self.duration * 1000, 2),
+            "phases_ms": {k: round(v * 1000, 2) for k, v in self.phases.items()},
+            "rows": dict(self.rows),
+            "transitions": {str(k): v for k, v in self.transitions.items()},
+            "commands": dict(self.commands),
+            "due_deadlines": self.due,
+            "max_lag_ms": round(self.max_lag * 1000, 2) if self.max_lag is not None else None,
+            "error": self.error
+        }
+
+
+class SchedulerMetrics:
+    """Acumulados e historial reciente de los ticks de un shard."""
+
+    def __init__(self, shard: int, history: int = SCHEDULER_METRICS_HISTORY):
+        self.shard = shard
+        self._recent: Deque[TickRecord] = deque(maxlen=history)
+        self._lock = threading.Lock()
+        self.ticks: Dict[str, int] = {}
+        self.errors = 0
+        self.last_error: Optional[str] = None
+        self.transitions: Dict[int, int] = {}
+        self.commands: Dict[str, int] = {}
+        self.rows: Dict[str, int] = {"reconcile": 0, "deadlines": 0}
+        self.phase_seconds: Dict[str, float] = {p: 0.0 for p in PHASES}
+        self.tick_duration = Histogram(TICK_BUCKETS)
+        self.deadline_lag = Histogram(LAG_BUCKETS)
+        self.last_tick: Optional[TickRecord] = None
+
+    def record(self, tick: TickRecord, lags: Iterable[float] = ()) -> None:
+        with self._lock:
+            self.ticks[tick.reason] = self.ticks.get(tick.reason, 0) + 1
+            if tick.error:
+                self.errors += 1
+                self.last_error = tick.error
+            for status, n in tick.transitions.items():
+                self.transitions[status] = self.transitions.get(status, 0) + n
+            for action, n in tick.commands.items():
+                self.commands[action] = self.commands.get(action, 0) + n
+            for phase, n in tick.rows.items():
+                self.rows[phase] = self.rows.get(phase, 0) + n
+            for phase, seconds in tick.phases.items():
+                self.phase_seconds[phase] = self.phase_seconds.get(phase, 0.0) + seconds
+            self.tick_duration.observe(tick.duration)
+            for lag in lags:
+                self.deadline_lag.observe(max(0.0, lag))
+            self._recent.append(tick)
+            self.last_tick = tick
+
+    def snapshot(self, recent: int = 10) -> Dict[str, Any]:
+        with self._lock:
+            durations = sorted(t.duration for t in self._recent)
+            lags = sorted(t.max_lag for t in self._recent if t.max_lag is not None)
+            last = list(self._recent)[-recent:] if recent > 0 else []
+            return {
+                "ticks": dict(self.ticks),
+                "errors": self.errors,
+                "last_error": self.last_error,
+                "transitions": {str(k): v for k, v in self.transitions.items()},
+                "commands": dict(self.commands),
+                "rows": dict(self.rows),
+                "tick_ms": {
+                    "p50": _ms(_percentile(durations, 50)),
+                    "p99": _ms(_percentile(durations, 99)),
+                    "max": _ms(durations[-1] if durations else None)
+                },
+                "deadline_lag_ms": {
+                    "observed": self.deadline_lag.count,
+                    "mean": _ms(self.deadline_lag.total / self.deadline_lag.count if self.deadline_lag.count else None),
+                    "max_recent": _ms(lags[-1] if lags else None)
+                },
+                "recent_ticks": [t.to_dict() for t in reversed(last)]
+            }
+
+
+def _percentile(ordered: List[float], p: float) -> Optional[float]:
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def _labels(**labels: Any) -> str:
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}"
+
+
+def render_prometheus(shards: Iterable[Tuple[SchedulerMetrics, Dict[str, float]]]) -> str:
+    """
+    Texto en formato de exposición de Prometheus (text/plain; version=0.0.4).
+    shards: (métricas, gauges del shard como pending_deadlines o is_leader).
+    """
+    families: Dict[str, Tuple[str, str, List[str]]] = {}
+
+    def add(name: str, kind: str, help_text: str, line: str) -> None:
+        families.setdefault(name, (kind, help_text, []))[2].append(line)
+
+    for m, gauges in shards:
+        with m._lock:
+            s = m.shard
+            name = f"{METRIC_PREFIX}_ticks_total"
+            for reason, n in sorted(m.ticks.items()):
+                add(name, "counter", "Revisiones del scheduler por motivo",
+                    f"{name}{_labels(shard=s, reason=reason)} {n}")
+            name = f"{METRIC_PREFIX}_errors_total"
+            add(name, "counter", "Revisiones fallidas", f"{name}{_labels(shard=s)} {m.errors}")
+            name = f"{METRIC_PREFIX}_transitions_total"
+            for status, n in sorted(m.transitions.items()):
+                add(name, "counter", "Cambios de estado aplicados por estado nuevo",
+                    f"{name}{_labels(shard=s, status=status)} {n}")
+            name = f"{METRIC_PREFIX}_commands_total"
+            for action, n in sorted(m.commands.items()):
+                add(name, "counter", "Comandos publicados en el bus por acción",
+                    f"{name}{_labels(shard=s, action=action)} {n}")
+            name = f"{METRIC_PREFIX}_rows_total"
+            for phase, n in m.rows.items():
+                add(name, "counter", "Filas por fase del tick (cambios aplicados, deadlines cargados)",
+                    f"{name}{_labels(shard=s, phase=phase)} {n}")
+            name = f"{METRIC_PREFIX}_phase_seconds_total"
+            for phase, seconds in m.phase_seconds.items():
+                add(name, "counter", "Tiempo acumulado por fase del tick",
+                    f"{name}{_labels(shard=s, phase=phase)} {seconds:.6f}")
+            for name, hist, help_text in (
+                (f"{METRIC_PREFIX}_tick_duration_seconds", m.tick_duration, "Duración de cada tick"),
+                (f"{METRIC_PREFIX}_deadline_lag_seconds", m.deadline_lag,
+                 "Atraso entre un deadline y su aplicación"),
+            ):
+                for le, n in hist.cumulative():
+                    add(name, "histogram", help_text, f"{name}_bucket{_labels(shard=s, le=le)} {n}")
+                add(name, "histogram", help_text, f"{name}_sum{_labels(shard=s)} {hist.total:.6f}")
+                add(name, "histogram", help_text, f"{name}_count{_labels(shard=s)} {hist.count}")
+            if m.last_tick is not None:
+                name = f"{METRIC_PREFIX}_last_tick_timestamp_seconds"
+                add(name, "gauge", "Inicio del último tick (epoch)",
+                    f"{name}{_labels(shard=s)} {m.last_tick.started_at.timestamp():.3f}")
+        for gauge, value in gauges.items():
+            name = f"{METRIC_PREFIX}_{gauge}"
+            add(name, "gauge", GAUGE_HELP.get(gauge, gauge), f"{name}{_labels(shard=s)} {value}")
+
+    lines: List[str] = []
+    for name, (kind, help_text, samples) in families.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
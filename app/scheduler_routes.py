@@ -0,0 +1,18 @@
+from typing import Any, Dict
+from fastapi import APIRouter, Query
+from fastapi.responses import PlainTextResponse
+from app.arduino_reader import scheduler_metrics_text, scheduler_status
+
+router = APIRouter(prefix="/scheduler", tags=["Scheduler"])
+
+
+@router.get("/status", response_model=Dict[str, Any])
+def get_scheduler_status(recent: int = Query(10, ge=0, le=100, description="Ticks recientes por shard")):
+    """Liderazgo, deadlines pendientes y métricas por tick de cada shard del scheduler en este worker"""
+    return {"success": True, "data": scheduler_status(recent)}
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def get_scheduler_metrics():
+    """Métricas del scheduler en formato de exposición de Prometheus"""
+    return PlainTextResponse(scheduler_metrics_text(), media_type="text/plain; version=0.0.4")
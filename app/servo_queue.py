@@ -0,0 +1,400 @@
+import asyncio
+import os
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Deque, Dict, Iterable, Optional, Set, Tuple
+from sqlalchemy import DateTime, bindparam, text
+from starlette.concurrency import run_in_threadpool
+from app.database import engine
+from app.command_listener import NotifyListener
+from app.command_bus import command_bus, DeviceCommand
+from app.command_tracker import command_tracker
+from app.devices.models import DeviceCommandQueue
+
+# =======================================================
+# Colas de comandos del servo por dispositivo
+# =======================================================
+#
+# Cada comando que sale por el bus se encola para su dispositivo con vencimiento
+# (SERVO_COMMAND_TTL). El ESP32 lo recoge con GET /devices/devices/servo-command?device_id=…
+# en orden de llegada; recogerlo lo borra. Con SERVO_QUEUE_BACKEND=db (por defecto)
+# las colas viven en device_command_queue, así cualquier worker atiende a cualquier
+# dispositivo y los comandos sobreviven a un reinicio: encolar es un INSERT y
+# recoger un DELETE ... RETURNING de la fila más vieja por el índice
+# (device_iot_id, id), con FOR UPDATE SKIP LOCKED en PostgreSQL para que dos
+# workers no entreguen el mismo comando. Con SERVO_QUEUE_BACKEND=memory (o si el
+# INSERT falla) las colas son deques en memoria del worker.
+#
+# Los comandos sin dispositivo (POST servo-command sin device_id) van a la cola 0.
+# Un GET sin device_id lee la cola de SERVO_LEGACY_DEVICE_ID si está configurada
+# (firmware antiguo con una sola válvula) o, si no, la cola 0. Sin SERVO_LEGACY_DEVICE_ID
+# cada comando de un dispositivo se copia también a la cola 0 (SERVO_LEGACY_MIRROR), así
+# el firmware antiguo sigue recibiendo todos los comandos como antes de las colas por
+# dispositivo. La copia va sin command_id: no se sigue ni se reintenta.
+#
+# Long-poll y SSE: la conexión que espera registra un asyncio.Event por dispositivo y
+# queda dormida en el event loop sin ocupar hilos. El hilo del bus que encola el comando
+# lo despierta con call_soon_threadsafe.
+#
+# Entre workers (PostgreSQL): el INSERT del comando hace en la misma transacción
+# pg_notify(SERVO_CHANNEL, "device_id,pid"), así el aviso sale sólo si el comando quedó
+# encolado. Cada worker escucha el canal con una conexión LISTEN en su event loop
+# (command_listener) y despierta a sus esperas de ese dispositivo; la que llegue primero
+# lo recoge de la cola compartida (SKIP LOCKED), las demás vuelven a esperar. Los avisos
+# del propio worker se ignoran (ya despertó a sus esperas al encolar). Con la conexión
+# LISTEN activa las esperas sólo se despiertan por avisos, sin consultar la base. Si se
+# corta, al reconectar se despiertan todas las esperas y, mientras tanto, cada una vuelve
+# a mirar la cola cada SERVO_WAIT_RECHECK segundos.
+# Con SERVO_QUEUE_BACKEND=memory los comandos no salen del worker: sólo sirve con uno.
+#
+# Un comando recogido para una conexión que no llegó a escribirlo (el cliente se fue o la
+# espera se canceló mientras se recogía) se vuelve a publicar con requeue, con su command_id.
+#
+# Cada comando se entrega con su command_id y queda anotado en app.command_tracker
+# (confirmación, reintentos y latencias). Los reintentos vencidos se vuelven a encolar
+# aquí (retry_unacked), con el mismo id.
+
+SERVO_QUEUE_BACKEND    = os.getenv("SERVO_QUEUE_BACKEND", "db")                # db | memory
+SERVO_COMMAND_TTL      = float(os.getenv("SERVO_COMMAND_TTL", "300"))          # s
+SERVO_QUEUE_MAX        = int(os.getenv("SERVO_QUEUE_MAX", "32"))               # por dispositivo, en memoria
+SERVO_LEGACY_DEVICE_ID = os.getenv("SERVO_LEGACY_DEVICE_ID")
+SERVO_LEGACY_MIRROR    = os.getenv("SERVO_LEGACY_MIRROR", "true").lower() in ("1", "true", "yes")
+SERVO_PRUNE_EVERY      = 1000                                                  # comandos entre purgas de vencidos
+SERVO_WAIT_TIMEOUT     = float(os.getenv("SERVO_WAIT_TIMEOUT", "25"))          # s, long-poll por defecto
+SERVO_WAIT_MAX         = float(os.getenv("SERVO_WAIT_MAX", "60"))              # s, tope del long-poll
+SERVO_WAIT_RECHECK     = float(os.getenv("SERVO_WAIT_RECHECK", "5"))           # s entre revisiones sin LISTEN
+SERVO_SSE_KEEPALIVE    = float(os.getenv("SERVO_SSE_KEEPALIVE", "15"))         # s entre comentarios keepalive
+SERVO_CHANNEL          = os.getenv("SERVO_CHANNEL", "servo_commands")           # canal NOTIFY entre workers
+
+BROADCAST_DEVICE_ID = 0
+
+TABLE = DeviceCommandQueue.__tablename__
+
+_EXPIRE_SQL = text(f"""
+    DELETE FROM {TABLE}
+     WHERE device_iot_id = :device_id AND expires_at <= :now
+""").bindparams(bindparam("now", type_=DateTime))
+
+_TAKE_SQL = """
+    DELETE FROM {table}
+     WHERE id = (
+         SELECT id FROM {table}
+          WHERE device_iot_id = :device_id AND expires_at > :now
+          ORDER BY id
+          LIMIT 1
+          {lock}
+     )
+    RETURNING command_id, action
+"""
+TAKE_SQL = text(_TAKE_SQL.format(table=TABLE, lock="FOR UPDATE SKIP LOCKED")).bindparams(
+    bindparam("now", type_=DateTime))
+TAKE_SQL_NO_LOCK = text(_TAKE_SQL.format(table=TABLE, lock="")).bindparams(
+    bindparam("now", type_=DateTime))
+
+_NOTIFY_SQL = text("SELECT pg_notify(:channel, :payload)")
+
+_PRUNE_SQL = text(f"DELETE FROM {TABLE} WHERE expires_at <= :now").bindparams(
+    bindparam("now", type_=DateTime))
+
+
+class QueuedCommand:
+    __slots__ = ("command_id", "action")
+
+    def __init__(self, command_id: Optional[str], action: str):
+        self.command_id = command_id
+        self.action = action
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"action": self.action, "command_id": self.command_id or ""}
+
+
+class ServoQueues:
+    def __init__(
+        self,
+        backend: str = SERVO_QUEUE_BACKEND,
+        ttl: float = SERVO_COMMAND_TTL,
+        max_per_device: int = SERVO_QUEUE_MAX,
+        legacy_device_id: Optional[int] = int(SERVO_LEGACY_DEVICE_ID) if SERVO_LEGACY_DEVICE_ID else None,
+        legacy_mirror: bool = SERVO_LEGACY_MIRROR
+    ):
+        self.backend = backend
+        self.ttl = timedelta(seconds=ttl)
+        self.max_per_device = max_per_device
+        self.legacy_device_id = legacy_device_id
+        # Sin dispositivo heredado configurado, el firmware antiguo lee la cola 0
+        self.legacy_mirror = legacy_mirror and legacy_device_id is None
+        self._memory: Dict[int, Deque[Tuple[datetime, QueuedCommand]]] = {}   # device_id → (vence, comando)
+        self._lock = threading.Lock()
+        self._waiters: Dict[int, Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]]] = {}
+        self._enqueued_db = 0
+        self.enqueued = 0
+        self.delivered = 0
+        self.expired = 0
+        self.dropped = 0
+        self.fallbacks = 0
+        self.wakeups = 0
+        self.notified = 0
+        self.remote_wakeups = 0
+        self.retried = 0
+        self.requeued = 0
+        self.mirrored = 0
+
+    @staticmethod
+    def _key(device_id: Optional[int]) -> int:
+        return BROADCAST_DEVICE_ID if device_id is None else device_id
+
+    def _resolve(self, device_id: Optional[int]) -> int:
+        """Cola que atiende un GET: la del dispositivo, o la del firmware antiguo si no trae device_id."""
+        return self._key(self.legacy_device_id if device_id is None else device_id)
+
+    def _mirrors(self, command: DeviceCommand, device_id: int) -> bool:
+        """Si el comando se copia a la cola 0 para el firmware antiguo (los reenvíos ya se copiaron)."""
+        return self.legacy_mirror and device_id != BROADCAST_DEVICE_ID and not command.reissued
+
+    # ── Encolar (suscriptor del bus) ────────────────────────
+    def deliver(self, command: DeviceCommand) -> None:
+        device_id = self._key(command.device_id)
+        expires_at = command.created_at + self.ttl
+        mirror = self._mirrors(command, device_id)
+        self.enqueued += 1
+        if self.backend == "db":
+            try:
+                with engine.begin() as conn:
+                    rows = [{
+                        "command_id": command.command_id, "device_iot_id": device_id, "action": command.action,
+                        "source": command.source, "created_at": command.created_at, "expires_at": expires_at
+                    }]
+                    if mirror:
+                        rows.append(dict(rows[0], command_id=None, device_iot_id=BROADCAST_DEVICE_ID))
+                    conn.execute(DeviceCommandQueue.__table__.insert(), rows)
+                    command_tracker.record(conn, command, device_id)
+                    if conn.dialect.name == "postgresql":
+                        for queue_id in (device_id, BROADCAST_DEVICE_ID) if mirror else (device_id,):
+                            conn.execute(_NOTIFY_SQL, {"channel": SERVO_CHANNEL, "payload": f"{queue_id},{os.getpid()}"})
+                        self.notified += 1
+                    self._enqueued_db += 1
+                    if self._enqueued_db % SERVO_PRUNE_EVERY == 0:
+                        self.expired += conn.execute(_PRUNE_SQL, {"now": datetime.now()}).rowcount
+            except Exception as e:
+                self.fallbacks += 1
+                print(f"[servo] No se pudo encolar {command} en la base, queda en memoria:", e)
+                self._enqueue_memory(device_id, expires_at, QueuedCommand(command.command_id, command.action))
+                if mirror:
+                    self._enqueue_memory(BROADCAST_DEVICE_ID, expires_at, QueuedCommand(None, command.action))
+        else:
+            self._enqueue_memory(device_id, expires_at, QueuedCommand(command.command_id, command.action))
+            if mirror:
+                self._enqueue_memory(BROADCAST_DEVICE_ID, expires_at, QueuedCommand(None, command.action))
+            self._tracked(lambda conn: command_tracker.record(conn, command, device_id))
+        self._notify(device_id)
+        if mirror:
+            self.mirrored += 1
+            self._notify(BROADCAST_DEVICE_ID)
+
+    @staticmethod
+    def _tracked(step, default=None):
+        """Seguimiento de un comando de la cola en memoria: si la base falla, el comando sigue su curso."""
+        try:
+            with engine.begin() as conn:
+                return step(conn)
+        except Exception as e:
+            command_tracker.errors += 1
+            print("[servo] No se pudo anotar el seguimiento del comando:", e)
+            return default
+
+    def _enqueue_memory(self, device_id: int, expires_at: datetime, command: QueuedCommand) -> None:
+        with self._lock:
+            queue = self._memory.setdefault(device_id, deque())
+            queue.append((expires_at, command))
+            if len(queue) > self.max_per_device:
+                queue.popleft()
+                self.dropped += 1
+
+    # ── Recoger (GET del ESP32) ─────────────────────────────
+    def take(self, device_id: Optional[int] = None, acks: bool = False) -> Optional[QueuedCommand]:
+        """
+        Siguiente comando vigente del dispositivo (None si no hay); lo saca de la cola.
+        acks: el dispositivo confirmará el comando (si no, no se reintenta).
+        """
+        device_id = self._resolve(device_id)
+        now = datetime.now()
+        command = self._take_memory(device_id, now, acks)
+        if command is None and self.backend == "db":
+            command = self._take_db(device_id, now, acks)
+        if command is not None:
+            self.delivered += 1
+        return command
+
+    def _take_memory(self, device_id: int, now: datetime, acks: bool) -> Optional[QueuedCommand]:
+        while True:
+            with self._lock:
+                queue = self._memory.get(device_id)
+                command = None
+                while queue:
+                    expires_at, command = queue.popleft()
+                    if expires_at > now:
+                        break
+                    self.expired += 1
+                    command = None
+                if not queue:
+                    self._memory.pop(device_id, None)
+            if command is None:
+                return None
+            if self._tracked(lambda conn: command_tracker.mark_delivered(conn, command.command_id, acks, now), True):
+                return command
+
+    def _take_db(self, device_id: int, now: datetime, acks: bool) -> Optional[QueuedCommand]:
+        sql = TAKE_SQL if engine.dialect.name == "postgresql" else TAKE_SQL_NO_LOCK
+        params = {"device_id": device_id, "now": now}
+        with engine.begin() as conn:
+            self.expired += conn.execute(_EXPIRE_SQL, params).rowcount
+            while True:
+                row = conn.execute(sql, params).first()
+                if row is None:
+                    return None
+                # Una copia de un reintento cuyo comando ya se confirmó se descarta
+                if command_tracker.mark_delivered(conn, row.command_id, acks, now):
+                    return QueuedCommand(row.command_id, row.action)
+
+    def requeue(self, device_id: Optional[int], commands: Iterable[QueuedCommand]) -> None:
+        """Vuelve a publicar, en orden y con su command_id, comandos recogidos que no se enviaron."""
+        device_id = self._resolve(device_id)
+        for command in commands:
+            command_bus.publish(device_id, command.action, source="requeue", command_id=command.command_id)
+            self.requeued += 1
+
+    # ── Reintentos (barrido de app.command_tracker) ─────────
+    def retry_unacked(self) -> int:
+        """Vuelve a encolar los comandos entregados cuya confirmación venció."""
+        now = datetime.now()
+        expires_at = now + self.ttl
+        with engine.begin() as conn:
+            retries = command_tracker.due_retries(conn, now)
+            if retries and self.backend == "db":
+                conn.execute(DeviceCommandQueue.__table__.insert(), [
+                    {"command_id": r.id, "device_iot_id": r.device_iot_id, "action": r.action,
+                     "source": "retry", "created_at": now, "expires_at": expires_at}
+                    for r in retries
+                ])
+                if conn.dialect.name == "postgresql":
+                    for device_id in {r.device_iot_id for r in retries}:
+                        conn.execute(_NOTIFY_SQL, {"channel": SERVO_CHANNEL, "payload": f"{device_id},{os.getpid()}"})
+        if self.backend != "db":
+            for r in retries:
+                self._enqueue_memory(r.device_iot_id, expires_at, QueuedCommand(r.id, r.action))
+        for device_id in {r.device_iot_id for r in retries}:
+            self._notify(device_id)
+        self.retried += len(retries)
+        return len(retries)
+
+    # ── Espera asíncrona (long-poll y SSE) ──────────────────
+    def _notify(self, device_id: int) -> None:
+        """Despierta las conexiones que esperan un comando del dispositivo (desde cualquier hilo)."""
+        with self._lock:
+            waiters = list(self._waiters.get(device_id, ()))
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+                self.wakeups += 1
+            except RuntimeError:
+                pass  # el event loop de esa conexión ya se cerró
+
+    def on_notify(self, payload: str) -> None:
+        """Aviso NOTIFY de un comando encolado (por este u otro worker)."""
+        try:
+            device_id, pid = (int(part) for part in payload.split(","))
+        except ValueError:
+            print(f"[servo] Aviso NOTIFY inválido: {payload!r}")
+            return
+        if pid != os.getpid():
+            self.remote_wakeups += 1
+            self._notify(device_id)
+
+    def notify_all(self) -> None:
+        """Despierta todas las esperas para que revisen la cola (avisos posiblemente perdidos)."""
+        with self._lock:
+            device_ids = list(self._waiters)
+        for device_id in device_ids:
+            self._notify(device_id)
+
+    def _recheck_interval(self, remaining: float) -> float:
+        """
+        Cuánto dormir sin aviso. Los avisos alcanzan salvo con la cola en la base de
+        PostgreSQL y la conexión LISTEN caída: un comando de otro worker no despertaría.
+        """
+        if self.backend == "db" and command_listener.is_postgres and not command_listener.listening:
+            return min(remaining, SERVO_WAIT_RECHECK)
+        return remaining
+
+    async def _take_async(self, device_id: int, acks: bool) -> Optional[QueuedCommand]:
+        # También con memory: la entrega se anota en device_command_log
+        task = asyncio.ensure_future(run_in_threadpool(self.take, device_id, acks))
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # El hilo sigue y puede sacar un comando de la cola que ya nadie va a enviar
+            def done(t: asyncio.Future) -> None:
+                if not t.cancelled() and t.exception() is None and t.result() is not None:
+                    self.requeue(device_id, [t.result()])
+            task.add_done_callback(done)
+            raise
+
+    async def wait_take(self, device_id: Optional[int], timeout: float, acks: bool = False) -> Optional[QueuedCommand]:
+        """Como take(), pero espera hasta `timeout` segundos a que llegue un comando."""
+        device_id = self._resolve(device_id)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        waiter = (loop, asyncio.Event())
+        # Registrarse antes de mirar la cola: un comando que llegue entre medio deja el Event puesto
+        with self._lock:
+            self._waiters.setdefault(device_id, set()).add(waiter)
+        try:
+            while True:
+                waiter[1].clear()
+                command = await self._take_async(device_id, acks)
+                remaining = deadline - loop.time()
+                if command is not None or remaining <= 0:
+                    return command
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), self._recheck_interval(remaining))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(device_id)
+                if waiters is not None:
+                    waiters.discard(waiter)
+                    if not waiters:
+                        del self._waiters[device_id]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            in_memory = sum(len(q) for q in self._memory.values())
+            waiting = sum(len(w) for w in self._waiters.values())
+        return {
+            "backend": self.backend,
+            "ttl_seconds": self.ttl.total_seconds(),
+            "legacy_device_id": self.legacy_device_id,
+            "legacy_mirror": self.legacy_mirror,
+            "mirrored": self.mirrored,
+            "enqueued": self.enqueued,
+            "delivered": self.delivered,
+            "expired": self.expired,
+            "dropped_overflow": self.dropped,
+            "db_fallbacks": self.fallbacks,
+            "in_memory": in_memory,
+            "waiting_connections": waiting,
+            "wakeups": self.wakeups,
+            "notified": self.notified,
+            "remote_wakeups": self.remote_wakeups,
+            "retried": self.retried,
+            "requeued": self.requeued,
+            "listener": command_listener.stats()
+        }
+
+
+servo_queues = ServoQueues()
+command_bus.subscribe(servo_queues.deliver)
+command_tracker.on_retry(servo_queues.retry_unacked)
+command_listener = NotifyListener(SERVO_CHANNEL, servo_queues.on_notify, servo_queues.notify_all)
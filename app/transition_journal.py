@@ -0,0 +1,170 @@
+import os
+import threading
+from collections import deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app.database import engine
+from app.devices.models import DeviceStatusTransition
+
+# =======================================================
+# Journal de transiciones de estado de los dispositivos
+# =======================================================
+#
+# Cada cambio de device_iot.status se anota en la sesión que lo hace y, al confirmar
+# la transacción, pasa a un buffer en memoria (se descarta si hay rollback). Un hilo
+# lo inserta en device_status_transition en lotes de hasta JOURNAL_FLUSH_MAX_ITEMS
+# filas o cada JOURNAL_FLUSH_INTERVAL segundos. Si la inserción falla, las filas
+# vuelven al buffer para el próximo intento.
+
+JOURNAL_FLUSH_MAX_ITEMS = int(os.getenv("JOURNAL_FLUSH_MAX_ITEMS", "500"))
+JOURNAL_FLUSH_INTERVAL  = float(os.getenv("JOURNAL_FLUSH_INTERVAL", "1.0"))   # segundos
+JOURNAL_BUFFER_MAX      = int(os.getenv("JOURNAL_BUFFER_MAX", "100000"))      # se descartan las más antiguas
+
+_PENDING_KEY = "pending_status_transitions"
+
+
+class TransitionJournal:
+    def __init__(
+        self,
+        flush_max_items: int = JOURNAL_FLUSH_MAX_ITEMS,
+        flush_interval: float = JOURNAL_FLUSH_INTERVAL,
+        buffer_max: int = JOURNAL_BUFFER_MAX
+    ):
+        self.flush_max_items = flush_max_items
+        self.flush_interval = flush_interval
+        self._buffer: Deque[Dict[str, Any]] = deque()
+        self._buffer_max = buffer_max
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.recorded = 0
+        self.written = 0
+        self.discarded = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+
+    def record_after_commit(
+        self,
+        db: Session,
+        device_id: int,
+        lot_id: Optional[int],
+        from_status: Optional[int],
+        to_status: int,
+        source: str,
+        request_id: Optional[int] = None,
+        ts: Optional[datetime] = None
+    ) -> None:
+        """Anotar una transición que se escribe sólo si la transacción de `db` confirma."""
+        db.connection()  # asegura una transacción abierta para que commit/rollback la cierren
+        db.info.setdefault(_PENDING_KEY, []).append({
+            "device_iot_id": device_id,
+            "lot_id": lot_id,
+            "request_id": request_id,
+            "from_status": from_status,
+            "to_status": to_status,
+            "source": source,
+            "ts": ts or datetime.now()
+        })
+
+    def _after_commit(self, session: Session) -> None:
+        rows = session.info.pop(_PENDING_KEY, None)
+        if rows:
+            self._append(rows)
+
+    def _after_rollback(self, session: Session, previous_transaction=None) -> None:
+        self.discarded += len(session.info.pop(_PENDING_KEY, ()))
+
+    def _append(self, rows: List[Dict[str, Any]]) -> None:
+        with self._cond:
+            self._buffer.extend(rows)
+            self.recorded += len(rows)
+            while len(self._buffer) > self._buffer_max:
+                self._buffer.popleft()
+                self.dropped += 1
+            if len(self._buffer) >= self.flush_max_items:
+                self._cond.notify()
+
+    # ── Escritura en lotes ──────────────────────────────────
+    def flush(self) -> int:
+        """Inserta lo acumulado en lotes. Devuelve cuántas filas escribió."""
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._cond:
+                    batch = [self._buffer.popleft() for _ in range(min(self.flush_max_items, len(self._buffer)))]
+                if not batch:
+                    return written
+                try:
+                    with engine.begin() as conn:
+                        conn.execute(DeviceStatusTransition.__table__.insert(), batch)
+                except Exception as e:
+                    self.failed_flushes += 1
+                    with self._cond:
+                        self._buffer.extendleft(reversed(batch))
+                    print("[journal] Error escribiendo transiciones:", e)
+                    return written
+                self.flushes += 1
+                self.written += len(batch)
+                written += len(batch)
+
+    def run(self) -> None:
+        print("[journal] hilo de escritura iniciado")
+        while not self._stop.is_set():
+            with self._cond:
+                if len(self._buffer) < self.flush_max_items:
+                    self._cond.wait(self.flush_interval)
+            self.flush()
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Detiene el hilo y escribe lo pendiente."""
+        self._stop.set()
+        with self._cond:
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+        self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "buffered": len(self._buffer),
+            "recorded": self.recorded,
+            "written": self.written,
+            "discarded_on_rollback": self.discarded,
+            "dropped_overflow": self.dropped,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "flush_max_items": self.flush_max_items,
+            "flush_interval": self.flush_interval
+        }
+
+
+transition_journal = TransitionJournal()
+
+event.listen(Session, "after_commit", transition_journal._after_commit)
+event.listen(Session, "after_soft_rollback", transition_journal._after_rollback)
+
+
+def set_device_status(
+    db: Session,
+    device,
+    status: int,
+    source: str,
+    request_id: Optional[int] = None,
+    ts: Optional[datetime] = None
+) -> None:
+    """Cambia device.status y anota la transición en el journal (si el estado cambia)."""
+    if device.status != status:
+        transition_journal.record_after_commit(
+            db, device.id, device.lot_id, device.status, status, source, request_id, ts
+        )
+    device.status = status
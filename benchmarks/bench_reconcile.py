@@ -0,0 +1,118 @@
+import argparse
+import sys
+import time
+from datetime import datetime
+from benchmarks.fleet import configure_database, build_fleet, reset_statuses
+
+# =======================================================
+# Benchmark: reconciliación de estados del scheduler
+# =======================================================
+#
+# Compara la versión por filas (tres subconsultas + un get por dispositivo + un
+# SELECT por válvula) con la sentencia única de app.arduino_reader.
+#
+#   python -m benchmarks.bench_reconcile --sizes 10000 100000
+
+configure_database("bench_reconcile")
+
+from sqlalchemy import event, text              # noqa: E402
+from app.database import engine, SessionLocal   # noqa: E402
+from app import arduino_reader                  # noqa: E402
+from app.devices.models import DeviceIot        # noqa: E402
+
+arduino_reader.print = lambda *args, **kwargs: None
+
+_LATEST_APPROVED = """
+    SELECT r.device_iot_id, r.{column}
+      FROM request r
+      JOIN (
+          SELECT MAX(id) max_id
+            FROM request
+           WHERE status = 17
+           GROUP BY device_iot_id
+      ) x ON r.id = x.max_id
+     WHERE {condition}
+"""
+
+
+def legacy_reconcile(db, now: datetime) -> None:
+    """Revisión anterior: O(dispositivos) consultas por tick."""
+    for dev_id, _ in db.execute(text(_LATEST_APPROVED.format(column="close_date", condition="r.close_date < :now")),
+                                {"now": now}).fetchall():
+        dev = db.query(DeviceIot).get(dev_id)
+        if dev and dev.status != 12:
+            dev.status = 12
+    for dev_id, _ in db.execute(text(_LATEST_APPROVED.format(
+            column="open_date", condition=":now BETWEEN r.open_date AND r.close_date")), {"now": now}).fetchall():
+        dev = db.query(DeviceIot).get(dev_id)
+        if dev and dev.status == 20:
+            dev.status = 22
+    for dev_id, _ in db.execute(text(_LATEST_APPROVED.format(column="open_date", condition="r.open_date > :now")),
+                                {"now": now}).fetchall():
+        dev = db.query(DeviceIot).get(dev_id)
+        if dev and dev.status not in (21, 22):
+            dev.status = 20
+    for dev in db.query(DeviceIot).filter(DeviceIot.devices_id == arduino_reader.VALVE_TYPE_ID):
+        any_req = db.execute(text("""
+            SELECT 1 FROM request WHERE device_iot_id = :dev_id AND status = 17 LIMIT 1
+        """), {"dev_id": dev.id}).first()
+        if not any_req and dev.status != 12:
+            dev.status = 12
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args, **kwargs):
+        self.count += 1
+
+
+def measure(fn, now: datetime, counter: QueryCounter):
+    db = SessionLocal()
+    try:
+        counter.count = 0
+        started = time.perf_counter()
+        fn(db, now)
+        db.commit()
+        return time.perf_counter() - started, counter.count
+    finally:
+        db.close()
+
+
+def statuses():
+    with engine.connect() as conn:
+        return dict(conn.execute(text("SELECT id, status FROM device_iot")).fetchall())
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--skip-legacy-above", type=int, default=None,
+                        help="no medir la versión por filas por encima de este tamaño")
+    args = parser.parse_args(argv)
+
+    counter = QueryCounter()
+    print(f"{'válvulas':>9} {'versión':>8} {'tick 1 (s)':>11} {'consultas':>10} {'tick 2 (s)':>11} {'consultas':>10}")
+    for size in args.sizes:
+        now = datetime.now()
+        build_fleet(engine, size, now)
+        results = {}
+        runs = [("set", arduino_reader.reconcile_device_statuses)]
+        if args.skip_legacy_above is None or size <= args.skip_legacy_above:
+            runs.insert(0, ("legacy", legacy_reconcile))
+        for name, fn in runs:
+            reset_statuses(engine)
+            first = measure(fn, now, counter)      # con cambios
+            second = measure(fn, now, counter)     # estado estable: nada que cambiar
+            results[name] = statuses()
+            print(f"{size:>9} {name:>8} {first[0]:>11.3f} {first[1]:>10} {second[0]:>11.3f} {second[1]:>10}")
+        if len(results) == 2 and results["legacy"] != results["set"]:
+            print("  ¡los estados finales no coinciden!")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
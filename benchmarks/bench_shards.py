@@ -0,0 +1,85 @@
+import argparse
+import multiprocessing
+import sys
+import time
+from datetime import datetime
+from benchmarks.fleet import configure_database, build_fleet, reset_statuses
+
+# =======================================================
+# Benchmark: tiempo de tick del scheduler según el número de shards
+# =======================================================
+#
+# Un proceso por shard, todos arrancan a la vez y revisan sólo sus dispositivos
+# (device_iot_id % shards). Se mide el tiempo hasta que termina el último.
+# En SQLite las escrituras se serializan; para ver el escalado real usar PostgreSQL:
+#
+#   DATABASE_URL=postgresql://... python -m benchmarks.bench_shards --valves 100000 --shards 1 2 4 8
+
+configure_database("bench_shards")
+
+from sqlalchemy import text                     # noqa: E402
+from app.database import engine, SessionLocal   # noqa: E402
+from app import arduino_reader                  # noqa: E402
+
+arduino_reader.print = lambda *args, **kwargs: None
+
+
+def _run_shard(shard: int, shards: int, now: datetime, barrier, results) -> None:
+    engine.dispose(close=False)  # conexiones propias en el proceso hijo
+    db = SessionLocal()
+    try:
+        barrier.wait()
+        started = time.perf_counter()
+        changed = arduino_reader.reconcile_device_statuses(db, now, shard, shards)
+        db.commit()
+        results[shard] = (time.perf_counter() - started, len(changed))
+    finally:
+        db.close()
+
+
+def tick(shards: int, now: datetime):
+    """Un tick completo repartido en `shards` procesos. Devuelve (pared, peor shard, cambios)."""
+    ctx = multiprocessing.get_context("fork")
+    barrier = ctx.Barrier(shards + 1)
+    results = ctx.Manager().dict()
+    procs = [ctx.Process(target=_run_shard, args=(s, shards, now, barrier, results)) for s in range(shards)]
+    for p in procs:
+        p.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for p in procs:
+        p.join()
+    wall = time.perf_counter() - started
+    if len(results) != shards:
+        raise RuntimeError("algún shard no terminó (ver errores arriba)")
+    return wall, max(r[0] for r in results.values()), sum(r[1] for r in results.values())
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--valves", type=int, default=100000)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args(argv)
+
+    now = datetime.now()
+    build_fleet(engine, args.valves, now)
+    engine.dispose()
+    print(f"{engine.dialect.name}, {args.valves} válvulas")
+    print(f"{'shards':>7} {'tick (s)':>9} {'peor shard (s)':>15} {'cambios':>8}")
+    expected = None
+    for shards in args.shards:
+        reset_statuses(engine)
+        engine.dispose()
+        wall, worst, changed = tick(shards, now)
+        with engine.connect() as conn:
+            final = conn.execute(text("SELECT id, status FROM device_iot ORDER BY id")).fetchall()
+        expected = expected or final
+        print(f"{shards:>7} {wall:>9.3f} {worst:>15.3f} {changed:>8}")
+        if final != expected:
+            print("  ¡los estados finales no coinciden con 1 shard!")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
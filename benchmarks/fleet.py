@@ -0,0 +1,162 @@
+import os
+import random
+import tempfile
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+# =======================================================
+# Flota sintética de válvulas y solicitudes para los benchmarks
+# =======================================================
+#
+# Los benchmarks usan DATABASE_URL si está definida; si no, una base SQLite temporal.
+# configure_database() debe llamarse antes de importar cualquier módulo de app.
+
+VALVE_TYPE_ID = 2   # devices_id de válvula según app.arduino_reader
+
+# Reparto de la flota según la situación de su último request aprobado
+FLEET_MIX = {
+    "future": 0.40,     # apertura programada → 20
+    "open": 0.30,       # apertura vigente → 22
+    "expired": 0.20,    # cierre vencido → 12
+    "none": 0.10,       # sin solicitudes aprobadas → 12
+}
+
+
+def configure_database(name: str) -> str:
+    """Define DATABASE_URL (SQLite temporal por defecto) y la devuelve."""
+    if not os.getenv("DATABASE_URL"):
+        path = os.path.join(tempfile.gettempdir(), f"disriego_{name}.db")
+        if os.path.exists(path):
+            os.remove(path)
+        os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+    return os.environ["DATABASE_URL"]
+
+
+def reset_schema(engine) -> None:
+    """Crea vacías las tablas device_iot, request y device_status_transition."""
+    from sqlalchemy.schema import CreateTable
+    from app.devices.models import DeviceIot, DeviceStatusTransition
+    from app.devices_request.models import Request
+
+    tables = (DeviceIot.__table__, Request.__table__, DeviceStatusTransition.__table__)
+    for table in reversed(tables):
+        table.drop(engine, checkfirst=True)
+    with engine.begin() as conn:
+        for table in tables:
+            conn.execute(CreateTable(table))
+            # device_iot está mapeada dos veces (devices y devices_request): un índice por nombre
+            for index in {i.name: i for i in table.indexes}.values():
+                index.create(conn)
+
+
+def build_fleet(engine, valves: int, now: datetime, history: int = 2, seed: int = 1) -> Dict[str, int]:
+    """
+    Inserta `valves` válvulas en estado 20 y, por válvula, `history` requests antiguos
+    (rechazados o aprobados y vencidos) más el último request aprobado según FLEET_MIX.
+    Devuelve cuántas válvulas quedaron en cada situación.
+    """
+    from app.devices.models import DeviceIot
+    from app.devices_request.models import Request
+
+    rng = random.Random(seed)
+    reset_schema(engine)
+    kinds = list(FLEET_MIX)
+    weights = [FLEET_MIX[k] for k in kinds]
+    counts = {k: 0 for k in kinds}
+
+    devices, requests = [], []
+    request_id = 0
+    for dev_id in range(1, valves + 1):
+        devices.append({
+            "id": dev_id, "serial_number": dev_id, "lot_id": dev_id, "status": 20,
+            "devices_id": VALVE_TYPE_ID, "installation_date": now - timedelta(days=365)
+        })
+        for h in range(history):
+            request_id += 1
+            start = now - timedelta(days=30 - h)
+            requests.append({
+                "id": request_id, "status": rng.choice((17, 19)), "lot_id": dev_id, "device_iot_id": dev_id,
+                "open_date": start, "close_date": start + timedelta(hours=2), "request_date": start
+            })
+        kind = rng.choices(kinds, weights)[0]
+        counts[kind] += 1
+        if kind == "none":
+            for r in requests[-history:]:
+                r["status"] = 19
+            continue
+        offset = {"future": timedelta(hours=3), "open": timedelta(minutes=-30),
+                  "expired": timedelta(hours=-5)}[kind]
+        request_id += 1
+        requests.append({
+            "id": request_id, "status": 17, "lot_id": dev_id, "device_iot_id": dev_id,
+            "open_date": now + offset, "close_date": now + offset + timedelta(hours=2),
+            "request_date": now - timedelta(days=1)
+        })
+
+    with engine.begin() as conn:
+        for i in range(0, len(devices), 5000):
+            conn.execute(DeviceIot.__table__.insert(), devices[i:i + 5000])
+        for i in range(0, len(requests), 5000):
+            conn.execute(Request.__table__.insert(), requests[i:i + 5000])
+    return counts
+
+
+def reset_statuses(engine, status: int = 20) -> None:
+    """Vuelve todas las válvulas al estado inicial para repetir una medición."""
+    from sqlalchemy import text
+
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE device_iot SET status = :status"), {"status": status})
+
+
+def build_timeline(
+    engine,
+    requests: int,
+    start: datetime,
+    per_device: int = 4,
+    slot: timedelta = timedelta(minutes=15),
+    spread_slots: int = 96,
+    reject_ratio: float = 0.1,
+    seed: int = 1
+) -> List[Tuple[datetime, int, int]]:
+    """
+    Inserta requests / per_device válvulas en estado 12 y sus `requests` solicitudes
+    pendientes (18), una tras otra por válvula y alineadas a `slot`: cada una se decide
+    después de que cierra la anterior, abre 1-24 slots después de decidirse y dura 1-8.
+    Devuelve los eventos (instante, request_id, nuevo estado 17/19) ordenados por instante.
+    """
+    from app.devices.models import DeviceIot
+    from app.devices_request.models import Request
+
+    rng = random.Random(seed)
+    reset_schema(engine)
+    devices, rows, events = [], [], []
+    valves = max(1, requests // per_device)
+    for request_id in range(1, requests + 1):
+        dev_id = (request_id - 1) % valves + 1
+        if dev_id > len(devices):
+            devices.append({
+                "id": dev_id, "serial_number": dev_id, "lot_id": dev_id, "status": 12,
+                "devices_id": VALVE_TYPE_ID, "installation_date": start - timedelta(days=365),
+                "_cursor": start + slot * rng.randrange(spread_slots)
+            })
+        device = devices[dev_id - 1]
+        decided = device["_cursor"] + slot * rng.randrange(4)
+        open_date = decided + slot * rng.randint(1, 24)
+        close_date = open_date + slot * rng.randint(1, 8)
+        device["_cursor"] = close_date + slot
+        rows.append({
+            "id": request_id, "status": 18, "lot_id": dev_id, "device_iot_id": dev_id,
+            "open_date": open_date, "close_date": close_date, "request_date": decided - slot
+        })
+        events.append((decided, request_id, 19 if rng.random() < reject_ratio else 17))
+
+    for device in devices:
+        del device["_cursor"]
+    with engine.begin() as conn:
+        for i in range(0, len(devices), 5000):
+            conn.execute(DeviceIot.__table__.insert(), devices[i:i + 5000])
+        for i in range(0, len(rows), 5000):
+            conn.execute(Request.__table__.insert(), rows[i:i + 5000])
+    events.sort()
+    return events
@@ -0,0 +1,224 @@
+import argparse
+import csv
+import json
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from benchmarks.fleet import configure_database, build_timeline
+
+# =======================================================
+# Simulación del scheduler de válvulas con reloj virtual
+# =======================================================
+#
+# Carga una flota sintética de solicitudes (ver fleet.build_timeline) y conduce el
+# DeadlineScheduler de app.arduino_reader saltando el reloj de un evento al siguiente:
+# las aprobaciones/rechazos (que en la API despiertan al scheduler) y los deadlines de
+# su heap. Registra cada transición de estado y cada comando que sale por el bus,
+# y comprueba que coincidan con lo esperado según las fechas de cada solicitud.
+#
+#   python -m benchmarks.simulate_scheduler --requests 100000
+#   python -m benchmarks.simulate_scheduler --requests 20000 --record /tmp/sim.csv --json
+
+configure_database("simulate_scheduler")
+
+from sqlalchemy import DateTime, text                               # noqa: E402
+from app.database import engine, SessionLocal                       # noqa: E402
+from app import arduino_reader                                      # noqa: E402
+from app.arduino_reader import DeadlineScheduler                    # noqa: E402
+from app.command_bus import command_bus, DeviceCommand              # noqa: E402
+from app.transition_journal import transition_journal               # noqa: E402
+
+arduino_reader.print = lambda *args, **kwargs: None
+
+Transition = Tuple[datetime, int, Optional[int], int]   # (instante virtual, device_iot_id, antes, después)
+Command = Tuple[datetime, int, str]                     # (instante virtual, device_iot_id, acción)
+
+
+class VirtualClock:
+    def __init__(self, start: datetime):
+        self._now = start
+
+    def now(self) -> datetime:
+        return self._now
+
+    def advance_to(self, when: datetime) -> None:
+        if when > self._now:
+            self._now = when
+
+
+class SimulatedLeader:
+    """Siempre líder: la simulación corre en un único proceso."""
+    is_leader = True
+    is_postgres = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {"name": "simulation", "is_leader": True}
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def expected_history(events: List[Tuple[datetime, int, int]]) -> Tuple[Counter, Counter]:
+    """Transiciones y comandos que debe producir cada solicitud aprobada."""
+    approved = {request_id: at for at, request_id, status in events if status == 17}
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT id, device_iot_id, open_date, close_date FROM request")
+                            .columns(open_date=DateTime, close_date=DateTime)).fetchall()
+    transitions, commands = Counter(), Counter()
+    for request_id, dev_id, open_date, close_date in rows:
+        decided = approved.get(request_id)
+        if decided is None:
+            continue
+        closed = close_date + timedelta(milliseconds=1)
+        transitions.update([(decided, dev_id, 12, 20), (open_date, dev_id, 20, 22), (closed, dev_id, 22, 12)])
+        commands.update([(open_date, dev_id, "open"), (closed, dev_id, "close")])
+    return transitions, commands
+
+
+class Simulation:
+    def __init__(self, start: datetime, events: List[Tuple[datetime, int, int]]):
+        self.clock = VirtualClock(start)
+        self.events = events
+        self.scheduler = DeadlineScheduler(SimulatedLeader(), max_idle=0, clock=self.clock.now)
+        self.transitions: List[Transition] = []
+        self.commands: List[Command] = []
+        self.tick_seconds: List[float] = []
+        self.ticks: Counter = Counter()
+        with engine.connect() as conn:
+            self.statuses: Dict[int, Optional[int]] = dict(conn.execute(text("SELECT id, status FROM device_iot")).fetchall())
+        command_bus.subscribe(self._on_command)
+
+    def _on_command(self, command: DeviceCommand) -> None:
+        self.commands.append((self.clock.now(), command.device_id, command.action))
+
+    def _decide(self, batch: List[Tuple[int, int]]) -> None:
+        """Aprobaciones y rechazos del mismo instante, como approve_request/reject_request."""
+        db = SessionLocal()
+        try:
+            db.execute(text("UPDATE request SET status = :status WHERE id = :id"),
+                       [{"id": request_id, "status": status} for request_id, status in batch])
+            db.commit()
+        finally:
+            db.close()
+
+    def _tick(self, reason: str) -> None:
+        self.ticks[reason] += 1
+        started = time.perf_counter()
+        changed = self.scheduler.tick(reason)
+        self.tick_seconds.append(time.perf_counter() - started)
+        now = self.clock.now()
+        for dev_id, status, _ in changed:
+            self.transitions.append((now, dev_id, self.statuses.get(dev_id), status))
+            self.statuses[dev_id] = status
+        # Los comandos se despachan en otros hilos: esperar para fecharlos en este instante
+        while command_bus.stats()["devices_in_flight"]:
+            time.sleep(0.0005)
+
+    def run(self) -> float:
+        started = time.perf_counter()
+        self._tick("start")
+        i = 0
+        while True:
+            next_event = self.events[i][0] if i < len(self.events) else None
+            next_deadline = self.scheduler.next_deadline()
+            if next_event is None and next_deadline is None:
+                break
+            if next_event is not None and (next_deadline is None or next_event <= next_deadline):
+                self.clock.advance_to(next_event)
+                batch = []
+                while i < len(self.events) and self.events[i][0] == next_event:
+                    batch.append(self.events[i][1:])
+                    i += 1
+                self._decide(batch)
+                self._tick("wake")
+            else:
+                self.clock.advance_to(next_deadline)
+                self._tick("deadline")
+        return time.perf_counter() - started
+
+    def record(self, path: str) -> None:
+        with open(path, "w", newline="") as f:
+            out = csv.writer(f)
+            out.writerow(["virtual_ts", "kind", "device_iot_id", "from_status", "to_status", "action"])
+            for at, dev_id, before, after in self.transitions:
+                out.writerow([at.isoformat(), "transition", dev_id, before, after, ""])
+            for at, dev_id, action in self.commands:
+                out.writerow([at.isoformat(), "command", dev_id, "", "", action])
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=100000)
+    parser.add_argument("--per-device", type=int, default=4, help="solicitudes por válvula")
+    parser.add_argument("--slot-minutes", type=int, default=15, help="granularidad de las fechas")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--record", default=None, help="CSV con transiciones y comandos")
+    parser.add_argument("--json", action="store_true", help="resumen en JSON (para comparar corridas)")
+    args = parser.parse_args(argv)
+
+    start = datetime(2025, 1, 1)
+    loaded = time.perf_counter()
+    events = build_timeline(engine, args.requests, start, per_device=args.per_device,
+                            slot=timedelta(minutes=args.slot_minutes), seed=args.seed)
+    loaded = time.perf_counter() - loaded
+
+    sim = Simulation(start, events)
+    wall = sim.run()
+    transition_journal.flush()
+    with engine.connect() as conn:
+        journal_rows = conn.execute(text("SELECT COUNT(*) FROM device_status_transition")).scalar()
+    expected_transitions, expected_commands = expected_history(events)
+    missing = (expected_transitions - Counter(sim.transitions)) + (expected_commands - Counter(sim.commands))
+    unexpected = (Counter(sim.transitions) - expected_transitions) + (Counter(sim.commands) - expected_commands)
+
+    ticked = sum(sim.tick_seconds)
+    summary = {
+        "requests": args.requests,
+        "valves": len(sim.statuses),
+        "load_seconds": round(loaded, 3),
+        "virtual_hours": round((sim.clock.now() - start).total_seconds() / 3600, 2),
+        "wall_seconds": round(wall, 3),
+        "ticks": dict(sim.ticks),
+        "transitions": len(sim.transitions),
+        "transitions_by_kind": {f"{a}->{b}": n for (a, b), n in
+                                sorted(Counter((t[2], t[3]) for t in sim.transitions).items(), key=str)},
+        "commands": len(sim.commands),
+        "transitions_per_second": round(len(sim.transitions) / wall, 1) if wall else None,
+        "tick_ms": {p: round(percentile(sim.tick_seconds, q) * 1000, 2)
+                    for p, q in (("p50", 50), ("p90", 90), ("p99", 99), ("max", 100))},
+        "tick_seconds_total": round(ticked, 3),
+        "journal_rows": journal_rows,
+        "missing": sum(missing.values()),
+        "unexpected": sum(unexpected.values())
+    }
+    if args.record:
+        sim.record(args.record)
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(f"solicitudes {summary['requests']}, válvulas {summary['valves']} (carga {summary['load_seconds']} s)")
+        print(f"tiempo virtual {summary['virtual_hours']} h en {summary['wall_seconds']} s de pared")
+        print(f"ticks {summary['ticks']}")
+        print(f"transiciones {summary['transitions']} {summary['transitions_by_kind']}, comandos {summary['commands']}")
+        print(f"transiciones/s {summary['transitions_per_second']}")
+        tick_ms = summary["tick_ms"]
+        print(f"tick (ms) p50 {tick_ms['p50']}  p90 {tick_ms['p90']}  p99 {tick_ms['p99']}  max {tick_ms['max']}")
+        print(f"journal {journal_rows} filas, faltantes {summary['missing']}, inesperadas {summary['unexpected']}")
+    for item in list(missing.elements())[:5]:
+        print("  falta:", item)
+    for item in list(unexpected.elements())[:5]:
+        print("  inesperada:", item)
+    if journal_rows != len(sim.transitions):
+        print(f"  el journal tiene {journal_rows} filas para {len(sim.transitions)} transiciones")
+    return 0 if not missing and not unexpected and journal_rows == len(sim.transitions) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,56 @@
+import os
+import tempfile
+
+# La app crea el engine al importarse: base SQLite temporal antes de cualquier import de app
+_DB_FILE = os.path.join(tempfile.mkdtemp(prefix="disriego-tests-"), "test.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{_DB_FILE}"
+
+import pytest
+from sqlalchemy import text
+from app.database import engine, SessionLocal
+from app.devices.models import (
+    DeviceCommandLog, DeviceCommandQueue, DeviceCompressionState, DeviceIotReading, DeviceLeakState, DeviceReadingDedup,
+    DeviceStatusTransition, ConsumptionMeasurement, ConsumptionVolumeSync, RequestVolumeClose
+)
+from app.devices_request.models import Request
+
+# device_iot y maintenance se crean a mano: sus modelos usan tipos de PostgreSQL o no están en este módulo
+DEVICE_IOT_DDL = """
+    CREATE TABLE IF NOT EXISTS device_iot (
+        id INTEGER PRIMARY KEY, serial_number INT, model TEXT, lot_id INT, installation_date TIMESTAMP,
+        maintenance_interval_id INT, estimated_maintenance_date TIMESTAMP, status INT, devices_id INT,
+        price_device JSON, data_devices JSON
+    )
+"""
+MAINTENANCE_DDL = """
+    CREATE TABLE IF NOT EXISTS maintenance (
+        id INTEGER PRIMARY KEY, device_iot_id INT, type_failure_id INT, description_failure TEXT,
+        date TIMESTAMP, maintenance_status_id INT
+    )
+"""
+
+TABLES = (
+    Request.__table__, ConsumptionMeasurement.__table__, ConsumptionVolumeSync.__table__, DeviceIotReading.__table__,
+    DeviceReadingDedup.__table__, DeviceStatusTransition.__table__,
+    DeviceCommandQueue.__table__, DeviceCommandLog.__table__, DeviceLeakState.__table__,
+    DeviceCompressionState.__table__, RequestVolumeClose.__table__,
+)
+
+
+@pytest.fixture
+def db():
+    """Sesión sobre tablas vacías."""
+    for table in reversed(TABLES):
+        table.drop(engine, checkfirst=True)
+    with engine.begin() as conn:
+        for table, ddl in (("device_iot", DEVICE_IOT_DDL), ("maintenance", MAINTENANCE_DDL)):
+            conn.execute(text(f"DROP TABLE IF EXISTS {table}"))
+            conn.execute(text(ddl))
+    for table in TABLES:
+        table.create(engine)
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.rollback()
+        session.close()
@@ -0,0 +1,82 @@
+import threading
+import time
+import pytest
+from sqlalchemy import text
+from app.command_bus import CommandBus, command_bus
+
+
+def _wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+@pytest.fixture
+def received(monkeypatch):
+    """Único suscriptor del bus global mientras dura el test."""
+    commands = []
+    monkeypatch.setattr(command_bus, "_handlers", [commands.append])
+    return commands
+
+
+def test_commands_of_a_device_keep_their_order_across_workers():
+    bus = CommandBus(workers=4)
+    release = threading.Event()
+    seen = []
+
+    def handler(command):
+        if command.device_id == 1 and command.action == "open":
+            release.wait(2)   # el despacho del dispositivo 1 queda trabado
+        seen.append((command.device_id, command.action))
+    bus.subscribe(handler)
+
+    for device_id, action in ((1, "open"), (2, "open"), (1, "close"), (2, "close"), (1, "open2")):
+        bus.publish(device_id, action, source="test")
+    # El dispositivo 2 no espera al 1; los comandos del 1 esperan en su cola
+    _wait_for(lambda: seen == [(2, "open"), (2, "close")])
+    assert bus.stats()["queued"] == 2
+    release.set()
+    _wait_for(lambda: bus.stats()["devices_in_flight"] == 0)
+
+    assert [a for d, a in seen if d == 1] == ["open", "close", "open2"]
+    assert bus.stats()["dispatched"] == 5
+
+
+def test_failing_handler_does_not_stop_the_lane():
+    bus = CommandBus(workers=1)
+    seen = []
+
+    def handler(command):
+        if command.action == "boom":
+            raise RuntimeError("servo desconectado")
+        seen.append(command.action)
+    bus.subscribe(handler)
+    for action in ("open", "boom", "close"):
+        bus.publish(7, action, source="test")
+    _wait_for(lambda: bus.stats()["devices_in_flight"] == 0)
+    assert seen == ["open", "close"]
+    assert bus.stats()["failed"] == 1
+
+
+def test_commands_are_dispatched_only_after_commit(db, received):
+    db.execute(text("INSERT INTO device_iot (id, status) VALUES (3, 12)"))
+    command = command_bus.publish_after_commit(db, 3, "open", source="test")
+    time.sleep(0.05)
+    assert received == []
+
+    db.commit()
+    _wait_for(lambda: received == [command])
+
+
+def test_rolled_back_commands_are_discarded(db, received):
+    discarded = command_bus.discarded
+    db.execute(text("INSERT INTO device_iot (id, status) VALUES (3, 22)"))
+    command_bus.publish_after_commit(db, 3, "close", source="test")
+    command_bus.publish_after_commit(db, 4, "close", source="test")
+    db.rollback()
+    assert command_bus.discarded == discarded + 2
+
+    db.commit()
+    time.sleep(0.05)
+    assert received == []
@@ -0,0 +1,52 @@
+import time
+from app.command_bus import DeviceCommand
+from app.command_tracker import STATUS_ACKED, STATUS_SUPERSEDED, command_tracker
+from app.servo_queue import servo_queues
+
+
+def _issue(device_id, action):
+    command = DeviceCommand(device_id, action, "test")
+    servo_queues.deliver(command)
+    time.sleep(0.002)   # issued_at distintos
+    return command
+
+
+def _status(db, command_id):
+    return command_tracker.get(db, command_id)["status"]
+
+
+def test_retry_does_not_outrank_a_newer_command(db, monkeypatch):
+    monkeypatch.setattr(command_tracker, "ack_timeout", 0)
+    opened = _issue(1, "open")
+    assert servo_queues.take(1, acks=True).command_id == opened.command_id   # sin confirmar
+    closed = _issue(1, "close")
+    assert servo_queues.take(1, acks=True).command_id == closed.command_id
+    command_tracker.ack(db, closed.command_id, 1, True, None)
+
+    assert servo_queues.retry_unacked() == 0
+    assert _status(db, opened.command_id) == STATUS_SUPERSEDED
+    assert _status(db, closed.command_id) == STATUS_ACKED
+    assert servo_queues.take(1, acks=True) is None
+
+
+def test_requeued_copy_is_dropped_when_a_newer_command_arrives(db, monkeypatch):
+    monkeypatch.setattr(command_tracker, "ack_timeout", 0)
+    opened = _issue(2, "open")
+    servo_queues.take(2, acks=True)
+    assert servo_queues.retry_unacked() == 1          # copia de "open" en la cola
+    closed = _issue(2, "close")
+
+    taken = servo_queues.take(2, acks=True)
+    assert (taken.command_id, taken.action) == (closed.command_id, "close")
+    assert _status(db, opened.command_id) == STATUS_SUPERSEDED
+    assert servo_queues.take(2, acks=True) is None
+
+
+def test_unacked_command_is_retried_with_its_id(db, monkeypatch):
+    monkeypatch.setattr(command_tracker, "ack_timeout", 0)
+    opened = _issue(3, "open")
+    servo_queues.take(3, acks=True)
+    assert servo_queues.retry_unacked() == 1
+    again = servo_queues.take(3, acks=True)
+    assert (again.command_id, again.action) == (opened.command_id, "open")
+    assert command_tracker.get(db, opened.command_id)["attempts"] == 2
@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+import pytest
+from app.database import engine
+from app.devices.compression import HistoryCompressor
+from app.devices.models import Device, DeviceCompressionState
+from app.devices.templates import device_templates
+
+T0 = datetime(2026, 6, 1, 10, 0)
+SWINGING_DOOR = 1
+
+
+@pytest.fixture
+def template(db):
+    Device.__table__.drop(engine, checkfirst=True)
+    Device.__table__.create(engine)
+    db.add(Device(id=SWINGING_DOOR, properties={"compression": {"algorithm": "swinging_door", "tolerance": 0.5}}))
+    db.commit()
+    device_templates.invalidate()
+
+
+def _row(minute, value):
+    return {"device_iot_id": 9, "ts": T0 + timedelta(minutes=minute), "lot_id": 1, "sensor_value": value, "data": {}}
+
+
+def _offer(compressor, db, minute, value):
+    return [r["ts"] for r in compressor.offer(db, SWINGING_DOOR, _row(minute, value))]
+
+
+def test_another_worker_continues_the_signal(db, template):
+    worker_a, worker_b = HistoryCompressor(), HistoryCompressor()
+    assert _offer(worker_a, db, 0, 10.0) == [T0]
+    assert _offer(worker_a, db, 1, 11.0) == []          # retenido
+    db.commit()
+    assert _offer(worker_b, db, 2, 12.0) == []          # sigue la misma recta
+    assert _offer(worker_b, db, 3, 20.0) == [T0 + timedelta(minutes=2)]
+    db.commit()
+    assert db.get(DeviceCompressionState, 9).held["sensor_value"] == 20.0
+
+
+def test_rollback_keeps_the_held_point(db, template):
+    compressor = HistoryCompressor()
+    _offer(compressor, db, 0, 10.0)
+    _offer(compressor, db, 1, 11.0)
+    db.commit()
+    assert _offer(compressor, db, 2, 30.0) == [T0 + timedelta(minutes=1)]
+    db.rollback()                                       # el punto retenido no llegó al histórico
+
+    assert _offer(HistoryCompressor(), db, 2, 30.0) == [T0 + timedelta(minutes=1)]
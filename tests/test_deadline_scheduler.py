@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import text
+from app import arduino_reader
+from app.arduino_reader import VALVE_TYPE_ID, DeadlineScheduler
+from app.device_twin import device_twin
+from app.leader_election import LeaderElector
+
+T0 = datetime(2026, 5, 1, 6, 0)
+OPEN = T0 + timedelta(hours=1)
+CLOSE = T0 + timedelta(hours=2)
+
+
+class VirtualClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    commands = []
+    monkeypatch.setattr(arduino_reader.command_bus, "publish_after_commit",
+                        lambda db, device_id, action, source: commands.append((device_id, action)))
+    return commands
+
+
+@pytest.fixture
+def scheduler(db, sent):
+    """Válvula 5 en espera con un request aprobado de OPEN a CLOSE; reloj virtual en T0."""
+    db.execute(text("INSERT INTO device_iot (id, lot_id, status, devices_id) VALUES (5, 5, 20, :type)"),
+               {"type": VALVE_TYPE_ID})
+    db.execute(text("INSERT INTO request (status, device_iot_id, open_date, close_date) VALUES (17, 5, :open, :close)"),
+               {"open": OPEN, "close": CLOSE})
+    db.commit()
+    device_twin.invalidate(5)
+    leader = LeaderElector("test_scheduler")
+    leader.start()   # SQLite: único worker, siempre líder
+    return DeadlineScheduler(leader, max_idle=0, clock=VirtualClock(T0))
+
+
+def _status(db):
+    db.expire_all()
+    return db.execute(text("SELECT status FROM device_iot WHERE id = 5")).scalar()
+
+
+def test_sleeps_until_the_next_deadline(db, scheduler):
+    assert scheduler.tick("start") == []
+    assert scheduler.next_deadline() == OPEN
+    assert scheduler.stats()["pending_deadlines"] == 2
+
+    scheduler.clock.now = OPEN - timedelta(seconds=1)
+    scheduler.wake()
+    assert scheduler._wait() == "wake"
+    scheduler.clock.now = OPEN + timedelta(milliseconds=500)
+    assert scheduler._wait() == "deadline"
+
+
+def test_deadlines_open_and_close_the_valve(db, scheduler, sent):
+    scheduler.tick("start")
+
+    scheduler.clock.now = OPEN + timedelta(milliseconds=500)
+    assert scheduler.tick("deadline") == [(5, 22, True)]
+    assert _status(db) == 22
+    assert scheduler.next_deadline() == CLOSE + timedelta(milliseconds=1)
+
+    scheduler.clock.now = CLOSE + timedelta(seconds=1)
+    assert scheduler.tick("deadline") == [(5, 12, True)]
+    assert _status(db) == 12
+    assert scheduler.next_deadline() is None
+    assert sent == [(5, "open"), (5, "close")]
+
+    metrics = scheduler.metrics.snapshot()
+    assert metrics["ticks"] == {"start": 1, "deadline": 2}
+    assert metrics["deadline_lag_ms"]["observed"] == 2
+    assert metrics["recent_ticks"][1]["max_lag_ms"] == 500.0
+
+
+def test_request_changed_outside_the_heap_is_picked_up_on_wake(db, scheduler):
+    scheduler.tick("start")
+    db.execute(text("UPDATE request SET open_date = :open WHERE device_iot_id = 5"),
+               {"open": T0 - timedelta(minutes=1)})
+    db.commit()
+    assert scheduler.tick("wake") == [(5, 22, True)]
+    assert scheduler.next_deadline() == CLOSE + timedelta(milliseconds=1)
@@ -0,0 +1,61 @@
+from app.devices.dedup import DUPLICATE, NEW, RESET, ReadingDedup, SeqWindow
+
+
+def _apply(dedup, db, device_id, seqs, boot=None):
+    """Reclama y confirma un lote de lecturas; devuelve los seq aceptados como nuevos."""
+    items = [(device_id, dedup.key_for(s, None, boot), s) for s in seqs]
+    fresh = [i for i in items if dedup.lookup(i[0], i[1], i[2]) is None]
+    accepted = dedup.claim(db, fresh)
+    db.commit()
+    for device_id_, key, seq in fresh:
+        if (device_id_, key) in accepted:
+            dedup.remember(device_id_, key, seq, {"success": True})
+    return [seq for d, key, seq in fresh if (d, key) in accepted]
+
+
+def test_window_duplicates_inside_window():
+    window = SeqWindow()
+    for seq in range(10):
+        window.mark(seq)
+    assert window.classify(5) == DUPLICATE
+    assert window.classify(10) == NEW
+
+
+def test_backward_jump_beyond_window_is_left_to_the_table_without_boot():
+    window = SeqWindow()
+    window.mark(500)
+    assert window.classify(0) == NEW
+    window.mark(0)
+    assert window.mask == 1
+
+
+def test_new_boot_is_reset_even_for_small_offsets():
+    window = SeqWindow()
+    window.mark(30, boot=1)
+    assert window.classify(0, boot=2) == RESET
+    assert window.classify(0, boot=1) == NEW     # fuera de la ventana: decide la tabla
+    assert window.classify(30, boot=1) == DUPLICATE
+
+
+def test_replayed_upload_without_boot_is_rejected(db):
+    dedup = ReadingDedup()
+    assert _apply(dedup, db, 7, range(501)) == list(range(501))
+    # Sin boot un retroceso grande no se toma como reinicio: la subida repetida no se aplica
+    assert _apply(dedup, db, 7, range(0, 200)) == []
+    assert _apply(dedup, db, 7, [100, 199]) == []
+    assert _apply(dedup, db, 7, [501]) == [501]
+
+
+def test_reboot_with_boot_counter_keeps_old_keys_apart(db):
+    dedup = ReadingDedup()
+    assert _apply(dedup, db, 8, range(40), boot=1) == list(range(40))
+    assert _apply(dedup, db, 8, range(40), boot=2) == list(range(40))
+    # Reintentos tardíos del arranque anterior siguen siendo duplicados
+    assert _apply(dedup, db, 8, [3, 39], boot=1) == []
+
+
+def test_restart_of_the_process_recovers_latest_boot(db):
+    _apply(ReadingDedup(), db, 9, range(10), boot=4)
+    dedup = ReadingDedup()   # otro proceso, sin ventana en memoria
+    assert _apply(dedup, db, 9, [5], boot=4) == []
+    assert _apply(dedup, db, 9, [5], boot=5) == [5]
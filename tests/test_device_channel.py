@@ -0,0 +1,48 @@
+import asyncio
+import pytest
+from app import device_channel
+from app.device_channel import DeviceChannels, DeviceConnection
+
+
+class BrokenSocket:
+    """El enlace se cae al primer envío."""
+
+    async def send_json(self, message, mode="text"):
+        raise ConnectionResetError("enlace caído")
+
+
+def _command(command_id, action):
+    return {"type": "command", "action": action, "command_id": command_id}
+
+
+def test_requeue_keeps_issue_order_after_failed_send(monkeypatch):
+    published = []
+    monkeypatch.setattr(device_channel.command_bus, "publish",
+                        lambda device_id, action, source, command_id=None: published.append((command_id, action)))
+
+    async def scenario():
+        channels = DeviceChannels()
+        conn = DeviceConnection(4, True, BrokenSocket(), 3)
+        conn.outbox.put_nowait(_command("c1", "open"))
+        conn.outbox.put_nowait({"type": "ack", "results": []})
+        conn.outbox.put_nowait(_command("c2", "close"))
+        conn.in_flight = _command("c3", "open")     # esperando lugar en la cola llena
+        with pytest.raises(ConnectionResetError):
+            await channels._send_loop(conn)
+        channels._requeue(conn)
+
+    asyncio.run(scenario())
+    assert published == [("c1", "open"), ("c2", "close"), ("c3", "open")]
+
+
+def test_failed_send_goes_back_to_the_head(monkeypatch):
+    async def scenario():
+        channels = DeviceChannels()
+        conn = DeviceConnection(5, False, BrokenSocket(), 4)
+        conn.outbox.put_nowait(_command("old", "open"))
+        conn.outbox.put_nowait(_command("new", "close"))
+        with pytest.raises(ConnectionResetError):
+            await channels._send_loop(conn)
+        return [m["command_id"] for m in conn.unsent] + [conn.outbox.get_nowait()["command_id"]]
+
+    assert asyncio.run(scenario()) == ["old", "new"]
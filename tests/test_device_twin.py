@@ -0,0 +1,37 @@
+from sqlalchemy import text
+from app.device_twin import change_device_status, device_twin
+
+
+def _valve(db, device_id, status):
+    db.execute(text("INSERT INTO device_iot (id, lot_id, status, devices_id, data_devices) "
+                    "VALUES (:id, 1, :status, 2, '{}')"), {"id": device_id, "status": status})
+    db.commit()
+
+
+def _db_status(db, device_id):
+    return db.execute(text("SELECT status FROM device_iot WHERE id = :id"), {"id": device_id}).scalar()
+
+
+def test_load_many_reads_the_database_not_the_stale_twin(db):
+    _valve(db, 41, 12)
+    assert device_twin.get(db, 41).status == 12
+    # Otro worker abrió la válvula: este gemelo no se enteró
+    db.execute(text("UPDATE device_iot SET status = 22 WHERE id = 41")); db.commit()
+    assert device_twin.peek(41).status == 12
+    assert device_twin.load_many(db, [41])[41].status == 22
+    assert device_twin.peek(41).status == 22
+
+
+def test_strict_change_refuses_a_decision_taken_on_a_stale_state(db):
+    _valve(db, 42, 12)
+    stale = device_twin.get(db, 42)
+    db.execute(text("UPDATE device_iot SET status = 22 WHERE id = 42")); db.commit()
+
+    assert change_device_status(db, stale, 26, "leak", strict=True) is False
+    db.commit()
+    assert _db_status(db, 42) == 22
+
+    fresh = device_twin.load_many(db, [42])[42]
+    assert change_device_status(db, fresh, 26, "leak", strict=True) is True
+    db.commit()
+    assert _db_status(db, 42) == 26
@@ -0,0 +1,106 @@
+from datetime import datetime
+import pytest
+from fastapi.responses import JSONResponse
+from sqlalchemy import text
+from app.database import engine
+from app.device_twin import device_twin
+from app.devices import ingest_queue
+from app.devices.ingest_queue import ReadingQueue
+from app.devices.models import Device, DeviceIotReading, DeviceReadingRollup
+from app.devices.schemas import DeviceIotReadingUpdateByLot
+from app.devices.templates import device_templates
+
+SENSOR_TYPE_ID = 3
+
+
+def _reading(device_id, value, ts=None):
+    return DeviceIotReadingUpdateByLot(device_id=device_id, lot_id=4, device_type_id=SENSOR_TYPE_ID,
+                                       sensor_value=value, ts=ts)
+
+
+@pytest.fixture
+def applied(monkeypatch):
+    """Reemplaza apply_readings_batch y devuelve los lotes que recibió."""
+    batches = []
+
+    def apply_readings_batch(self, readings):
+        batches.append([(r.device_id, r.sensor_value) for r in readings])
+        return [{"index": i, "device_id": r.device_id, "success": r.device_id != 99}
+                for i, r in enumerate(readings)]
+    monkeypatch.setattr(ingest_queue.DeviceService, "apply_readings_batch", apply_readings_batch)
+    return batches
+
+
+def test_full_queue_rejects_instead_of_blocking():
+    q = ReadingQueue(maxsize=2, flush_max_items=10, flush_interval=0.01)
+    assert q.put(_reading(30, 1.0))
+    assert q.put(_reading(30, 2.0))
+    assert not q.put(_reading(30, 3.0))
+    assert q.stats()["enqueued"] == 2
+    assert q.stats()["rejected"] == 1
+    assert q.stats()["pending"] == 2
+
+
+def test_reading_is_stamped_on_arrival():
+    q = ReadingQueue(maxsize=10, flush_max_items=10, flush_interval=0.01)
+    given = datetime(2026, 3, 1, 9, 0)
+    early, late = _reading(30, 1.0, ts=given), _reading(30, 2.0)
+    before = datetime.now()
+    q.put(early)
+    q.put(late)
+    assert early.ts == given
+    assert before <= late.ts <= datetime.now()
+
+
+def test_flush_groups_by_device_keeping_arrival_order(applied):
+    q = ReadingQueue(maxsize=10, flush_max_items=10, flush_interval=0.01)
+    q._flush([_reading(30, 1.0), _reading(31, 5.0), _reading(30, 2.0), _reading(99, 0.0), _reading(31, 6.0)])
+    assert applied == [[(30, 1.0), (30, 2.0), (31, 5.0), (31, 6.0), (99, 0.0)]]
+    assert (q.flushed, q.failed, q.flushes) == (4, 1, 1)
+
+
+def test_failed_batch_is_retried_one_by_one(monkeypatch):
+    def broken_batch(self, readings):
+        raise RuntimeError("deadlock detected")
+    sent = []
+
+    def single(self, reading):
+        sent.append(reading.device_id)
+        return JSONResponse(status_code=404 if reading.device_id == 99 else 200, content={})
+    monkeypatch.setattr(ingest_queue.DeviceService, "apply_readings_batch", broken_batch)
+    monkeypatch.setattr(ingest_queue.DeviceService, "update_device_reading_by_lot", single)
+
+    q = ReadingQueue(maxsize=10, flush_max_items=10, flush_interval=0.01)
+    q._flush([_reading(30, 1.0), _reading(99, 2.0), _reading(30, 3.0)])
+    assert sent == [30, 30, 99]
+    assert (q.flushed, q.failed, q.flushes) == (2, 1, 1)
+
+
+def test_collect_stops_at_flush_max_items():
+    q = ReadingQueue(maxsize=10, flush_max_items=3, flush_interval=1.0)
+    for value in range(5):
+        q.put(_reading(30, float(value)))
+    assert len(q._collect()) == 3
+    assert len(q._collect()) == 2
+    assert q._collect() == []
+
+
+def test_stop_drains_pending_readings_into_the_history(db):
+    for table in (Device.__table__, DeviceReadingRollup.__table__):
+        table.drop(engine, checkfirst=True)
+        table.create(engine)
+    db.add(Device(id=SENSOR_TYPE_ID, properties={}))
+    db.execute(text("INSERT INTO device_iot (id, lot_id, status, devices_id, data_devices) "
+                    "VALUES (30, 4, 12, :t, '{}')"), {"t": SENSOR_TYPE_ID})
+    db.commit()
+    device_templates.invalidate()
+    device_twin.invalidate(30)
+
+    q = ReadingQueue(maxsize=10, flush_max_items=100, flush_interval=0.05)
+    for value in range(4):
+        q.put(_reading(30, float(value)))
+    q.start()
+    q.stop()
+    assert q.stats()["pending"] == 0
+    assert q.stats()["flushed"] == 4
+    assert db.query(DeviceIotReading).filter(DeviceIotReading.device_iot_id == 30).count() == 4
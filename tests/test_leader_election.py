@@ -0,0 +1,82 @@
+import threading
+import time
+from app import arduino_reader
+from app.arduino_reader import DeadlineScheduler, _shard_capacity
+from app.leader_election import LEADER_GATED_EVERY, LeaderElector
+
+
+def _run_until(elector, acquisitions):
+    """Corre el bucle de elección sin PostgreSQL hasta `acquisitions` intentos de tomar el lock."""
+    attempts = []
+
+    def try_acquire():
+        attempts.append(elector._attempts)
+        if len(attempts) == acquisitions:
+            elector._stop.set()
+    elector._try_acquire = try_acquire
+    elector.run()
+    return attempts
+
+
+def test_without_postgres_the_worker_is_the_leader():
+    elected = []
+    elector = LeaderElector("test_sqlite")
+    elector.on_elected(lambda: elected.append(True))
+    elector.start()
+    elector.start()
+    assert elector.is_leader
+    assert elected == [True]
+    assert elector.stats()["elections"] == 1
+
+
+def test_closed_gate_only_tries_every_few_heartbeats():
+    elector = LeaderElector("test_gated", heartbeat=0, can_acquire=lambda: False)
+    assert _run_until(elector, 2) == [LEADER_GATED_EVERY, 2 * LEADER_GATED_EVERY]
+
+    elector = LeaderElector("test_open", heartbeat=0, can_acquire=lambda: True)
+    assert _run_until(elector, 3) == [1, 2, 3]
+
+
+def test_demotion_runs_callbacks_once():
+    demoted = []
+    elector = LeaderElector("test_demote")
+    elector.on_demoted(lambda: demoted.append(True))
+    elector._promote()
+    elector._demote("conexión perdida")
+    elector._demote("detenido")
+    assert not elector.is_leader
+    assert demoted == [True]
+
+
+def test_shard_capacity_limits_shards_per_worker(monkeypatch):
+    leaders = [LeaderElector(f"test_shard:{i}") for i in range(4)]
+    monkeypatch.setattr(arduino_reader, "SCHEDULER_SHARDS", 4)
+    monkeypatch.setattr(arduino_reader, "SCHEDULER_WORKERS", 3)
+    monkeypatch.setattr(arduino_reader, "scheduler_shards",
+                        [DeadlineScheduler(leader, i, 4) for i, leader in enumerate(leaders)])
+    assert _shard_capacity()
+    leaders[0]._promote()
+    assert _shard_capacity()
+    leaders[3]._promote()
+    assert not _shard_capacity()   # ceil(4 / 3) = 2 shards por worker
+    leaders[0]._demote("detenido")
+    assert _shard_capacity()
+
+
+def test_follower_does_not_tick_until_elected(monkeypatch):
+    ticks = []
+    leader = LeaderElector("test_follower")
+    sched = DeadlineScheduler(leader, max_idle=0)
+    monkeypatch.setattr(sched, "tick", lambda reason="manual": ticks.append(reason))
+    leader.on_elected(sched.wake)
+    threading.Thread(target=sched.run, daemon=True).start()
+
+    sched.wake()   # un aviso sin liderazgo no dispara una revisión
+    time.sleep(0.1)
+    assert ticks == []
+
+    leader._promote()
+    deadline = time.monotonic() + 2
+    while not ticks and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert ticks == ["wake"]
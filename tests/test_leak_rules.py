@@ -0,0 +1,87 @@
+import pytest
+from sqlalchemy import text, update
+from app.devices.leak_rules import FAILURE_TYPE_ID, MAINT_STATUS_ID, LeakDetector, LeakRule
+from app.devices.models import DeviceLeakState
+
+
+def _state(db, valve_id):
+    db.expire_all()
+    return db.get(DeviceLeakState, valve_id)
+
+
+def test_workers_share_the_window_and_open_one_incident(db):
+    worker_a, worker_b = LeakDetector(), LeakDetector()
+    assert worker_a.evaluate_batch(db, [(3, 5.0, False)]) == ([], [])
+    db.commit()
+    assert worker_b.evaluate_batch(db, [(3, 5.0, False)]) == ([], [])
+    db.commit()
+    assert worker_a.evaluate_batch(db, [(3, 5.0, False)]) == ([(3, 5.0)], [])
+    db.commit()
+    assert worker_b.evaluate_batch(db, [(3, 6.0, False)]) == ([], [])
+    db.commit()
+    assert _state(db, 3).open_incident
+
+
+def test_clear_is_persisted(db):
+    detector = LeakDetector()
+    detector.evaluate_batch(db, [(4, 5.0, False)] * 3)
+    db.commit()
+    opened, cleared = LeakDetector().evaluate_batch(db, [(4, 0.0, False)] * 3)
+    db.commit()
+    assert (opened, cleared) == ([], [4])
+    assert not _state(db, 4).open_incident
+
+
+def test_rolled_back_incident_opens_again(db):
+    detector = LeakDetector()
+    detector.evaluate_batch(db, [(5, 5.0, False)] * 2)
+    db.commit()
+    assert detector.evaluate_batch(db, [(5, 5.0, False)]) == ([(5, 5.0)], [])
+    db.rollback()
+    assert detector.evaluate_batch(db, [(5, 5.0, False)]) == ([(5, 5.0)], [])
+
+
+def test_pending_leak_maintenance_counts_as_open_incident(db):
+    db.execute(text("INSERT INTO maintenance (device_iot_id, type_failure_id, maintenance_status_id) "
+                    "VALUES (6, :tfid, :msid)"), {"tfid": FAILURE_TYPE_ID, "msid": MAINT_STATUS_ID})
+    db.commit()
+    assert LeakDetector().evaluate_batch(db, [(6, 5.0, False)] * 4) == ([], [])
+
+
+def test_rules_must_implement_evaluate():
+    class Incomplete(LeakRule):
+        name = "incomplete"
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_steady_state_does_not_write_the_row(db):
+    detector = LeakDetector()
+    detector.evaluate_batch(db, [(8, 5.0, True)] * 10)   # válvula abierta con flujo normal
+    db.commit()
+    writes = detector.writes
+    assert detector.evaluate_batch(db, [(8, 5.0, True)] * 3) == ([], [])
+    db.commit()
+    assert detector.writes == writes
+    assert _state(db, 8).version == writes
+
+
+def test_state_changed_by_another_worker_is_reevaluated_under_lock(db, monkeypatch):
+    detector = LeakDetector()
+    detector.evaluate_batch(db, [(9, 5.0, False)] * 2)
+    db.commit()
+    read = detector._read_states
+
+    def read_then_other_worker_opens(session, valve_ids, lock=False):
+        states = read(session, valve_ids, lock)
+        if not lock:
+            # Otro worker abre el incidente entre la lectura y la escritura
+            table = DeviceLeakState.__table__
+            session.execute(update(table).where(table.c.device_iot_id == 9)
+                                         .values(open_incident=True, version=table.c.version + 1))
+        return states
+    monkeypatch.setattr(detector, "_read_states", read_then_other_worker_opens)
+
+    assert detector.evaluate_batch(db, [(9, 5.0, False)]) == ([], [])
+    assert detector.conflicts == 1
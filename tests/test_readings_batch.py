@@ -0,0 +1,86 @@
+import json
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import text
+from app.database import engine
+from app.device_twin import device_twin
+from app.devices import services
+from app.devices.models import Device, DeviceIotReading, DeviceReadingRollup
+from app.devices.schemas import DeviceIotReadingUpdateByLot
+from app.devices.services import DeviceService
+from app.devices.templates import device_templates
+
+T0 = datetime(2026, 3, 1, 9, 0)
+SENSOR_TYPE_ID = 3
+
+
+@pytest.fixture
+def service(db):
+    """Sensores 30 y 31 en el lote 4, sin compresión de histórico."""
+    for table in (Device.__table__, DeviceReadingRollup.__table__):
+        table.drop(engine, checkfirst=True)
+        table.create(engine)
+    db.add(Device(id=SENSOR_TYPE_ID, properties={}))
+    db.execute(text("INSERT INTO device_iot (id, lot_id, status, devices_id, data_devices) "
+                    "VALUES (30, 4, 12, :t, '{}'), (31, 4, 12, :t, '{}')"), {"t": SENSOR_TYPE_ID})
+    db.commit()
+    device_templates.invalidate()
+    device_twin.invalidate(30)
+    device_twin.invalidate(31)
+    return DeviceService(db)
+
+
+def _reading(device_id, value, minute, **extra):
+    return DeviceIotReadingUpdateByLot(device_id=device_id, lot_id=4, device_type_id=SENSOR_TYPE_ID,
+                                       sensor_value=value, ts=T0 + timedelta(minutes=minute), **extra)
+
+
+def _body(response):
+    return response.status_code, json.loads(response.body)
+
+
+def test_batch_reports_one_result_per_reading(db, service):
+    status, body = _body(service.update_device_readings_batch([
+        _reading(30, 1.0, 0), _reading(99, 2.0, 0), _reading(31, 3.0, 1),
+    ]))
+    assert status == 200
+    assert body["data"]["received"] == 3
+    assert body["data"]["applied"] == 2
+    assert [(r["device_id"], r["status"]) for r in body["data"]["results"]] == [(30, 200), (99, 404), (31, 200)]
+
+    stored = db.query(DeviceIotReading.device_iot_id, DeviceIotReading.sensor_value) \
+               .order_by(DeviceIotReading.device_iot_id).all()
+    assert [tuple(r) for r in stored] == [(30, 1.0), (31, 3.0)]
+    assert device_twin.get(db, 31).data_devices["sensor_value"] == 3.0
+
+
+def test_repeated_seq_in_the_same_batch_is_applied_once(db, service):
+    status, body = _body(service.update_device_readings_batch([
+        _reading(30, 1.0, 0, seq=1, boot=1), _reading(30, 1.0, 0, seq=1, boot=1), _reading(30, 2.0, 1, seq=2, boot=1),
+    ]))
+    assert status == 200
+    assert [r.get("duplicate", False) for r in body["data"]["results"]] == [False, True, False]
+    assert db.query(DeviceIotReading).count() == 2
+
+    # El reintento del lote completo no vuelve a escribir el histórico
+    _, body = _body(service.update_device_readings_batch([_reading(30, 2.0, 1, seq=2, boot=1)]))
+    assert body["data"]["results"][0]["duplicate"] is True
+    assert db.query(DeviceIotReading).count() == 2
+
+
+def test_oversized_batch_is_refused(db, service, monkeypatch):
+    monkeypatch.setattr(services, "MAX_BATCH_READINGS", 2)
+    status, body = _body(service.update_device_readings_batch([_reading(30, float(i), i) for i in range(3)]))
+    assert status == 413
+    assert body["success"] is False
+    assert db.query(DeviceIotReading).count() == 0
+
+
+def test_failed_batch_rolls_back_every_reading(db, service, monkeypatch):
+    def broken_append(self, rows):
+        raise RuntimeError("sin espacio en disco")
+    monkeypatch.setattr(services.ReadingStore, "append", broken_append)
+    status, body = _body(service.update_device_readings_batch([_reading(30, 1.0, 0), _reading(31, 2.0, 0)]))
+    assert status == 500
+    assert body["success"] is False
+    assert db.execute(text("SELECT data_devices FROM device_iot WHERE id = 30")).scalar() in ("{}", {})
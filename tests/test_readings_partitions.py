@@ -0,0 +1,50 @@
+from datetime import datetime
+import pytest
+from app.devices import readings
+from app.devices.readings import ReadingStore
+
+
+@pytest.fixture
+def ddl(db, monkeypatch):
+    """ReadingStore como si fuera PostgreSQL: guarda los CREATE TABLE en vez de ejecutarlos."""
+    statements = []
+    monkeypatch.setattr(ReadingStore, "_is_postgres", lambda self: True)
+    monkeypatch.setattr(db, "execute", lambda stmt, *args, **kw: statements.append(str(stmt)))
+    monkeypatch.setattr(readings, "_known_partitions", set())
+    return statements
+
+
+def test_partition_is_known_only_after_commit(db, ddl):
+    store = ReadingStore(db)
+    store.ensure_partitions([datetime(2026, 3, 5), datetime(2026, 3, 20)])
+    assert len(ddl) == 1
+    assert readings._known_partitions == set()
+
+    db.commit()
+    assert readings._known_partitions == {"2026_03"}
+    store.ensure_partitions([datetime(2026, 3, 28)])
+    assert len(ddl) == 1
+
+
+def test_rolled_back_partition_is_created_again(db, ddl):
+    store = ReadingStore(db)
+    store.ensure_partitions([datetime(2026, 4, 1)])
+    db.rollback()
+    assert readings._known_partitions == set()
+
+    store.ensure_partitions([datetime(2026, 4, 2)])
+    assert len(ddl) == 2
+    db.commit()
+    assert readings._known_partitions == {"2026_04"}
+
+
+def test_upcoming_partitions_are_created_ahead_of_ingest(db, ddl):
+    maintainer = readings.PartitionMaintainer(ahead=2)
+    assert maintainer.ensure_upcoming(db, now=datetime(2026, 11, 15)) == 3
+    assert readings._known_partitions == {"2026_11", "2026_12", "2027_01"}
+    assert "FROM ('2026-12-01T00:00:00') TO ('2027-01-01T00:00:00')" in ddl[1]
+
+    # La ingesta de esos meses ya no ejecuta DDL en su transacción
+    ReadingStore(db).ensure_partitions([datetime(2026, 12, 24), datetime(2027, 1, 2)])
+    assert len(ddl) == 3
+    assert maintainer.ensure_upcoming(db, now=datetime(2026, 11, 20)) == 0
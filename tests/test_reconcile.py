@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import text
+from app import arduino_reader
+from app.arduino_reader import VALVE_TYPE_ID, command_for, reconcile_device_statuses
+from app.device_twin import device_twin
+
+NOW = datetime(2026, 5, 1, 12, 0)
+HOUR = timedelta(hours=1)
+
+# id: (estado actual, tipo, ventana del último request aprobado o None)
+DEVICES = {
+    1: (22, VALVE_TYPE_ID, None),                           # sin solicitudes → 12
+    2: (12, VALVE_TYPE_ID, (NOW + HOUR, NOW + 2 * HOUR)),   # futura → 20
+    3: (21, VALVE_TYPE_ID, (NOW + HOUR, NOW + 2 * HOUR)),   # futura, manual: se respeta
+    4: (20, VALVE_TYPE_ID, (NOW - HOUR, NOW + HOUR)),       # vigente → 22
+    5: (21, VALVE_TYPE_ID, (NOW - HOUR, NOW + HOUR)),       # vigente, manual: se respeta
+    6: (22, VALVE_TYPE_ID, (NOW - 2 * HOUR, NOW - HOUR)),   # expirada → 12 con close
+    7: (22, 1, None),                                       # no es válvula ni tiene request
+    8: (12, VALVE_TYPE_ID, (NOW - 2 * HOUR, NOW - HOUR)),   # expirada y ya cerrada
+}
+
+
+@pytest.fixture
+def recorded(db, monkeypatch):
+    for device_id, (status, devices_id, window) in DEVICES.items():
+        db.execute(text("INSERT INTO device_iot (id, lot_id, status, devices_id) VALUES (:id, :id, :s, :t)"),
+                   {"id": device_id, "s": status, "t": devices_id})
+        if window:
+            db.execute(text("INSERT INTO request (status, device_iot_id, open_date, close_date) "
+                            "VALUES (17, :id, :open, :close)"), {"id": device_id, "open": window[0], "close": window[1]})
+        device_twin.invalidate(device_id)
+    db.commit()
+    out = {"commands": [], "transitions": []}
+    monkeypatch.setattr(arduino_reader.command_bus, "publish_after_commit",
+                        lambda db, device_id, action, source: out["commands"].append((device_id, action)))
+    monkeypatch.setattr(arduino_reader.transition_journal, "record_after_commit",
+                        lambda db, device_id, lot_id, old, new, source, request_id=None, ts=None:
+                        out["transitions"].append((device_id, old, new, request_id is not None)))
+    return out
+
+
+def _statuses(db):
+    return dict(db.execute(text("SELECT id, status FROM device_iot")).fetchall())
+
+
+def test_one_pass_moves_each_valve_to_its_target(db, recorded):
+    changed = reconcile_device_statuses(db, NOW)
+    db.commit()
+
+    assert sorted(changed) == [(1, 12, False), (2, 20, True), (4, 22, True), (6, 12, True)]
+    assert _statuses(db) == {1: 12, 2: 20, 3: 21, 4: 22, 5: 21, 6: 12, 7: 22, 8: 12}
+    assert sorted(recorded["commands"]) == [(4, "open"), (6, "close")]
+    # SQLite no devuelve el estado anterior: la transición queda con from_status NULL
+    assert sorted(recorded["transitions"]) == [(1, None, 12, False), (2, None, 20, True),
+                                               (4, None, 22, True), (6, None, 12, True)]
+    assert device_twin.get(db, 4).status == 22
+
+
+def test_second_pass_changes_nothing(db, recorded):
+    reconcile_device_statuses(db, NOW)
+    db.commit()
+    assert reconcile_device_statuses(db, NOW) == []
+
+
+def test_latest_approved_request_wins(db, recorded):
+    # Un request posterior aprobado para la válvula 6 la vuelve a abrir; uno pendiente no cuenta
+    db.execute(text("INSERT INTO request (status, device_iot_id, open_date, close_date) VALUES (17, 6, :o, :c)"),
+               {"o": NOW - HOUR, "c": NOW + HOUR})
+    db.execute(text("INSERT INTO request (status, device_iot_id, open_date, close_date) VALUES (18, 4, :o, :c)"),
+               {"o": NOW - 3 * HOUR, "c": NOW - 2 * HOUR})
+    db.commit()
+    changed = dict((d, s) for d, s, _ in reconcile_device_statuses(db, NOW))
+    assert changed[4] == 22
+    assert 6 not in changed   # ya estaba abierta dentro de la nueva ventana
+
+
+def test_command_for_each_target():
+    assert command_for(22, True) == "open"
+    assert command_for(12, True) == "close"
+    assert command_for(12, False) is None
+    assert command_for(20, True) is None
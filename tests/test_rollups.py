@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import text
+from app.database import engine
+from app.devices.models import Device, DeviceReadingRollup
+from app.devices.readings import ReadingStore
+from app.devices.rollups import RESOLUTIONS, SCOPE_DEVICE, SCOPE_LOT, RollupStore
+
+DAY = datetime(2026, 2, 10)
+
+
+@pytest.fixture
+def store(db):
+    for table in (Device.__table__, DeviceReadingRollup.__table__):
+        table.drop(engine, checkfirst=True)
+        table.create(engine)
+    db.add_all([
+        Device(id=1, properties={"compression": {"algorithm": "deadband", "tolerance": 1}}),
+        Device(id=2, properties={}),
+    ])
+    db.execute(text("INSERT INTO device_iot (id, lot_id, status, devices_id) VALUES (10, 5, 12, 1), (20, 6, 12, 2)"))
+    db.commit()
+    return RollupStore(db)
+
+
+def _reading(device_id, lot_id, minute, value):
+    return {"device_iot_id": device_id, "ts": DAY + timedelta(minutes=minute), "lot_id": lot_id,
+            "sensor_value": value, "data": {}}
+
+
+def _day_rollup(db, scope, scope_id):
+    return db.query(DeviceReadingRollup).filter_by(
+        scope=scope, scope_id=scope_id, resolution=RESOLUTIONS["day"], bucket=DAY
+    ).one_or_none()
+
+
+def test_rebuild_keeps_rollups_of_compressed_types(db, store):
+    # Ingesta: el medidor comprimido recibió 3 lecturas pero el histórico guardó sólo 1
+    store.apply([_reading(10, 5, m, 1.0) for m in range(3)] + [_reading(20, 6, m, 2.0) for m in range(2)])
+    ReadingStore(db).append([_reading(10, 5, 0, 1.0)] + [_reading(20, 6, m, 2.0) for m in range(2)])
+    db.commit()
+
+    assert store.rebuild(DAY, DAY + timedelta(days=1)) == 2
+    assert _day_rollup(db, SCOPE_DEVICE, 10).samples == 3
+    assert _day_rollup(db, SCOPE_LOT, 5).samples == 3
+    assert _day_rollup(db, SCOPE_DEVICE, 20).samples == 2
+    assert _day_rollup(db, SCOPE_LOT, 6).samples == 2
+
+
+def test_pick_resolution_prefers_the_finest_level_within_limit():
+    start = datetime(2026, 1, 1)
+    assert RollupStore.pick_resolution(start, start + timedelta(hours=2), None, 1000) == RESOLUTIONS["minute"]
+    assert RollupStore.pick_resolution(start, start + timedelta(days=7), None, 1000) == RESOLUTIONS["hour"]
+    assert RollupStore.pick_resolution(start, start + timedelta(days=5000), None, 1000) == RESOLUTIONS["day"]
+    assert RollupStore.pick_resolution(start, start + timedelta(days=7), 7200, 1000) == RESOLUTIONS["hour"]
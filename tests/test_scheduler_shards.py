@@ -0,0 +1,27 @@
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from app.arduino_reader import VALVE_TYPE_ID, reconcile_device_statuses
+
+NOW = datetime(2026, 5, 1, 12, 0)
+
+
+def test_each_shard_reconciles_only_its_valves(db):
+    for device_id in range(1, 7):
+        db.execute(text("INSERT INTO device_iot (id, lot_id, status, devices_id) VALUES (:id, :id, 20, :type)"),
+                   {"id": device_id, "type": VALVE_TYPE_ID})
+        db.execute(text("INSERT INTO request (status, device_iot_id, open_date, close_date) "
+                        "VALUES (17, :id, :open, :close)"),
+                   {"id": device_id, "open": NOW - timedelta(hours=1), "close": NOW + timedelta(hours=1)})
+    db.commit()
+
+    changed = reconcile_device_statuses(db, NOW, shard=1, shards=3)
+    db.commit()
+    assert sorted(device_id for device_id, _, _ in changed) == [1, 4]
+
+    statuses = dict(db.execute(text("SELECT id, status FROM device_iot")).fetchall())
+    assert statuses == {1: 22, 2: 20, 3: 20, 4: 22, 5: 20, 6: 20}
+
+    for shard in (0, 2):
+        reconcile_device_statuses(db, NOW, shard=shard, shards=3)
+    db.commit()
+    assert set(dict(db.execute(text("SELECT id, status FROM device_iot")).fetchall()).values()) == {22}
@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import text
+from app import arduino_reader, scheduler_routes
+from app.arduino_reader import SCHEDULER_RETRY_DELAY, VALVE_TYPE_ID, DeadlineScheduler
+from app.device_twin import device_twin
+from app.leader_election import LeaderElector
+from app.scheduler_metrics import Histogram, SchedulerMetrics, TickRecord
+
+T0 = datetime(2026, 5, 1, 6, 0)
+
+
+class VirtualClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def scheduler(db, monkeypatch):
+    """Único shard de este worker, con una válvula que abre a T0 + 1 h y reloj virtual."""
+    db.execute(text("INSERT INTO device_iot (id, lot_id, status, devices_id) VALUES (5, 5, 20, :type)"),
+               {"type": VALVE_TYPE_ID})
+    db.execute(text("INSERT INTO request (status, device_iot_id, open_date, close_date) VALUES (17, 5, :o, :c)"),
+               {"o": T0 + timedelta(hours=1), "c": T0 + timedelta(hours=2)})
+    db.commit()
+    device_twin.invalidate(5)
+    monkeypatch.setattr(arduino_reader.command_bus, "publish_after_commit", lambda *args, **kwargs: None)
+    leader = LeaderElector("test_status")
+    leader.start()
+    sched = DeadlineScheduler(leader, max_idle=0, clock=VirtualClock(T0))
+    monkeypatch.setattr(arduino_reader, "scheduler_shards", [sched])
+    return sched
+
+
+def test_status_reports_ticks_and_deadlines(scheduler):
+    scheduler.tick("start")
+    scheduler.clock.now = T0 + timedelta(hours=1, seconds=2)
+    scheduler.tick("deadline")
+
+    data = scheduler_routes.get_scheduler_status(recent=1)["data"]
+    assert data["owned_shards"] == [0]
+    shard = data["schedulers"][0]
+    assert shard["leader"]["is_leader"] is True
+    assert shard["pending_deadlines"] == 1
+    assert shard["next_deadline"] == (T0 + timedelta(hours=2, milliseconds=1)).isoformat()
+    metrics = shard["metrics"]
+    assert metrics["ticks"] == {"start": 1, "deadline": 1}
+    assert metrics["transitions"] == {"22": 1}
+    assert metrics["commands"] == {"open": 1}
+    assert metrics["rows"] == {"reconcile": 1, "deadlines": 3}
+    assert len(metrics["recent_ticks"]) == 1
+    assert metrics["recent_ticks"][0]["reason"] == "deadline"
+    assert metrics["recent_ticks"][0]["max_lag_ms"] == 2000.0
+
+
+def test_failed_tick_is_counted_and_retried(scheduler, monkeypatch):
+    def broken(db, now, shard=0, shards=1):
+        raise RuntimeError("la base no responde")
+    monkeypatch.setattr(arduino_reader, "reconcile_device_statuses", broken)
+    assert scheduler.tick("start") == []
+
+    metrics = scheduler.metrics.snapshot()
+    assert metrics["errors"] == 1
+    assert metrics["last_error"] == "la base no responde"
+    assert scheduler.next_deadline() == T0 + timedelta(seconds=SCHEDULER_RETRY_DELAY)
+
+
+def test_metrics_endpoint_renders_prometheus_text(scheduler):
+    scheduler.tick("start")
+    response = scheduler_routes.get_scheduler_metrics()
+    assert response.media_type.startswith("text/plain")
+    body = response.body.decode()
+    assert '# TYPE disriego_scheduler_ticks_total counter' in body
+    assert 'disriego_scheduler_ticks_total{shard="0",reason="start"} 1' in body
+    assert 'disriego_scheduler_tick_duration_seconds_count{shard="0"} 1' in body
+    assert 'disriego_scheduler_tick_duration_seconds_bucket{shard="0",le="+Inf"} 1' in body
+    assert 'disriego_scheduler_is_leader{shard="0"} 1' in body
+    assert 'disriego_scheduler_pending_deadlines{shard="0"} 2' in body
+    assert 'disriego_scheduler_next_deadline_seconds{shard="0"} 3600.0' in body
+
+
+def test_histogram_buckets_are_cumulative():
+    hist = Histogram((0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        hist.observe(value)
+    assert hist.cumulative() == [("0.1", 1), ("1.0", 3), ("+Inf", 4)]
+    assert hist.count == 4
+
+
+def test_snapshot_keeps_only_the_recent_history():
+    metrics = SchedulerMetrics(shard=2, history=3)
+    for minute in range(5):
+        tick = TickRecord(T0 + timedelta(minutes=minute), "deadline")
+        tick.duration = 0.01 * (minute + 1)
+        tick.max_lag = 0.5
+        metrics.record(tick, [0.5, -0.1])
+    snapshot = metrics.snapshot(recent=2)
+    assert snapshot["ticks"] == {"deadline": 5}
+    assert snapshot["tick_ms"]["max"] == 50.0
+    assert snapshot["tick_ms"]["p50"] == 40.0   # percentiles sobre los 3 últimos
+    assert [t["started_at"] for t in snapshot["recent_ticks"]] == [
+        (T0 + timedelta(minutes=4)).isoformat(), (T0 + timedelta(minutes=3)).isoformat()
+    ]
+    assert snapshot["deadline_lag_ms"]["observed"] == 10
+    assert snapshot["deadline_lag_ms"]["mean"] == 250.0   # los atrasos negativos cuentan como 0
@@ -0,0 +1,49 @@
+import asyncio
+from app.command_bus import DeviceCommand
+from app.devices import routes
+from app.servo_queue import servo_queues
+
+
+class GoneRequest:
+    """Cliente que cerró la conexión mientras esperaba."""
+
+    def __init__(self, gone_after=0):
+        self.checks = 0
+        self.gone_after = gone_after
+
+    async def is_disconnected(self):
+        self.checks += 1
+        return self.checks > self.gone_after
+
+
+def _republished(monkeypatch):
+    published = []
+    monkeypatch.setattr(routes.servo_queues, "requeue",
+                        lambda device_id, commands: published.extend((device_id, c.command_id) for c in commands))
+    return published
+
+
+def test_long_poll_requeues_a_command_the_client_left_behind(db, monkeypatch):
+    published = _republished(monkeypatch)
+    command = DeviceCommand(31, "open", "test")
+    servo_queues.deliver(command)
+
+    response = asyncio.run(routes.wait_servo_command(GoneRequest(), device_id=31, timeout=1, acks=False))
+    assert response == {"action": ""}
+    assert published == [(31, command.command_id)]
+
+
+def test_sse_requeues_the_command_whose_event_was_not_written(db, monkeypatch):
+    published = _republished(monkeypatch)
+    command = DeviceCommand(32, "close", "test")
+    servo_queues.deliver(command)
+
+    async def scenario():
+        response = await routes.stream_servo_commands(GoneRequest(gone_after=2), device_id=32, acks=False)
+        events = response.body_iterator
+        assert (await events.__anext__()).startswith("retry")
+        assert command.command_id in await events.__anext__()
+        await events.aclose()   # la conexión se cerró antes de escribir el evento
+
+    asyncio.run(scenario())
+    assert published == [(32, command.command_id)]
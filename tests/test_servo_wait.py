@@ -0,0 +1,40 @@
+from datetime import datetime
+import pytest
+from app.command_bus import DeviceCommand
+from app.command_listener import NotifyListener
+from app.servo_queue import SERVO_WAIT_RECHECK, ServoQueues, command_listener
+
+
+def test_waiters_only_poll_the_queue_while_listen_is_down(monkeypatch):
+    queues = ServoQueues(backend="db")
+    monkeypatch.setattr(NotifyListener, "is_postgres", property(lambda self: True))
+
+    monkeypatch.setattr(command_listener, "listening_since", None)
+    assert queues._recheck_interval(25.0) == SERVO_WAIT_RECHECK
+
+    monkeypatch.setattr(command_listener, "listening_since", datetime.now())
+    assert queues._recheck_interval(25.0) == 25.0
+    assert ServoQueues(backend="memory")._recheck_interval(25.0) == 25.0
+
+
+@pytest.mark.parametrize("backend", ["db", "memory"])
+def test_legacy_firmware_without_device_id_still_gets_device_commands(db, backend):
+    queues = ServoQueues(backend=backend)
+    command = DeviceCommand(3, "open", "test")
+    queues.deliver(command)
+
+    assert queues.take(3).command_id == command.command_id
+    legacy = queues.take(None)   # firmware antiguo: GET sin device_id
+    assert legacy.action == "open" and legacy.command_id is None
+    assert queues.take(None) is None
+
+    # Los reenvíos no se vuelven a copiar
+    queues.deliver(DeviceCommand(3, "open", "requeue", command_id=command.command_id))
+    assert queues.take(None) is None
+
+
+def test_configured_legacy_device_is_not_mirrored(db):
+    queues = ServoQueues(backend="memory", legacy_device_id=3)
+    queues.deliver(DeviceCommand(3, "close", "test"))
+    assert queues.take(None).action == "close"
+    assert queues.take(3) is None
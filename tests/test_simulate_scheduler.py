@@ -0,0 +1,19 @@
+import json
+from app.command_bus import command_bus
+from app.transition_journal import transition_journal
+from benchmarks import simulate_scheduler
+
+
+def test_simulated_fleet_gets_exactly_the_expected_transitions(monkeypatch, capsys):
+    # La simulación se suscribe al bus global y compara el journal con sus transiciones
+    monkeypatch.setattr(command_bus, "_handlers", [])
+    with transition_journal._cond:
+        transition_journal._buffer.clear()
+
+    assert simulate_scheduler.main(["--requests", "200", "--per-device", "4", "--json"]) == 0
+    summary = json.loads(capsys.readouterr().out)
+    assert summary["valves"] == 50
+    assert summary["missing"] == 0
+    assert summary["unexpected"] == 0
+    assert summary["commands"] > 0
+    assert summary["journal_rows"] == summary["transitions"]
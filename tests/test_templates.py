@@ -0,0 +1,40 @@
+import pytest
+from app.database import engine
+from app.devices.models import Device
+from app.devices.templates import DeviceTemplateCache, device_templates
+
+
+@pytest.fixture
+def template(db):
+    Device.__table__.drop(engine, checkfirst=True)
+    Device.__table__.create(engine)
+    db.add(Device(id=1, properties={"compression": {"algorithm": "deadband", "tolerance": 1}}))
+    db.commit()
+    device_templates.invalidate()
+    return db.get(Device, 1)
+
+
+def test_template_update_invalidates_after_commit(db, template):
+    assert device_templates.get(db, 1)["compression"]["tolerance"] == 1
+    template.properties = {"compression": {"algorithm": "deadband", "tolerance": 2}}
+    db.flush()
+    assert device_templates.get(db, 1)["compression"]["tolerance"] == 1   # sin confirmar
+    db.commit()
+    assert device_templates.get(db, 1)["compression"]["tolerance"] == 2
+
+
+def test_rolled_back_update_keeps_the_template(db, template):
+    device_templates.get(db, 1)
+    invalidations = device_templates.invalidations
+    template.properties = {}
+    db.flush()
+    db.rollback()
+    assert device_templates.invalidations == invalidations
+
+
+def test_expired_template_is_read_again(db, template):
+    cache = DeviceTemplateCache(ttl=0)
+    assert cache.get(db, 1) is not None
+    db.delete(template)
+    db.commit()
+    assert cache.get(db, 1) is None
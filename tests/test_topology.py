@@ -0,0 +1,59 @@
+import threading
+from sqlalchemy import text
+from app.devices.topology import DELETED_STATUS_ID, VALVE_TYPE_ID, LotTopologyIndex
+
+
+def _device(db, device_id, lot_id, type_id=VALVE_TYPE_ID, status=12):
+    db.execute(text("INSERT INTO device_iot (id, lot_id, status, devices_id) VALUES (:id, :lot, :status, :type)"),
+               {"id": device_id, "lot": lot_id, "status": status, "type": type_id})
+    db.commit()
+
+
+def test_deleted_valve_leaves_its_lot(db):
+    index = LotTopologyIndex()
+    _device(db, 1, 7)
+    _device(db, 2, 7)
+    assert index.valve_id(db, 7) == 1
+    db.execute(text("UPDATE device_iot SET status = :s WHERE id = 1"), {"s": DELETED_STATUS_ID})
+    db.commit()
+    index.invalidate()
+    assert index.valve_id(db, 7) == 2
+
+
+def test_invalidation_during_a_load_forces_another_load(db, monkeypatch):
+    index = LotTopologyIndex()
+    _device(db, 1, 7)
+    query = db.query
+
+    def query_then_invalidate(*args):
+        index.invalidate()   # un dispositivo cambió mientras se leía
+        return query(*args)
+    monkeypatch.setattr(db, "query", query_then_invalidate)
+    assert index.valve_id(db, 7) == 1
+    monkeypatch.undo()
+    assert not index._fresh()
+    index.valve_id(db, 7)
+    assert index._fresh() and index.loads == 2
+
+
+def test_only_one_thread_reloads_and_the_rest_use_the_old_index(db):
+    index = LotTopologyIndex()
+    _device(db, 1, 7)
+    index.valve_id(db, 7)
+    index.invalidate()
+
+    started, release = threading.Event(), threading.Event()
+    load = index.load
+
+    def slow_load(session):
+        started.set()
+        release.wait(5)
+        load(session)
+    index.load = slow_load
+    reloader = threading.Thread(target=index.valve_id, args=(db, 7))
+    reloader.start()
+    assert started.wait(5)
+    assert index.valve_id(db, 7) == 1        # no espera: índice anterior
+    release.set()
+    reloader.join(5)
+    assert index.loads == 2
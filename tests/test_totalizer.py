@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import text
+from app.devices.models import ConsumptionMeasurement
+from app.devices.totalizer import MeterTotalizer
+
+T0 = datetime(2026, 1, 1, 8, 0)
+
+
+def _request(db, request_id=1, valve_id=10):
+    db.execute(text("INSERT INTO request (id, status, device_iot_id, open_date) VALUES (:id, 17, :valve, :open)"),
+               {"id": request_id, "valve": valve_id, "open": T0})
+    db.commit()
+
+
+def _saved(db, request_id=1):
+    rows = db.query(ConsumptionMeasurement).filter(ConsumptionMeasurement.request_id == request_id).all()
+    assert len(rows) <= 1
+    return float(rows[0].final_volume) if rows else None
+
+
+def test_checkpoints_of_two_workers_add_up(db):
+    _request(db)
+    # Sin caché de totales: cada consulta ve los checkpoints del otro worker
+    worker_a, worker_b = MeterTotalizer(cache_ttl=0), MeterTotalizer(cache_ttl=0)
+    worker_a.apply([(5, 100.0, 112.5, T0 + timedelta(minutes=1), 1, 10)])
+    worker_b.apply([(5, 112.5, 120.0, T0 + timedelta(minutes=2), 1, 10)])
+
+    assert worker_a.checkpoint(db) == 1
+    assert worker_b.checkpoint(db) == 1
+    assert _saved(db) == pytest.approx(20.0)
+
+    # Cada worker agrega a lo guardado lo que todavía no guardó
+    worker_a.apply([(5, 120.0, 121.0, T0 + timedelta(minutes=3), 1, 10)])
+    assert worker_a.volume(db, 1) == pytest.approx(21.0)
+    assert worker_b.volume(db, 1) == pytest.approx(20.0)
+    worker_a.checkpoint(db)
+    assert worker_b.volume(db, 1) == pytest.approx(21.0)
+    assert worker_a.checkpoint(db) == 0
+
+
+def test_failed_checkpoint_keeps_the_increments_pending(db, monkeypatch):
+    _request(db)
+    totalizer = MeterTotalizer()
+    totalizer.apply([(5, 0.0, 7.25, T0 + timedelta(minutes=1), 1, 10)])
+
+    def broken_commit():
+        raise RuntimeError("se cayó la conexión")
+    monkeypatch.setattr(db, "commit", broken_commit)
+    with pytest.raises(RuntimeError):
+        totalizer.checkpoint(db)
+    monkeypatch.undo()
+    assert _saved(db) is None
+
+    assert totalizer.checkpoint(db) == 1
+    assert _saved(db) == pytest.approx(7.25)
+
+
+def _final_volume(db, totalizer, value, ts):
+    """Lo que hace la lectura con final_volume: reemplaza el total y deja la marca."""
+    db.add(ConsumptionMeasurement(request_id=1, final_volume=value))
+    totalizer.mark_final_volumes(db, [(1, 10, value, ts)])
+    db.commit()
+    totalizer.sync_final_volume(1, 10, value, ts)
+
+
+def test_device_final_volume_replaces_pending_increments(db):
+    _request(db)
+    totalizer = MeterTotalizer()
+    totalizer.apply([(5, 0.0, 3.0, T0 + timedelta(minutes=1), 1, 10)])
+    _final_volume(db, totalizer, 4.0, T0 + timedelta(minutes=2))
+    assert totalizer.checkpoint(db) == 0
+    assert totalizer.volume(db, 1) == pytest.approx(4.0)
+
+
+def test_final_volume_drops_older_increments_of_other_workers(db):
+    _request(db)
+    reporter, other = MeterTotalizer(), MeterTotalizer()
+    other.apply([(5, 0.0, 3.0, T0 + timedelta(minutes=1), 1, 10),
+                 (5, 3.0, 5.0, T0 + timedelta(minutes=3), 1, 10)])
+    _final_volume(db, reporter, 4.0, T0 + timedelta(minutes=2))
+
+    # Sólo se suma el incremento posterior al final_volume informado
+    assert other.checkpoint(db) == 1
+    assert _saved(db) == pytest.approx(6.0)
+    assert other.stats()["superseded_increments"] == 1
+
+
+def test_reads_are_served_from_memory(db, monkeypatch):
+    _request(db)
+    totalizer = MeterTotalizer()
+    totalizer.apply([(5, 0.0, 2.5, T0 + timedelta(minutes=1), 1, 10)])
+    totalizer.checkpoint(db)
+    totalizer.apply([(5, 2.5, 3.0, T0 + timedelta(minutes=2), 1, 10)])
+
+    def no_queries(*args, **kwargs):
+        raise AssertionError("consulta a la base")
+    monkeypatch.setattr(db, "execute", no_queries)
+    assert totalizer.volume(db, 1) == pytest.approx(3.0)
+    assert totalizer.current(db, 5) == (True, 3.0)
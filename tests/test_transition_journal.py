@@ -0,0 +1,117 @@
+import json
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import pytest
+from sqlalchemy import text
+from app.devices.models import DeviceStatusTransition
+from app.devices.services import DeviceService
+from app.devices.timeline import StatusTimeline
+from app.transition_journal import TransitionJournal, set_device_status, transition_journal
+
+DAY = datetime(2026, 4, 2)
+
+
+def _at(hour, minute=0):
+    return DAY + timedelta(hours=hour, minutes=minute)
+
+
+@pytest.fixture
+def journal():
+    """Journal global con el buffer vacío (lo llenan los commits de otros tests)."""
+    with transition_journal._cond:
+        transition_journal._buffer.clear()
+    return transition_journal
+
+
+def _journaled(db):
+    return [(t.device_iot_id, t.from_status, t.to_status, t.source)
+            for t in db.query(DeviceStatusTransition).order_by(DeviceStatusTransition.id)]
+
+
+def test_transitions_are_written_only_after_commit(db, journal):
+    valve = SimpleNamespace(id=5, lot_id=3, status=20)
+    set_device_status(db, valve, 22, "scheduler", request_id=1)
+    set_device_status(db, valve, 22, "scheduler", request_id=1)   # sin cambio: no se anota
+    assert journal.flush() == 0
+
+    db.commit()
+    assert journal.flush() == 1
+    assert _journaled(db) == [(5, 20, 22, "scheduler")]
+
+
+def test_rolled_back_transitions_are_discarded(db, journal):
+    discarded = journal.discarded
+    set_device_status(db, SimpleNamespace(id=5, lot_id=3, status=22), 12, "api")
+    db.rollback()
+    db.commit()
+    assert journal.discarded == discarded + 1
+    assert journal.flush() == 0
+    assert _journaled(db) == []
+
+
+def test_flush_writes_in_batches_and_keeps_rows_on_failure(db):
+    journal = TransitionJournal(flush_max_items=2, flush_interval=1.0, buffer_max=3)
+    rows = [{"device_iot_id": 5, "lot_id": 3, "request_id": None, "from_status": None,
+             "to_status": status, "source": "test", "ts": _at(8, i)} for i, status in enumerate((20, 22, 12, 20))]
+    journal._append(rows)
+    assert journal.stats()["dropped_overflow"] == 1   # la más antigua
+
+    DeviceStatusTransition.__table__.drop(db.get_bind())
+    assert journal.flush() == 0
+    assert journal.stats()["buffered"] == 3
+    DeviceStatusTransition.__table__.create(db.get_bind())
+
+    assert journal.flush() == 3
+    assert journal.flushes == 2
+    assert [to for _, _, to, _ in _journaled(db)] == [22, 12, 20]
+
+
+@pytest.fixture
+def history(db):
+    """Válvulas 5 y 6 del lote 3 con sus transiciones de un día."""
+    db.execute(text("INSERT INTO device_iot (id, lot_id, status, devices_id) VALUES (5, 3, 22, 2), (6, 3, 12, 2)"))
+    db.add_all([
+        DeviceStatusTransition(device_iot_id=5, lot_id=3, from_status=12, to_status=20, source="approve",
+                               request_id=1, ts=_at(7)),
+        DeviceStatusTransition(device_iot_id=5, lot_id=3, from_status=20, to_status=22, source="scheduler",
+                               request_id=1, ts=_at(8)),
+        DeviceStatusTransition(device_iot_id=5, lot_id=3, from_status=22, to_status=12, source="scheduler",
+                               request_id=1, ts=_at(9, 30)),
+        DeviceStatusTransition(device_iot_id=5, lot_id=3, from_status=12, to_status=22, source="api",
+                               request_id=2, ts=_at(11)),
+        DeviceStatusTransition(device_iot_id=6, lot_id=3, from_status=20, to_status=22, source="scheduler",
+                               request_id=3, ts=_at(8, 30)),
+        DeviceStatusTransition(device_iot_id=6, lot_id=3, from_status=22, to_status=12, source="volume",
+                               request_id=3, ts=_at(9)),
+    ])
+    db.commit()
+    return StatusTimeline(db)
+
+
+def test_intervals_are_clipped_to_the_range(history):
+    intervals = history.intervals(_at(8, 15), _at(10), device_id=5)
+    assert [(i["status"], i["started_at"], i["ended_at"], i["seconds"]) for i in intervals] == [
+        (22, _at(8, 15), _at(9, 30), 4500.0),   # empezó antes del rango
+        (12, _at(9, 30), _at(10), 1800.0),
+    ]
+
+
+def test_open_durations_per_device_and_request(history):
+    intervals = history.intervals(_at(8, 15), _at(10), lot_id=3)
+    assert sorted({i["device_iot_id"] for i in intervals}) == [5, 6]
+    assert history.open_durations(intervals) == {
+        "open_seconds": 6300.0,
+        "by_device": [{"device_iot_id": 5, "open_seconds": 4500.0}, {"device_iot_id": 6, "open_seconds": 1800.0}],
+        "by_request": [{"request_id": 1, "open_seconds": 4500.0}, {"request_id": 3, "open_seconds": 1800.0}]
+    }
+
+
+def test_timeline_service_rejects_an_empty_range(db, history):
+    response = DeviceService(db).get_status_timeline(_at(10), _at(10), device_id=5)
+    assert response.status_code == 400
+
+    response = DeviceService(db).get_status_timeline(_at(6), _at(12), device_id=5)
+    body = json.loads(response.body)["data"]
+    assert body["device_iot_id"] == 5
+    assert body["open_seconds"] == 1.5 * 3600 + 3600
+    assert [i["status"] for i in body["intervals"]] == [20, 22, 12, 22]
@@ -0,0 +1,62 @@
+from datetime import datetime
+import pytest
+from sqlalchemy import text
+from app.command_bus import command_bus
+from app.device_twin import device_twin
+from app.devices.models import ConsumptionMeasurement, RequestVolumeClose
+from app.devices.topology import lot_index
+from app.devices.volume_close import STATUS_CLOSED, STATUS_OPEN, ActiveRequestIndex
+
+T0 = datetime(2026, 1, 1, 8, 0)
+
+
+@pytest.fixture
+def valve(db, monkeypatch):
+    """Válvula 10 abierta en el lote 7 con un request por volumen de 50 L ya cumplido."""
+    db.execute(text("INSERT INTO device_iot (id, lot_id, status, devices_id) VALUES (10, 7, :s, 1)"),
+               {"s": STATUS_OPEN})
+    db.execute(text("INSERT INTO request (id, status, device_iot_id, lot_id, type_opening_id, volume_water, open_date) "
+                    "VALUES (1, 17, 10, 7, 1, 50, :open)"), {"open": T0})
+    db.add(ConsumptionMeasurement(request_id=1, final_volume=55.0))
+    db.commit()
+    lot_index.invalidate()
+    device_twin.invalidate(10)
+    sent = []
+    monkeypatch.setattr(command_bus, "publish_after_commit",
+                        lambda db, device_id, action, source: sent.append((device_id, action)))
+    return sent
+
+
+def _status(db):
+    return db.execute(text("SELECT status FROM device_iot WHERE id = 10")).scalar()
+
+
+def test_request_is_closed_once_across_workers(db, valve):
+    worker_a, worker_b = ActiveRequestIndex(), ActiveRequestIndex()
+    worker_b.load(db)   # worker_b conoce el request antes del cierre
+
+    assert worker_a.evaluate(db, [(7, 1)]) == 1
+    assert _status(db) == STATUS_CLOSED
+    assert db.query(RequestVolumeClose).count() == 1
+
+    # Un operador la reabre: ningún worker vuelve a cerrarla por el mismo request
+    db.execute(text("UPDATE device_iot SET status = :s WHERE id = 10"), {"s": STATUS_OPEN})
+    db.commit()
+    assert worker_b.evaluate(db, [(7, 1)]) == 0
+    assert worker_a.evaluate(db, [(7, 1)]) == 0
+    assert _status(db) == STATUS_OPEN
+    assert valve == [(10, "close")]
+    assert worker_b.for_lot(db, 7).closed_at is not None
+    assert ActiveRequestIndex().for_lot(db, 7).closed_at is not None
+
+
+def test_stale_twin_does_not_hide_a_reopened_valve(db, valve):
+    worker = ActiveRequestIndex()
+    db.execute(text("UPDATE device_iot SET status = :s WHERE id = 10"), {"s": STATUS_CLOSED})
+    db.commit()
+    device_twin.get(db, 10)   # el gemelo queda con la válvula cerrada
+    db.execute(text("UPDATE device_iot SET status = :s WHERE id = 10"), {"s": STATUS_OPEN})
+    db.commit()
+
+    assert worker.evaluate(db, [(7, 1)]) == 1
+    assert _status(db) == STATUS_CLOSED